@@ -1,12 +1,21 @@
 from flask import Flask
 
 from coruscant.api import (
+    city_series as city_series_api,
     measurement_add as measurement_add_api,
+    measurement_add_status as measurement_add_status_api,
     measurament_update as measurament_update_api,
+    measurements_bulk as measurements_bulk_api,
+    measurements_bulk_update as measurements_bulk_update_api,
+    measurements_export as measurements_export_api,
+    measurements_geo_cities as measurements_geo_cities_api,
+    measurements_geo_grid as measurements_geo_grid_api,
     measurements_list as measurements_list_api
 )
+from coruscant.metrics import instrument
 
 app = Flask(__name__)
+instrument(app)
 
 
 @app.route('/api/measurement/add', methods=['POST'])
@@ -14,16 +23,51 @@ def measurement_add():
     return measurement_add_api()
 
 
+@app.route('/api/measurement/add/<write_id>')
+def measurement_add_status(write_id):
+    return measurement_add_status_api(write_id)
+
+
 @app.route('/api/measurement/update', methods=['PATCH'])
 def measurament_update():
     return measurament_update_api()
 
 
+@app.route('/api/measurements/bulk', methods=['POST'])
+def measurements_bulk():
+    return measurements_bulk_api()
+
+
+@app.route('/api/measurements/bulk', methods=['PATCH'])
+def measurements_bulk_update():
+    return measurements_bulk_update_api()
+
+
 @app.route('/api/measurements')
 def measurements_list():
     return measurements_list_api()
 
 
+@app.route('/api/measurements/export')
+def measurements_export():
+    return measurements_export_api()
+
+
+@app.route('/api/measurements/geo/cities')
+def measurements_geo_cities():
+    return measurements_geo_cities_api()
+
+
+@app.route('/api/measurements/geo/grid')
+def measurements_geo_grid():
+    return measurements_geo_grid_api()
+
+
+@app.route('/api/cities/<city>/series')
+def city_series(city):
+    return city_series_api(city)
+
+
 @app.route('/')
 def hello():
     return 'Hello, Planetly!'
@@ -0,0 +1,90 @@
+from quart import Quart
+
+from coruscant.api_async import (
+    city_series as city_series_api,
+    measurement_add as measurement_add_api,
+    measurement_add_status as measurement_add_status_api,
+    measurament_update as measurament_update_api,
+    measurements_bulk as measurements_bulk_api,
+    measurements_bulk_update as measurements_bulk_update_api,
+    measurements_export as measurements_export_api,
+    measurements_geo_cities as measurements_geo_cities_api,
+    measurements_geo_grid as measurements_geo_grid_api,
+    measurements_list as measurements_list_api
+)
+from coruscant.es import close_async_es_client
+from coruscant.metrics import instrument_async
+from coruscant.warmup import warmup_async
+
+app = Quart(__name__)
+instrument_async(app)
+
+
+@app.route('/api/measurement/add', methods=['POST'])
+async def measurement_add():
+    return await measurement_add_api()
+
+
+@app.route('/api/measurement/add/<write_id>')
+async def measurement_add_status(write_id):
+    return await measurement_add_status_api(write_id)
+
+
+@app.route('/api/measurement/update', methods=['PATCH'])
+async def measurament_update():
+    return await measurament_update_api()
+
+
+@app.route('/api/measurements/bulk', methods=['POST'])
+async def measurements_bulk():
+    return await measurements_bulk_api()
+
+
+@app.route('/api/measurements/bulk', methods=['PATCH'])
+async def measurements_bulk_update():
+    return await measurements_bulk_update_api()
+
+
+@app.route('/api/measurements')
+async def measurements_list():
+    return await measurements_list_api()
+
+
+@app.route('/api/measurements/export')
+async def measurements_export():
+    return await measurements_export_api()
+
+
+@app.route('/api/measurements/geo/cities')
+async def measurements_geo_cities():
+    return await measurements_geo_cities_api()
+
+
+@app.route('/api/measurements/geo/grid')
+async def measurements_geo_grid():
+    return await measurements_geo_grid_api()
+
+
+@app.route('/api/cities/<city>/series')
+async def city_series(city):
+    return await city_series_api(city)
+
+
+@app.route('/')
+async def hello():
+    return 'Hello, Planetly!'
+
+
+# Within WARMUP_DEADLINE, which must stay under the startup timeout of the server (60s for hypercorn)
+@app.before_serving
+async def warmup():
+    await warmup_async(app)
+
+
+@app.after_serving
+async def close_es_client():
+    await close_async_es_client()
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000, debug=True)
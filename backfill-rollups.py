@@ -0,0 +1,28 @@
+from argparse import ArgumentParser
+
+from elasticsearch_dsl import connections
+
+from coruscant import rollups
+from coruscant.es import ES_HOST
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description='Rebuilds the hottest measurement rollups from the measurement indexes. The top cities '
+                    'query only reads the rollups once they have been built'
+    )
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Rollups per bulk request')
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    rollups.backfill(connections.get_connection(), chunk_size=args.chunk_size)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # ES setup
+    connections.create_connection(hosts=[ES_HOST], timeout=20)
+
+    main(args)
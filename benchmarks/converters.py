@@ -0,0 +1,56 @@
+"""
+Compares the per-row cost of `generate_es_document` + `to_dict` against `fast_action`.
+
+Usage: python -m benchmarks.converters [--rows N]
+"""
+import random
+import time
+from argparse import ArgumentParser
+
+from coruscant.loader import fast_action, generate_es_document
+
+HEADER = ['dt', 'AverageTemperature', 'AverageTemperatureUncertainty', 'City', 'Country', 'Latitude', 'Longitude']
+
+
+def synthetic_rows(rows: int, cities: int = 3448, seed: int = 0) -> list[list[str]]:
+    rnd = random.Random(seed)
+    locations = [
+        (f'{rnd.uniform(0, 70):.2f}{rnd.choice("NS")}', f'{rnd.uniform(0, 180):.2f}{rnd.choice("EW")}')
+        for _ in range(cities)
+    ]
+    result = []
+    for i in range(rows):
+        city = i % cities
+        lat, lon = locations[city]
+        temperature = f'{rnd.uniform(-20, 40):.3f}' if rnd.random() > 0.04 else ''
+        uncertainty = f'{rnd.uniform(0, 3):.3f}' if temperature else ''
+        day = f'{rnd.randint(1743, 2013)}-{rnd.randint(1, 12):02d}-01'
+        result.append([day, temperature, uncertainty, f'City {city}', f'Country {city % 159}', lat, lon])
+    return result
+
+
+def measure(name: str, convert, rows: list) -> float:
+    start = time.perf_counter()
+    for row in rows:
+        convert(row)
+    elapsed = time.perf_counter() - start
+    per_row = elapsed / len(rows) * 1e6
+    print(f'{name:<24} {per_row:8.2f} us/row  {len(rows) / elapsed:12.0f} rows/sec')
+    return per_row
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200000)
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.rows)
+    dict_rows = [dict(zip(HEADER, row)) for row in rows]
+
+    current = measure('generate_es_document', lambda row: generate_es_document(row).to_dict(True), dict_rows)
+    fast = measure('fast_action', fast_action, rows)
+    print(f'speedup: {current / fast:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares creating an Elasticsearch client per request (what get_es_client used to do) against
+reusing the shared one, doing a search against a local stub HTTP server.
+
+Usage: python -m benchmarks.es_client [--requests N]
+"""
+import json
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from elasticsearch import Elasticsearch
+
+RESPONSE = json.dumps({'took': 1, 'timed_out': False, 'hits': {'hits': []}}).encode('utf-8')
+# Every new client checks it's talking to ES before its first request
+INFO = json.dumps({'version': {'number': '7.16.2', 'build_flavor': 'default'}})
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    wbufsize = -1  # send headers and body together, flushed after every request
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        response = INFO.encode('utf-8') if self.path == '/' else RESPONSE
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.send_header('X-elastic-product', 'Elasticsearch')
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(name: str, get_client, requests: int) -> float:
+    start = time.perf_counter()
+    for _ in range(requests):
+        get_client().search(index='global_land_temperatures_by_city-*', size=10)
+    per_request = (time.perf_counter() - start) / requests * 1e6
+    print(f'{name:<20} {per_request:8.0f} us/request')
+    return per_request
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    host = f'127.0.0.1:{server.server_port}'
+
+    shared = Elasticsearch(host, timeout=30)
+    per_request = measure('client per request', lambda: Elasticsearch(host, timeout=30), args.requests)
+    reused = measure('shared client', lambda: shared, args.requests)
+    print(f'overhead removed: {per_request - reused:.0f} us/request')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
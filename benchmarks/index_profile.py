@@ -0,0 +1,128 @@
+"""
+On-disk size of the measurement indexes and latency of the top cities query (measurements_list) against a
+real Elasticsearch cluster (ES_HOST), to compare the mapping profiles (see INDEX_PROFILE).
+
+Run it once, rebuild the indexes with the other profile, and run it again against the first results:
+
+    python -m benchmarks.index_profile --forcemerge --output standard.json
+    INDEX_PROFILE=optimized python reindex-profile.py
+    python -m benchmarks.index_profile --forcemerge --compare standard.json
+
+Sizes are of the primary shards, so they don't depend on the replicas. Segments are merged with --forcemerge
+before measuring, otherwise the size depends on when the last merges happened.
+
+Usage: python -m benchmarks.index_profile [--requests N] [--concurrency N] [--forcemerge] [--seed N]
+                                          [--output FILE] [--compare FILE]
+"""
+import json
+import platform
+from argparse import ArgumentParser
+
+from benchmarks.suite import commit, run_profile, year_range
+
+
+def profiles() -> dict:
+    """
+    Top cities requests: the hottest ones, read from the rollups but for the partial years, and the coldest
+    and filtered ones, always read from the yearly indexes.
+    """
+    def top(params):
+        return {'method': 'GET', 'path': '/api/measurements', 'query_string': params}
+
+    return {
+        'top_narrow': lambda rnd: top({'cities': 10, **year_range(rnd, 1)}),
+        'top_wide': lambda rnd: top({'cities': 10, **year_range(rnd, rnd.randint(50, 200))}),
+        'coldest_wide': lambda rnd: top({'cities': 10, 'order': 'asc', **year_range(rnd, rnd.randint(50, 200))}),
+        'precise_wide': lambda rnd: top({'cities': 10, 'max_uncertainty': 0.5, **year_range(rnd, 50)}),
+        'country': lambda rnd: top({'cities': 10, 'country': rnd.choice(['Brazil', 'China', 'India', 'Spain'])}),
+    }
+
+
+def store(client) -> dict:
+    """
+    Documents and size of the primary shards, for the yearly and the decade indexes.
+    """
+    from coruscant.documents import Measurement
+    from coruscant.migration import index_profile
+
+    stats = client.indices.stats(index=Measurement.Index.name, metric='docs,store,segments')['indices']
+    settings = client.indices.get_settings(index=Measurement.Index.name)
+    tiers = {}
+    for index, index_stats in stats.items():
+        tier = tiers.setdefault('decades' if index.endswith('s') else 'years', {
+            'indexes': 0, 'docs': 0, 'bytes': 0, 'segments': 0, 'profiles': []
+        })
+        tier['indexes'] += 1
+        tier['docs'] += index_stats['primaries']['docs']['count']
+        tier['bytes'] += index_stats['primaries']['store']['size_in_bytes']
+        tier['segments'] += index_stats['primaries']['segments']['count']
+        tier['profiles'] = sorted({*tier['profiles'], index_profile(settings[index])})
+    return tiers
+
+
+def compare(results: dict, baseline: dict) -> None:
+    print(f'\ncompared to {baseline.get("commit")} ({", ".join(baseline.get("profiles", []))}):')
+    for tier, result in results['store'].items():
+        previous = baseline.get('store', {}).get(tier)
+        if previous:
+            print(f'{tier:<14} size {result["bytes"] / previous["bytes"]:6.2f}x')
+    for name, result in results['queries'].items():
+        previous = baseline.get('queries', {}).get(name)
+        if previous:
+            print(f'{name:<14} p50 {result["latency_ms"]["p50"] / previous["latency_ms"]["p50"]:6.2f}x  '
+                  f'p99 {result["latency_ms"]["p99"] / previous["latency_ms"]["p99"]:6.2f}x')
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=200, help='requests per query')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--forcemerge', action='store_true', help='merge the segments before measuring')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    args = parser.parse_args()
+
+    from app import app
+    from coruscant.documents import Measurement
+    from coruscant.es import get_es_client
+    from coruscant.loader import FORCE_MERGE_TIMEOUT
+
+    client = get_es_client()
+    if args.forcemerge:
+        client.indices.forcemerge(
+            index=Measurement.Index.name, max_num_segments=1, request_timeout=FORCE_MERGE_TIMEOUT
+        )
+    client.indices.refresh(index=Measurement.Index.name)
+
+    results = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'store': store(client),
+        'queries': {},
+    }
+    results['profiles'] = sorted({profile for tier in results['store'].values() for profile in tier['profiles']})
+    for tier, result in results['store'].items():
+        print(f'{tier:<14} {result["indexes"]:5d} indexes  {result["docs"]:10d} docs  '
+              f'{result["bytes"] / 2 ** 20:9.1f} MiB  {result["segments"]:5d} segments  '
+              f'{", ".join(result["profiles"])}')
+
+    for name, request in profiles().items():
+        result = results['queries'][name] = run_profile(
+            app, request, True, args.requests, args.concurrency, args.seed
+        )
+        latency = result['latency_ms']
+        print(f'{name:<14} {result["throughput"]:9.1f} req/s  p50 {latency["p50"]:8.2f} ms  '
+              f'p90 {latency["p90"]:8.2f} ms  p99 {latency["p99"]:8.2f} ms  errors {result["errors"]}')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Measures the latency of the top cities query of the local backend (coruscant.columnar) over a synthetic
+dataset with the shape of the real one, 8.6M rows by default, and of the ES path if ES is reachable.
+
+Both backends should hold the same data for the comparison to be fair: write the synthetic dataset with
+--csv, load it with `initial-load.py --file` and run the benchmark again with --es.
+
+Usage: python -m benchmarks.local_backend [--rows N] [--queries N] [--csv FILE] [--es]
+"""
+import csv
+import time
+from argparse import ArgumentParser
+from datetime import date
+
+import numpy as np
+
+from coruscant.columnar import ColumnarStore, from_month, to_month
+
+CITIES = 3448
+COUNTRIES = 159
+QUERIES = [
+    (10, None, None),
+    (10, date(1990, 1, 1), None),
+    (10, date(1850, 3, 1), date(1920, 10, 1)),
+    (100, date(2000, 1, 1), date(2000, 12, 1)),
+]
+
+
+def synthetic_store(rows: int, seed: int = 0) -> ColumnarStore:
+    """
+    Store with `rows` monthly measurements, spread over CITIES cities from 1743 to 2013.
+    """
+    rng = np.random.default_rng(seed)
+    first, last = to_month(date(1743, 1, 1)), to_month(date(2013, 12, 1))
+    city = np.arange(rows, dtype=np.int32) % CITIES
+    temperature = rng.uniform(-20, 40, rows).astype(np.float32)
+    temperature[rng.random(rows) < 0.04] = np.nan
+    columns = {
+        'month': (first + np.arange(rows) // CITIES % (last - first + 1)).astype(np.int32),
+        'dom': np.ones(rows, dtype=np.int8),
+        'average_temperature': temperature,
+        'average_temperature_uncertainty': rng.uniform(0, 3, rows).astype(np.float32),
+        'city': city,
+        'country': city % COUNTRIES,
+        'lat': rng.uniform(-70, 70, CITIES).astype(np.float32)[city],
+        'lon': rng.uniform(-180, 180, CITIES).astype(np.float32)[city],
+    }
+    return ColumnarStore(
+        [f'City {code}' for code in range(CITIES)], [f'Country {code}' for code in range(COUNTRIES)], columns
+    )
+
+
+def write_csv(store: ColumnarStore, filename: str) -> None:
+    columns = store._columns
+    with open(filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['dt', 'AverageTemperature', 'AverageTemperatureUncertainty', 'City', 'Country',
+                         'Latitude', 'Longitude'])
+        for row in range(len(store)):
+            lat, lon = float(columns['lat'][row]), float(columns['lon'][row])
+            temperature = columns['average_temperature'][row]
+            writer.writerow([
+                from_month(int(columns['month'][row]), int(columns['dom'][row])).isoformat(),
+                '' if np.isnan(temperature) else f'{temperature:.3f}',
+                '' if np.isnan(temperature) else f'{columns["average_temperature_uncertainty"][row]:.3f}',
+                store.cities[columns['city'][row]],
+                store.countries[columns['country'][row]],
+                f'{abs(lat):.2f}{"N" if lat >= 0 else "S"}',
+                f'{abs(lon):.2f}{"E" if lon >= 0 else "W"}',
+            ])
+
+
+def measure(name: str, top_cities, queries: int) -> None:
+    for number_of_cities, _from, _to in QUERIES:
+        top_cities(number_of_cities, _from, _to)  # warm up
+        start = time.perf_counter()
+        for _ in range(queries):
+            top_cities(number_of_cities, _from, _to)
+        per_query = (time.perf_counter() - start) / queries * 1e3
+        print(f'{name:<8} cities={number_of_cities:<4} from={_from} to={_to}  {per_query:8.2f} ms/query')
+
+
+def es_top_cities(number_of_cities, _from, _to):
+    from coruscant import rollups
+    from coruscant.es import TIMEOUTS, get_es_client
+    from coruscant.indexes import index_catalog
+
+    client = get_es_client()
+    if index_catalog.indexes() is None:
+        index_catalog.refresh(client)
+    indexes, body = rollups.top_cities_query(number_of_cities, _from, _to)
+    return client.search(index=indexes, body=body, ignore_unavailable=True, request_timeout=TIMEOUTS['search'])
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=8600000)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--csv', help='write the synthetic dataset to this CSV file')
+    parser.add_argument('--es', action='store_true', help='also measure the ES path')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    store = synthetic_store(args.rows)
+    print(f'{len(store)} rows built in {time.perf_counter() - start:.1f}s')
+    if args.csv:
+        write_csv(store, args.csv)
+
+    measure('local', store.top_cities, args.queries)
+    if args.es:
+        measure('es', es_top_cities, args.queries)
+
+
+if __name__ == '__main__':
+    main()
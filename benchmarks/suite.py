@@ -0,0 +1,422 @@
+"""
+Reproducible benchmark suite: throughput and latency of the API under several load profiles, against a
+local stand-in of Elasticsearch with a configurable latency, and conversion rate of the CSV loader.
+
+The synthetic data has the shape of the real dataset: ~3.4k cities with monthly measurements up to 2013,
+starting between 1743 and ~1950, so the recent years have many more measurements than the old ones, with
+higher uncertainties and more missing temperatures in the old years. Everything is seeded, so two runs
+with the same params send the same requests.
+
+The results are printed and written as JSON (--output), and compared against the results of a previous
+run (--compare), i.e. of the parent commit.
+
+Usage: python -m benchmarks.suite [--requests N] [--latency MS] [--concurrency N] [--profiles P ...]
+                                  [--csv-rows N] [--output FILE] [--compare FILE]
+"""
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Any, Callable, Iterable, Optional
+
+CITIES = 3448
+COUNTRIES = 159
+FIRST_YEAR, LAST_YEAR = 1743, 2013
+BULK_SIZE = 500
+HEADER = ['dt', 'AverageTemperature', 'AverageTemperatureUncertainty', 'City', 'Country', 'Latitude', 'Longitude']
+INFO = {'version': {'number': '7.16.2', 'build_flavor': 'default'}, 'tagline': 'You Know, for Search'}
+
+
+class SyntheticData:
+    """
+    Cities of the synthetic dataset, and their measurements.
+    """
+
+    def __init__(self, cities: int = CITIES, seed: int = 0):
+        rnd = random.Random(seed)
+        self.cities = []
+        for code in range(cities):
+            lat, lon = rnd.uniform(-55, 70), rnd.uniform(-180, 180)
+            self.cities.append({
+                'city': f'City {code}',
+                'country': f'Country {code % COUNTRIES}',
+                'lat': round(lat, 2),
+                'lon': round(lon, 2),
+                # Most cities start early, few of them before 1800: measurements pile up in the recent years
+                'first_year': FIRST_YEAR + int(210 * (1 - rnd.random() ** 2)),
+            })
+
+    def measurement(self, city: dict[str, Any], year: int, month: int, rnd: random.Random) -> dict[str, Any]:
+        age = (year - FIRST_YEAR) / (LAST_YEAR - FIRST_YEAR)
+        season = math.cos((month - 7) / 6 * math.pi) * (1 if city['lat'] >= 0 else -1)
+        measurement = {
+            'day': date(year, month, 1),
+            'city': city['city'],
+            'country': city['country'],
+            'location': {'lat': city['lat'], 'lon': city['lon']},
+        }
+        if rnd.random() > 0.15 * (1 - age):
+            measurement['average_temperature'] = round(
+                28 - abs(city['lat']) * 0.4 + season * abs(city['lat']) * 0.25 + rnd.gauss(0, 1.5), 3
+            )
+            measurement['average_temperature_uncertainty'] = round(0.2 + 2.5 * (1 - age) ** 3 * rnd.random(), 3)
+        return measurement
+
+    def rows(self, limit: Optional[int] = None, seed: int = 0) -> Iterable[list[str]]:
+        """
+        CSV rows, sorted by city and day like the real file.
+        """
+        rnd = random.Random(seed)
+        count = 0
+        for city in self.cities:
+            lat = f'{abs(city["lat"]):.2f}{"N" if city["lat"] >= 0 else "S"}'
+            lon = f'{abs(city["lon"]):.2f}{"E" if city["lon"] >= 0 else "W"}'
+            for year in range(city['first_year'], LAST_YEAR + 1):
+                for month in range(1, 13):
+                    if limit is not None and count >= limit:
+                        return
+                    measurement = self.measurement(city, year, month, rnd)
+                    yield [
+                        measurement['day'].isoformat(),
+                        str(measurement.get('average_temperature', '')),
+                        str(measurement.get('average_temperature_uncertainty', '')),
+                        city['city'], city['country'], lat, lon
+                    ]
+                    count += 1
+
+    def random_measurement(self, rnd: random.Random) -> dict[str, Any]:
+        city = rnd.choice(self.cities)
+        year = rnd.randint(city['first_year'], LAST_YEAR)
+        measurement = self.measurement(city, year, rnd.randint(1, 12), rnd)
+        measurement.setdefault('average_temperature', 20.0)
+        measurement.setdefault('average_temperature_uncertainty', 0.5)
+        return {**measurement, 'day': measurement['day'].isoformat()}
+
+
+class FakeES:
+    """
+    HTTP server answering the requests of the API like ES would, with canned documents of the synthetic
+    dataset, after waiting `latency` seconds. It's not a search engine: searches return the first `size`
+    cities, or the city of the `term` filter.
+    """
+
+    def __init__(self, data: SyntheticData, latency: float = 0.0, seed: int = 0):
+        from coruscant.documents import Measurement, MeasurementRollup
+
+        rnd = random.Random(seed)
+        self.latency = latency
+        self.hits = []
+        for city in data.cities:
+            source = data.measurement(city, LAST_YEAR - rnd.randint(0, 20), 7, rnd)
+            source.setdefault('average_temperature', 20.0)
+            source.setdefault('average_temperature_uncertainty', 0.5)
+            source['day'] = source['day'].isoformat()
+            self.hits.append({
+                '_index': Measurement.index_for_day(date.fromisoformat(source['day'])),
+                '_id': Measurement.generate_id(source['city'], source['country'], source['day']),
+                '_source': source,
+            })
+        self.hits.sort(key=lambda hit: -hit['_source']['average_temperature'])
+        self.by_city = {hit['_source']['city']: hit for hit in self.hits}
+        self.aliases = {
+            Measurement.index_for_day(date(year, 1, 1)): {'aliases': {}} for year in range(FIRST_YEAR, LAST_YEAR + 1)
+        }
+        # The rollups have been backfilled, so the top cities query reads them
+        self.aliases[MeasurementRollup.Index.name] = {'aliases': {MeasurementRollup.READY_ALIAS: {}}}
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def host(self) -> str:
+        return f'127.0.0.1:{self._server.server_port}'
+
+    def start(self) -> 'FakeES':
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def _terms(node: Any, field: str) -> list[Any]:
+        if isinstance(node, dict):
+            found = [node['term'][field]] if isinstance(node.get('term'), dict) and field in node['term'] else []
+            return found + [term for value in node.values() for term in FakeES._terms(value, field)]
+        if isinstance(node, list):
+            return [term for value in node for term in FakeES._terms(value, field)]
+        return []
+
+    def search(self, body: dict[str, Any]) -> dict[str, Any]:
+        cities = self._terms(body.get('query', {}), 'city')
+        if cities:
+            hits = [self.by_city[city] for city in cities[:1] if city in self.by_city]
+        else:
+            hits = self.hits[:body.get('size', 10)]
+        return {
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'max_score': None, 'hits': hits},
+        }
+
+    @staticmethod
+    def mget(index: str, body: dict[str, Any]) -> dict[str, Any]:
+        # No rollup is found, so the adds and updates record theirs
+        return {'docs': [{'_index': index, '_id': _id, 'found': False} for _id in body.get('ids', [])]}
+
+    def bulk(self, lines: list[dict[str, Any]]) -> dict[str, Any]:
+        items, position = [], 0
+        while position < len(lines):
+            (operation, meta), = lines[position].items()
+            position += 1 if operation == 'delete' else 2
+            result = {'_index': meta.get('_index'), '_id': meta.get('_id'), '_version': 1, 'status': 200,
+                      'result': 'updated', '_seq_no': 0, '_primary_term': 1}
+            if operation in ('index', 'create'):
+                result.update(status=201, result='created')
+            if operation == 'update' and meta.get('_source'):
+                result['get'] = {'_source': {**self.hits[0]['_source'], **lines[position - 1].get('doc', {})}}
+            items.append({operation: result})
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def respond(self, method: str, path: str, body: bytes) -> dict[str, Any]:
+        path = path.split('?')[0]
+        if path == '/':
+            return INFO
+        if path.endswith('/_alias'):
+            return self.aliases
+        if path.endswith('/_search'):
+            return self.search(json.loads(body) if body else {})
+        if path.endswith('/_mget'):
+            return self.mget(path.strip('/').split('/')[0], json.loads(body) if body else {})
+        if path.endswith('/_bulk'):
+            return self.bulk([json.loads(line) for line in body.splitlines() if line.strip()])
+        segments = path.strip('/').split('/')
+        if len(segments) == 3 and segments[1] in ('_doc', '_create', '_update'):
+            return {'_index': segments[0], '_id': segments[2], '_version': 1, '_seq_no': 0, '_primary_term': 1,
+                    'result': 'updated' if segments[1] == '_update' else 'created'}
+        return {'acknowledged': True}
+
+    def _handler(self) -> type:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            wbufsize = -1  # send headers and body together
+            disable_nagle_algorithm = True  # large responses take several writes
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if fake.latency:
+                    time.sleep(fake.latency)
+                response = json.dumps(fake.respond(self.command, self.path, body)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.send_header('X-elastic-product', 'Elasticsearch')
+                self.end_headers()
+                self.wfile.write(response)
+
+            do_GET = do_PUT = do_HEAD = do_DELETE = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def year_range(rnd: random.Random, years: int) -> dict[str, str]:
+    first = rnd.randint(FIRST_YEAR, LAST_YEAR - years + 1)
+    return {'from': f'{first}-01-01', 'to': f'{first + years - 1}-{rnd.choice(["06-30", "12-31"])}'}
+
+
+def profiles(data: SyntheticData) -> dict[str, tuple[Callable[[random.Random], dict[str, Any]], bool]]:
+    """
+    Load profiles: a function returning the args of a test client request, and whether the query cache
+    is cleared before every request (so reads measure the ES path instead of the cache).
+    """
+    def top(params):
+        return {'method': 'GET', 'path': '/api/measurements', 'query_string': params}
+
+    return {
+        'top_narrow': (lambda rnd: top({'cities': 10, **year_range(rnd, 1)}), True),
+        'top_wide': (lambda rnd: top({'cities': 10, **year_range(rnd, rnd.randint(50, 200))}), True),
+        'top_all': (lambda rnd: top({'cities': 100}), True),
+        'top_cached': (lambda rnd: top({'cities': 10, 'from': '1990-01-01'}), False),
+        'add': (lambda rnd: {
+            'method': 'POST', 'path': '/api/measurement/add', 'json': data.random_measurement(rnd)
+        }, True),
+        'bulk_add': (lambda rnd: {
+            'method': 'POST', 'path': '/api/measurements/bulk',
+            'json': [data.random_measurement(rnd) for _ in range(BULK_SIZE)]
+        }, True),
+        'update': (lambda rnd: {
+            'method': 'PATCH', 'path': '/api/measurement/update',
+            'query_string': {'city': rnd.choice(data.cities)['city'], 'day': '2013-07-01'},
+            'json': {'average_temperature': round(rnd.uniform(10, 40), 3)}
+        }, True),
+    }
+
+
+def percentile(latencies: list[float], fraction: float) -> float:
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def run_profile(app, request: Callable, clear_cache: bool, requests: int, concurrency: int, seed: int) -> dict:
+    from coruscant.cache import measurements_cache
+
+    rnd = random.Random(seed)
+    calls = [request(rnd) for _ in range(requests)]
+    measurements_cache.clear()
+
+    def worker(worker_calls):
+        latencies, errors = [], 0
+        with app.test_client() as client:
+            for call in worker_calls:
+                if clear_cache:
+                    measurements_cache.clear()
+                start = time.perf_counter()
+                response = client.open(**call)
+                latencies.append(time.perf_counter() - start)
+                errors += response.status_code >= 300
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(worker, [calls[i::concurrency] for i in range(concurrency)]))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency * 1e3 for worker_latencies, _ in results for latency in worker_latencies)
+    return {
+        'requests': requests,
+        'errors': sum(errors for _, errors in results),
+        'seconds': round(elapsed, 4),
+        'throughput': round(requests / elapsed, 2),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3),
+            'p50': round(percentile(latencies, 0.5), 3),
+            'p90': round(percentile(latencies, 0.9), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'max': round(latencies[-1], 3),
+        },
+    }
+
+
+def run_loader(data: SyntheticData, rows: int) -> dict[str, dict]:
+    """
+    Conversion rate of the CSV rows into ES documents, with the original converter and the fast one.
+    """
+    import csv
+    from coruscant.loader import actions_from_csv, docs_from_csv
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'temperatures.csv')
+        with open(filename, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(HEADER)
+            writer.writerows(data.rows(rows))
+
+        for name, convert in (('docs_from_csv', docs_from_csv), ('actions_from_csv', actions_from_csv)):
+            start = time.perf_counter()
+            converted = sum(len(chunk) for chunk in convert(filename))
+            elapsed = time.perf_counter() - start
+            results[name] = {
+                'rows': converted, 'seconds': round(elapsed, 4), 'rows_per_second': round(converted / elapsed)
+            }
+    return results
+
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict) -> None:
+    print(f'\ncompared to {baseline.get("commit")}:')
+    for name, result in results['profiles'].items():
+        previous = baseline.get('profiles', {}).get(name)
+        if previous:
+            print(f'{name:<12} p50 {result["latency_ms"]["p50"] / previous["latency_ms"]["p50"]:6.2f}x  '
+                  f'throughput {result["throughput"] / previous["throughput"]:6.2f}x')
+    for name, result in results['loader'].items():
+        previous = baseline.get('loader', {}).get(name)
+        if previous:
+            print(f'{name:<18} rows/sec {result["rows_per_second"] / previous["rows_per_second"]:6.2f}x')
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=500, help='requests per profile')
+    parser.add_argument('--latency', type=float, default=1.0, help='latency of the fake ES, in ms')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--profiles', nargs='*', help='profiles to run, all by default')
+    parser.add_argument('--csv-rows', type=int, default=200000, help='rows of the loader benchmark, 0 to skip it')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    args = parser.parse_args()
+
+    from elasticsearch_dsl import connections
+
+    from app import app
+    from coruscant.es import CLIENT_SETTINGS
+    from coruscant.indexes import index_catalog
+
+    data = SyntheticData(seed=args.seed)
+    fake_es = FakeES(data, latency=args.latency / 1e3, seed=args.seed).start()
+    connections.remove_connection('default')
+    connections.configure(default={**CLIENT_SETTINGS, 'hosts': [fake_es.host], 'sniff_on_start': False})
+    index_catalog.clear()
+
+    results = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'profiles': {},
+        'loader': {},
+    }
+    for name, (request, clear_cache) in profiles(data).items():
+        if args.profiles and name not in args.profiles:
+            continue
+        result = results['profiles'][name] = run_profile(
+            app, request, clear_cache, args.requests, args.concurrency, args.seed
+        )
+        latency = result['latency_ms']
+        print(f'{name:<12} {result["throughput"]:9.1f} req/s  p50 {latency["p50"]:8.2f} ms  '
+              f'p90 {latency["p90"]:8.2f} ms  p99 {latency["p99"]:8.2f} ms  errors {result["errors"]}')
+    fake_es.stop()
+
+    if args.csv_rows:
+        results['loader'] = run_loader(data, args.csv_rows)
+        for name, result in results['loader'].items():
+            print(f'{name:<18} {result["rows_per_second"]:9d} rows/s')
+
+    failed = [name for name, result in results['profiles'].items() if result['errors']]
+    if failed:
+        # The latencies of failing requests aren't comparable to the ones of a working API
+        raise SystemExit(f'Not recording the results, some requests failed: {", ".join(failed)}')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,41 @@
-from datetime import datetime
+import base64
+import csv
+import json
+import logging
+import struct
+from datetime import date, datetime
+from io import StringIO
+from typing import Any, Callable, Hashable, Iterable, Optional
 
-from elasticsearch.exceptions import ConnectionError
-from flask import request, jsonify
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError, ElasticsearchException, NotFoundError
+from elasticsearch_dsl import Search
+from flask import Response, current_app, request, jsonify
 
+from coruscant import geo, rollups, series
+from coruscant.cache import measurements_cache, measurements_flights, years_for_range
 from coruscant.documents import Measurement
-from coruscant.es import get_es_client
+from coruscant.es import TIMEOUTS, get_es_client
+from coruscant.indexes import index_catalog
+from coruscant.writebehind import WRITE_BEHIND, write_buffer
 
+MAX_BULK_ITEMS = 10000
+UPDATE_FIELDS = ('average_temperature', 'average_temperature_uncertainty')
+TOP_CITIES_ORDERS = ('desc', 'asc')
+TOP_CITIES_PARAMS = ('order', 'country', 'min_uncertainty', 'max_uncertainty')
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_PAGE_SIZE = 1000
+EXPORT_KEEP_ALIVE = '5m'  # of the point in time, extended by every page
+EXPORT_CSV_HEADER = ('day', 'average_temperature', 'average_temperature_uncertainty', 'city', 'country', 'lat', 'lon')
 
-# @app.route('/api/measurement/add')
-def measurement_add():
+logger = logging.getLogger(__name__)
+
+
+def validate_measurement(body: dict) -> list[str]:
+    """
+    Validates the fields of a new measurement, parsing the day and temperatures in place.
+    Returns the list of errors found.
+    """
     FIELDS = [
         'average_temperature',
         'average_temperature_uncertainty',
@@ -19,10 +46,8 @@ def measurement_add():
         'location.lat',
         'location.lon'
     ]
-    body = request.json
     errors = []
 
-    # Validations
     for field in FIELDS:
         if '.' in field:
             base, _field = field.split('.')
@@ -37,124 +62,1009 @@ def measurement_add():
             if field == 'day':
                 try:
                     body['day'] = datetime.strptime(body['day'], '%Y-%m-%d').date()
-                except ValueError:
+                except (TypeError, ValueError):
                     errors.append('Invalid date format for day')
 
             # Validates floats
             if field in ('average_temperature', 'average_temperature_uncertainty'):
                 try:
                     body[field] = float(body[field])
-                except ValueError:
+                except (TypeError, ValueError):
                     errors.append(f'{field} must be a float')
 
+    return errors
+
+
+class Backend:
+    """
+    Storage of the measurements behind the handlers of this module: Elasticsearch (ElasticsearchBackend), or
+    the in-memory columns of coruscant.api_local.ColumnarBackend. The handlers validate the requests and build
+    the responses, the backends only get valid values.
+
+    The methods raise ConnectionError when the storage can't be reached.
+    """
+
+    def add(self, body: dict) -> Optional[str]:
+        """
+        Adds the measurement of a request body, validated by `validate_measurement`.
+        Returns the id of the write if the measurement has only been buffered, see coruscant.writebehind.
+        """
+        raise NotImplementedError
+
+    def bulk_add(self, results: list, measurements: list[tuple[int, Measurement]]) -> None:
+        """
+        Adds the valid measurements of a bulk add, filling their results (see `validate_bulk_measurements`).
+        """
+        raise NotImplementedError
+
+    def update(self, city: str, day: str, fields: dict) -> Optional[dict]:
+        """
+        Updates the measurement of the city and day. Returns the updated measurement, or None if not found.
+        """
+        raise NotImplementedError
+
+    def bulk_update(self, results: list, corrections: list[tuple[int, dict]]) -> None:
+        """
+        Applies the valid corrections of a bulk update, filling their results (see `validate_bulk_corrections`).
+        """
+        raise NotImplementedError
+
+    def top_cities(self, query: dict) -> list[dict]:
+        """
+        Returns the ranking of a top cities query (see `parse_measurements_list`), of `top_cities_size` cities.
+        """
+        raise NotImplementedError
+
+
+class ElasticsearchBackend(Backend):
+    """
+    Measurements in the Elasticsearch indexes of coruscant.documents.Measurement, with the rollups of
+    coruscant.rollups and the query cache of coruscant.cache.
+    """
+
+    def add(self, body: dict) -> Optional[str]:
+        if WRITE_BEHIND:
+            return write_buffer.add(buffered_measurement(body))
+
+        measurement = Measurement(**body)
+        measurement.save(request_timeout=TIMEOUTS['write'])
+        measurements_indexed(get_es_client(), [measurement.to_dict()])
+        return None
+
+    def bulk_add(self, results: list, measurements: list[tuple[int, Measurement]]) -> None:
+        client = get_es_client()
+        response = client.bulk(body=bulk_index_body(measurements), request_timeout=TIMEOUTS['bulk'])
+        measurements_indexed(client, bulk_index_results(results, measurements, response))
+
+    def update(self, city: str, day: str, fields: dict) -> Optional[dict]:
+        # First, get the document from ES and update it. We could do an "update by query",
+        # but it's the same logic under the hood, so I rather be explicit here.
+        response = update_search(city, day).execute()
+        if len(response.hits) == 0:
+            return None
+
+        measurement = response.hits[0]
+        previous = measurement.to_dict()
+        measurement.meta.routing = city
+        measurement.update(**fields)
+        measurement_corrected(get_es_client(), day, previous, measurement.to_dict())
+        return measurement.to_dict()
+
+    def bulk_update(self, results: list, corrections: list[tuple[int, dict]]) -> None:
+        client = get_es_client()
+        response = client.bulk(body=bulk_update_body(corrections), request_timeout=TIMEOUTS['bulk'])
+        measurements_corrected(client, bulk_update_results(results, corrections, response))
+
+    def top_cities(self, query: dict) -> list[dict]:
+        # Note: I am using elasticsearch-py instead of elasticsearch-dsl-py because
+        # the later does not yet support the collapse operator:
+        # https://github.com/elastic/elasticsearch-dsl-py/issues/1215
+        # and making this query without that operator would end up into a very
+        # complex pipeline of python functions that I'd rather avoid. This way,
+        # the code is much cleaner IMO.
+        cache_key = top_cities_cache_key(query)
+        cities, generation = measurements_cache.get(cache_key)
+        if cities is not None:
+            return cities
+
+        def search() -> list[dict]:
+            client = get_es_client()
+
+            # The partial years of the range are only searched in the indexes that exist,
+            # and the full years in the rollups once they have been backfilled
+            if index_catalog.indexes() is None:
+                index_catalog.refresh(client)
+
+            # Full years are read from the rollups, see coruscant.rollups
+            indexes, body = top_cities_search(query)
+            response = client.search(
+                index=indexes, body=body, ignore_unavailable=True, request_timeout=TIMEOUTS['search']
+            )
+
+            cities = [hit['_source'] for hit in response['hits']['hits']]
+            measurements_cache.put(cache_key, years_for_range(query['from'], query['to']), cities, generation)
+            return cities
+
+        # Identical queries missing the cache at the same time share a single search (the pages of a query
+        # share the key). Those arriving after a write get another generation, so a search of their own.
+        return measurements_flights.do((cache_key, generation), search)
+
+
+es_backend = ElasticsearchBackend()
+
+
+def get_backend() -> Backend:
+    """
+    Backend of the app serving the request, set in its BACKEND config (Elasticsearch by default).
+    """
+    return current_app.config.get('BACKEND', es_backend)
+
+
+# @app.route('/api/measurement/add')
+def measurement_add():
+    body = request.json
+
+    errors = validate_measurement(body)
     if errors:
         return {'errors': errors}, 400
 
     measurement = Measurement(**body)
-    measurement.save()
+    try:
+        write_id = get_backend().add(body)
+    except ConnectionError:
+        return {'errors': ['ES does not seem to be reachable']}, 400
+    if write_id is not None:
+        return buffered_add_response(write_id, measurement)
 
     return measurement.to_dict(), 201
 
 
-# @app.route('/api/measurement/update')
-def measurament_update():
-    # First, get the document from ES and update it. We could do an "update by query",
-    # but it's the same logic under the hood, so I rather be explicit here.
+def buffered_measurement(body: dict) -> dict:
+    """
+    A validated measurement, as JSON for the write-behind buffer.
+    """
+    return {**body, 'day': body['day'].isoformat()}
+
+
+def buffered_add_response(write_id: str, measurement: Measurement) -> tuple:
+    return (
+        {'id': write_id, 'status': 'pending', 'measurement': measurement.to_dict()},
+        202,
+        {'Location': f'/api/measurement/add/{write_id}'}
+    )
+
+
+# @app.route('/api/measurement/add/<write_id>')
+def measurement_add_status(write_id: str):
+    status = write_buffer.status(write_id)
+    if status is None:
+        return {'errors': ['Unknown write, or sent too long ago']}, 404
+    return {'id': write_id, **status}, 200
+
+
+def index_buffered(items: list[dict]) -> list[dict]:
+    """
+    Indexes the measurements of the write-behind buffer (see coruscant.writebehind) in a bulk request.
+    Returns the result of every measurement.
+    """
+    results, measurements = validate_bulk_measurements(items)
+    if measurements:
+        es_backend.bulk_add(results, measurements)
+    return results
+
+
+def parse_ndjson(data: str) -> list:
+    """
+    Parses a NDJSON body (one JSON object per line). Lines that can't be parsed are returned as None.
+    """
+    items = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+    return items
+
+
+def _bulk_items() -> list:
+    """
+    Reads the items of a bulk request, sent either as a JSON array or as NDJSON (one JSON object per line).
+    """
+    if request.mimetype == 'application/x-ndjson':
+        return parse_ndjson(request.get_data(as_text=True))
+
+    return request.get_json(silent=True)
+
+
+def validate_bulk_items(items: Any, name: str) -> list[str]:
+    """
+    Validates the body of a bulk request, where `name` is the kind of items it contains.
+    Returns the list of errors found.
+    """
+    if not isinstance(items, list):
+        return [f'Please, provide a JSON array or NDJSON with the {name}']
+    if len(items) > MAX_BULK_ITEMS:
+        return [f'No more than {MAX_BULK_ITEMS} {name} per request']
+    return []
+
+
+def validate_bulk_measurements(items: list) -> tuple[list, list[tuple[int, Measurement]]]:
+    """
+    Validates the items of a bulk add. Returns the results of the invalid items (None for the valid ones),
+    and the valid measurements with their position.
+    """
+    results = [None] * len(items)
+    measurements = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[position] = {'status': 400, 'errors': ['Invalid measurement, it must be a JSON object']}
+            continue
+        errors = validate_measurement(item)
+        if errors:
+            results[position] = {'status': 400, 'errors': errors}
+        else:
+            measurements.append((position, Measurement(**item)))
+    return results, measurements
+
+
+def bulk_index_body(measurements: list[tuple[int, Measurement]]) -> list[dict]:
+    """
+    Body of the bulk request indexing the given measurements, which are sorted in the order of the request.
+    """
+    # A single bulk request, with the documents grouped by their yearly index
+    measurements.sort(key=lambda measurement: measurement[1].day.year)
+    body = []
+    for _, measurement in measurements:
+        body.append({'index': {
+            '_index': Measurement.index_for_day(measurement.day),
+            '_id': Measurement.generate_id(measurement.city, measurement.country, measurement.day),
+            'routing': measurement.city
+        }})
+        body.append(measurement.to_dict())
+    return body
+
+
+def bulk_index_request(items: list) -> tuple[list, list[tuple[int, Measurement]], list[dict]]:
+    """
+    Validates the items of a bulk add. Returns the results of the invalid items (None for the valid ones),
+    the valid measurements with their position, and the body of the bulk request to index them.
+    """
+    results, measurements = validate_bulk_measurements(items)
+    return results, measurements, bulk_index_body(measurements)
 
-    FIELDS = ('average_temperature', 'average_temperature_uncertainty')
 
+def bulk_index_results(results: list, measurements: list[tuple[int, Measurement]], response: dict) -> list[dict]:
+    """
+    Fills the results of the measurements sent in a bulk add, from the bulk response.
+    Returns the measurements that were indexed.
+    """
+    indexed = []
+    for (position, measurement), item in zip(measurements, response['items']):
+        result = item['index']
+        if result.get('error'):
+            results[position] = {'status': result['status'], 'errors': [result['error'].get('reason', 'Unknown')]}
+        else:
+            results[position] = {'status': 201, 'measurement': measurement.to_dict()}
+            indexed.append(measurement.to_dict())
+    return indexed
+
+
+def invalidate_years(measurements: list[dict]) -> None:
+    for year in {measurement['day'].year for measurement in measurements}:
+        measurements_cache.invalidate_year(year)
+
+
+def update_rollups(update: Callable[..., None], client: Elasticsearch, *args: Any) -> None:
+    """
+    Calls one of the coruscant.rollups updates. The measurements have already been written, so a failure
+    is logged instead of failing the request: the rollups of the city are fixed by its next write, or by
+    rebuilding them (backfill-rollups.py).
+    """
     try:
-        city = request.args['city']
-        day = request.args['day']
+        update(client, *args)
+    except ElasticsearchException:
+        logger.exception('Could not update the rollups after a write')
+
+
+def measurements_indexed(client: Elasticsearch, indexed: list[dict]) -> None:
+    """
+    Updates the rollups, query cache and index catalog after adding the given measurements. The id of a
+    measurement is derived from its city, country and day, so it may have overwritten a hotter one.
+    """
+    for year in {measurement['day'].year for measurement in indexed}:
+        index_catalog.add_year(year)
+    update_rollups(rollups.measurements_updated, client, indexed)
+    invalidate_years(indexed)
+
+
+def measurements_corrected(client: Elasticsearch, updated: list[dict]) -> None:
+    """
+    Updates the rollups and query cache after a bulk update of the given measurements.
+    """
+    update_rollups(rollups.measurements_updated, client, updated)
+    invalidate_years(updated)
+
+
+def measurement_corrected(client: Elasticsearch, day: str, previous: dict, current: dict) -> None:
+    """
+    Updates the rollups and query cache after updating the measurement of the given day, from its previous values.
+    """
+    update_rollups(rollups.measurement_updated, client, previous, current)
+    measurements_cache.invalidate_year(int(day[:4]))
+
+
+def bulk_response(results: list, status: int) -> dict:
+    return {
+        'errors': any(result['status'] != status for result in results),
+        'items': results
+    }
+
+
+# @app.route('/api/measurements/bulk')
+def measurements_bulk():
+    items = _bulk_items()
+    errors = validate_bulk_items(items, 'measurements')
+    if errors:
+        return {'errors': errors}, 400
+
+    results, measurements = validate_bulk_measurements(items)
+    if measurements:
+        try:
+            get_backend().bulk_add(results, measurements)
+        except ConnectionError:
+            return {'errors': ['ES does not seem to be reachable']}, 400
+
+    return jsonify(bulk_response(results, 201))
+
+
+def parse_temperatures(body: dict) -> list[str]:
+    """
+    Parses the temperatures to update in place, returning the list of errors found.
+    """
+    errors = []
+    for field in UPDATE_FIELDS:
+        if field in body:
+            try:
+                body[field] = float(body[field])
+            except (TypeError, ValueError):
+                errors.append(f'{field} must be a float')
+    return errors
+
+
+def parse_update(args: dict, body: dict) -> tuple[list[str], Optional[tuple[str, str, dict]]]:
+    """
+    Parses the URL params and body of a measurement update.
+    Returns the list of errors found, and the city, day and fields to update.
+    """
+    try:
+        city = args['city']
+        day = args['day']
     except KeyError:
-        return {'errors': ['city and day fields required as URL params']}, 400
+        return ['city and day fields required as URL params'], None
+
+    try:
+        datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        return ['Invalid date format for day'], None
 
-    body = request.json
     if 'average_temperature' not in body and 'average_temperature_uncertainty' not in body:
-        return {'errors': ['Please, provide either average_temperature or average_temperature_uncertainty']}, 400
+        return ['Please, provide either average_temperature or average_temperature_uncertainty'], None
+
+    fields = {field: body[field] for field in UPDATE_FIELDS if field in body}
+    errors = parse_temperatures(fields)
+    if errors:
+        return errors, None
+
+    return [], (city, day, fields)
 
-    s = Measurement.search().params(
-        routing=city
+
+def update_search(city: str, day: str) -> Search:
+    """
+    Search of the measurement to update.
+    """
+    return Measurement.search().params(
+        routing=city,
+        request_timeout=TIMEOUTS['search']
     ).filter(
         'term', day=day
     ).filter(
         'term', city=city
     )
 
+
+# @app.route('/api/measurement/update')
+def measurament_update():
+    errors, update = parse_update(request.args, request.json)
+    if errors:
+        return {'errors': errors}, 400
+    city, day, fields = update
+
     try:
-        response = s.execute()
+        measurement = get_backend().update(city, day, fields)
     except ConnectionError:
         return {'errors': ['ES does not seem to be reachable']}, 400
 
-    if len(response.hits) == 0:
+    if measurement is None:
         return {'errors': ['Could not find the document']}, 404
 
-    measurement = response.hits[0]
-    measurement.update(**{field: body[field] for field in FIELDS if field in body})
+    return measurement, 200
+
+
+def validate_correction(body: dict) -> list[str]:
+    """
+    Validates an item of a bulk update, parsing the day and temperatures in place.
+    Returns the list of errors found.
+    """
+    errors = [f'Missing field {field}' for field in ('city', 'country', 'day') if field not in body]
+
+    if 'day' in body:
+        try:
+            body['day'] = datetime.strptime(body['day'], '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            errors.append('Invalid date format for day')
+
+    if not any(field in body for field in UPDATE_FIELDS):
+        errors.append('Please, provide either average_temperature or average_temperature_uncertainty')
+
+    return errors + parse_temperatures(body)
+
+
+def validate_bulk_corrections(items: list) -> tuple[list, list[tuple[int, dict]]]:
+    """
+    Validates the items of a bulk update. Returns the results of the invalid items (None for the valid ones),
+    and the valid corrections with their position.
+    """
+    results = [None] * len(items)
+    corrections = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[position] = {'status': 400, 'errors': ['Invalid correction, it must be a JSON object']}
+            continue
+        errors = validate_correction(item)
+        if errors:
+            results[position] = {'status': 400, 'errors': errors}
+        else:
+            corrections.append((position, item))
+    return results, corrections
+
+
+def bulk_update_body(corrections: list[tuple[int, dict]]) -> list[dict]:
+    """
+    Body of the bulk request applying the given corrections.
+    """
+    # Unlike measurament_update, there are no searches here: the documents are addressed
+    # directly by their index and deterministic id, see Measurement.generate_id
+    body = []
+    for _, correction in corrections:
+        body.append({'update': {
+            '_index': Measurement.index_for_day(correction['day']),
+            '_id': Measurement.generate_id(correction['city'], correction['country'], correction['day']),
+            'routing': correction['city'],
+            '_source': True
+        }})
+        body.append({'doc': {field: correction[field] for field in UPDATE_FIELDS if field in correction}})
+    return body
+
+
+def bulk_update_request(items: list) -> tuple[list, list[tuple[int, dict]], list[dict]]:
+    """
+    Validates the items of a bulk update. Returns the results of the invalid items (None for the valid ones),
+    the valid corrections with their position, and the body of the bulk request to apply them.
+    """
+    results, corrections = validate_bulk_corrections(items)
+    return results, corrections, bulk_update_body(corrections)
+
+
+def bulk_update_results(results: list, corrections: list[tuple[int, dict]], response: dict) -> list[dict]:
+    """
+    Fills the results of the corrections sent in a bulk update, from the bulk response.
+    Returns the updated measurements.
+    """
+    updated = []
+    for (position, correction), item in zip(corrections, response['items']):
+        result = item['update']
+        if result['status'] == 404:
+            results[position] = {'status': 404, 'errors': ['Could not find the document']}
+        elif result['status'] == 409:
+            results[position] = {'status': 409, 'errors': ['Conflict with a concurrent update, please retry']}
+        elif result.get('error'):
+            results[position] = {'status': result['status'], 'errors': [result['error'].get('reason', 'Unknown')]}
+        else:
+            measurement = Measurement.from_es({**result, **result['get']})
+            results[position] = {'status': 200, 'measurement': measurement.to_dict()}
+            updated.append(measurement.to_dict())
+    return updated
+
+
+# @app.route('/api/measurements/bulk', methods=['PATCH'])
+def measurements_bulk_update():
+    items = _bulk_items()
+    errors = validate_bulk_items(items, 'corrections')
+    if errors:
+        return {'errors': errors}, 400
+
+    results, corrections = validate_bulk_corrections(items)
+    if corrections:
+        try:
+            get_backend().bulk_update(results, corrections)
+        except ConnectionError:
+            return {'errors': ['ES does not seem to be reachable']}, 400
 
-    return measurement.to_dict(), 200
+    return jsonify(bulk_response(results, 200))
+
+
+def encode_cursor(cursor: dict) -> str:
+    """
+    Opaque cursor of a paginated response, to be sent back as is to get the next page.
+    """
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    Reverse of `encode_cursor`. Raises ValueError for invalid cursors.
+    """
+    cursor = json.loads(base64.urlsafe_b64decode(cursor))
+    if not isinstance(cursor, dict):
+        raise ValueError('Invalid cursor')
+    return cursor
+
+
+def parse_measurements_list(args: dict) -> tuple[list[str], Optional[dict]]:
+    """
+    Parses the URL params of the top cities query.
+    Returns the list of errors found, and the number of cities, date range, ranking order, filters and
+    cursor (the temperature and city to continue after, see `top_cities_page`).
+    """
+    try:
+        number_of_cities = int(args.get('cities', 10))
+    except ValueError:
+        return [f"Invalid cities number: {args.get('cities')}"], None
+
+    errors, date_range = parse_date_range(args)
+    if errors:
+        return errors, None
+
+    order = args.get('order', 'desc')
+    if order not in TOP_CITIES_ORDERS:
+        return [f'Invalid order: {order}, it must be either desc (hottest first) or asc (coldest first)'], None
+
+    uncertainties = {}
+    for param in ('min_uncertainty', 'max_uncertainty'):
+        try:
+            uncertainties[param] = float(args[param]) if args.get(param) else None
+        except ValueError:
+            return [f'Invalid {param}: {args[param]}'], None
+
+    cursor = None
+    if args.get('cursor'):
+        try:
+            cursor = decode_cursor(args['cursor'])['after']
+            if not (
+                isinstance(cursor, list) and len(cursor) == 2
+                and isinstance(cursor[0], (int, float)) and isinstance(cursor[1], str)
+            ):
+                raise ValueError
+        except (ValueError, TypeError, KeyError):
+            return ['Invalid cursor'], None
+
+    return [], {
+        'cities': number_of_cities,
+        'from': date_range[0],
+        'to': date_range[1],
+        'order': order,
+        'country': args.get('country') or None,
+        **uncertainties,
+        'cursor': cursor
+    }
+
+
+def top_cities_size(query: dict) -> int:
+    """
+    Number of cities to search for a top cities query.
+
+    The first page only needs the first cities of the ranking, the following ones read (and cache) the whole
+    ranking, so every page costs the same however deep it is: collapsed searches can't be paginated with
+    search_after in ES 7.
+    """
+    return query['cities'] if query['cursor'] is None else rollups.MAX_CITIES
+
+
+def top_cities_cache_key(query: dict) -> Hashable:
+    return (top_cities_size(query), query['from'], query['to'], *(query[param] for param in TOP_CITIES_PARAMS))
+
+
+def top_cities_search(query: dict) -> tuple[str, dict]:
+    """
+    Returns the indexes and body of the search of a top cities query, see coruscant.rollups.top_cities_query.
+    """
+    return rollups.top_cities_query(
+        top_cities_size(query), query['from'], query['to'], **{param: query[param] for param in TOP_CITIES_PARAMS}
+    )
+
+
+def _float32(value: float) -> float:
+    # ES sorts on the float values of the documents, while their source has the original doubles
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+
+def top_cities_page(cities: list[dict], query: dict) -> dict:
+    """
+    Returns the page of the top cities query in the `cities` ranking, and the cursor to the next page.
+    """
+    if query['cursor'] is not None:
+        temperature, city = _float32(query['cursor'][0]), query['cursor'][1]
+        sign = 1 if query['order'] == 'asc' else -1
+
+        def after_cursor(measurement: dict) -> bool:
+            other = _float32(measurement['average_temperature'])
+            return sign * other > sign * temperature or (other == temperature and measurement['city'] > city)
+
+        position = next((i for i, measurement in enumerate(cities) if after_cursor(measurement)), len(cities))
+        cities = cities[position:position + query['cities']]
+
+    cursor = None
+    if cities and len(cities) == query['cities']:
+        cursor = encode_cursor({'after': [cities[-1]['average_temperature'], cities[-1]['city']]})
+
+    return {'cities': cities, 'cursor': cursor}
+
+
+def parse_date_range(args: dict) -> tuple[list[str], Optional[tuple[Optional[date], Optional[date]]]]:
+    """
+    Parses the `from` and `to` URL params. Returns the list of errors found, and the date range.
+    """
+    _from = args.get('from')
+    _to = args.get('to')
+
+    if _from:
+        try:
+            _from = datetime.strptime(_from, '%Y-%m-%d').date()
+        except ValueError:
+            return [f'Invalid date format: {_from}'], None
+
+    if _to:
+        try:
+            _to = datetime.strptime(_to, '%Y-%m-%d').date()
+        except ValueError:
+            return [f'Invalid date format: {_to}'], None
+
+    if _from and _to and _from > _to:
+        return ["'from' has to be before 'to'"], None
+
+    return [], (_from or None, _to or None)
 
 
 # @app.route('/api/measurements')
 def measurements_list():
-    # Note: I am using elasticsearch-py instead of elasticsearch-dsl-py because
-    # the later does not yet support the collapse operator:
-    # https://github.com/elastic/elasticsearch-dsl-py/issues/1215
-    # and making this query without that operator would end up into a very
-    # complex pipeline of python functions that I'd rather avoid. This way,
-    # the code is much cleaner IMO.
+    errors, query = parse_measurements_list(request.args)
+    if errors:
+        return {'errors': errors}, 400
 
-    query_parameters = request.args
+    try:
+        cities = get_backend().top_cities(query)
+    except ConnectionError:
+        return {'errors': ['ES does not seem to be reachable']}, 400
+
+    return jsonify(
+        top_cities_page(cities, query)
+    )
+
+
+def parse_geo(args: dict, area_required: bool) -> tuple[list[str], Optional[dict]]:
+    """
+    Parses the URL params of the geo aggregations: the area (see coruscant.geo.parse_area), the date range,
+    and either the number of cities or the geohash precision of the grid.
+    """
+    errors, area = geo.parse_area(args)
+    if errors:
+        return errors, None
+    if area is None and area_required:
+        return ['Please, provide either lat, lon and distance, or top, left, bottom and right'], None
+
+    errors, date_range = parse_date_range(args)
+    if errors:
+        return errors, None
+
+    try:
+        number_of_cities = int(args.get('cities', 10))
+    except ValueError:
+        return [f"Invalid cities number: {args.get('cities')}"], None
+    if not 0 < number_of_cities <= geo.MAX_CITIES:
+        return [f'cities must be between 1 and {geo.MAX_CITIES}'], None
 
     try:
-        number_of_cities = int(query_parameters.get('cities', 10))
+        precision = int(args.get('precision', geo.DEFAULT_PRECISION))
     except ValueError:
-        return {'errors': [f"Invalid cities number: {query_parameters.get('cities')}"]}, 400
+        return [f"Invalid precision: {args.get('precision')}"], None
+    if not 1 <= precision <= geo.MAX_PRECISION:
+        return [f'precision must be between 1 and {geo.MAX_PRECISION}'], None
+
+    return [], {
+        'area': area,
+        'from': date_range[0],
+        'to': date_range[1],
+        'cities': number_of_cities,
+        'precision': precision
+    }
+
+
+def geo_cache_key(kind: str, query: dict) -> Hashable:
+    area = tuple(sorted(query['area'].items())) if query['area'] else None
+    size = query['cities'] if kind == 'cities' else query['precision']
+    return ('geo', kind, area, query['from'], query['to'], size)
+
+
+def geo_search(kind: str, query: dict) -> tuple[str, dict]:
+    if kind == 'cities':
+        return geo.cities_query(query['area'], query['cities'], query['from'], query['to'])
+    return geo.grid_query(query['area'], query['precision'], query['from'], query['to'])
+
+
+def geo_buckets(kind: str, response: dict) -> dict:
+    if kind == 'cities':
+        return {'cities': geo.cities_buckets(response)}
+    return {'cells': geo.grid_buckets(response)}
+
 
-    _from = request.args.get('from')
-    _to = request.args.get('to')
+def _geo_aggregation(kind: str):
+    errors, query = parse_geo(request.args, area_required=kind == 'cities')
+    if errors:
+        return {'errors': errors}, 400
+
+    cache_key = geo_cache_key(kind, query)
+    buckets, generation = measurements_cache.get(cache_key)
+    if buckets is not None:
+        return jsonify(buckets)
+
+    client = get_es_client()
+
+    try:
+        if (query['from'] or query['to']) and index_catalog.indexes() is None:
+            index_catalog.refresh(client)
+        indexes, body = geo_search(kind, query)
+        response = client.search(
+            index=indexes, body=body, ignore_unavailable=True, request_timeout=TIMEOUTS['search']
+        )
+    except ConnectionError:
+        return {'errors': ['ES does not seem to be reachable']}, 400
+
+    buckets = geo_buckets(kind, response)
+    measurements_cache.put(cache_key, years_for_range(query['from'], query['to']), buckets, generation)
+
+    return jsonify(buckets)
+
+
+# @app.route('/api/measurements/geo/cities')
+def measurements_geo_cities():
+    return _geo_aggregation('cities')
+
+
+# @app.route('/api/measurements/geo/grid')
+def measurements_geo_grid():
+    return _geo_aggregation('grid')
+
+
+def parse_series(args: dict) -> tuple[list[str], Optional[dict]]:
+    """
+    Parses the URL params of the series of a city: the interval, country, date range and max number of points.
+    """
+    interval = args.get('interval', 'year')
+    if interval not in series.INTERVALS:
+        return [f"Invalid interval: {interval}, it must be one of {', '.join(series.INTERVALS)}"], None
+
+    errors, date_range = parse_date_range(args)
+    if errors:
+        return errors, None
+
+    points = None
+    if args.get('points'):
+        try:
+            points = int(args['points'])
+        except ValueError:
+            return [f"Invalid points number: {args['points']}"], None
+        if not 0 < points <= series.MAX_POINTS:
+            return [f'points must be between 1 and {series.MAX_POINTS}'], None
+
+    return [], {
+        'interval': interval,
+        'country': args.get('country') or None,
+        'from': date_range[0],
+        'to': date_range[1],
+        'points': points
+    }
+
+
+def series_cache_key(city: str, query: dict) -> Hashable:
+    return ('series', city, query['interval'], query['country'], query['from'], query['to'], query['points'])
+
+
+# @app.route('/api/cities/<city>/series')
+def city_series(city: str):
+    errors, query = parse_series(request.args)
+    if errors:
+        return {'errors': errors}, 400
+
+    cache_key = series_cache_key(city, query)
+    result, generation = measurements_cache.get(cache_key)
+    if result is not None:
+        return jsonify(result)
+
+    client = get_es_client()
+
+    try:
+        if (query['from'] or query['to']) and index_catalog.indexes() is None:
+            index_catalog.refresh(client)
+        indexes, body = series.series_query(city, query['interval'], query['country'], query['from'], query['to'])
+        # Like the updates, only the shard of the city is searched in every index
+        response = client.search(
+            index=indexes, body=body, routing=city, ignore_unavailable=True, request_timeout=TIMEOUTS['search']
+        )
+    except ConnectionError:
+        return {'errors': ['ES does not seem to be reachable']}, 400
+
+    result = {
+        'city': city,
+        'interval': query['interval'],
+        'series': series.series_points(response, query['interval'], query['points'])
+    }
+    measurements_cache.put(cache_key, years_for_range(query['from'], query['to']), result, generation)
+
+    return jsonify(result)
+
+
+def parse_export(args: dict) -> tuple[list[str], Optional[dict]]:
+    """
+    Parses the URL params of an export. Returns the list of errors found, and the export filters, format
+    and cursor (the PIT id and sort values to resume from, see `encode_cursor`).
+    """
+    errors, date_range = parse_date_range(args)
+    if errors:
+        return errors, None
+
+    export_format = args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return [f'Invalid format: {export_format}, it must be one of {", ".join(EXPORT_FORMATS)}'], None
+
+    cursor = None
+    if args.get('cursor'):
+        try:
+            cursor = decode_cursor(args['cursor'])
+            if not isinstance(cursor.get('pit'), str) or not isinstance(cursor.get('after'), list):
+                raise ValueError
+        except (ValueError, AttributeError):
+            return ['Invalid cursor'], None
+
+    return [], {
+        'city': args.get('city'),
+        'country': args.get('country'),
+        'from': date_range[0],
+        'to': date_range[1],
+        'format': export_format,
+        'cursor': cursor
+    }
+
+
+def export_search_body(export: dict, pit: str, after: Optional[list]) -> dict:
+    """
+    Body of the search of a page of the export, in the point in time `pit` and after the sort values `after`.
+    """
+    filters = []
+    if export['city']:
+        filters.append({'term': {'city': export['city']}})
+    if export['country']:
+        # The country may be a text field (see INDEX_PROFILE), the exact matches are filtered by `export_page`
+        filters.append({'match_phrase': {'country': export['country']}})
+    if export['from'] or export['to']:
+        day = {}
+        if export['from']:
+            day['gte'] = export['from'].isoformat()
+        if export['to']:
+            day['lte'] = export['to'].isoformat()
+        filters.append({'range': {'day': day}})
 
     body = {
-        'collapse': {'field': 'city'},
-        'sort': [{'average_temperature': 'desc'}],
-        'size': number_of_cities
+        'pit': {'id': pit, 'keep_alive': EXPORT_KEEP_ALIVE},
+        'size': EXPORT_PAGE_SIZE,
+        'query': {'bool': {'filter': filters}},
+        # _shard_doc (implicit in a PIT) breaks the ties between cities with the same name
+        'sort': [{'day': 'asc'}, {'city': 'asc'}, {'_shard_doc': 'asc'}],
+        'track_total_hits': False
     }
+    if after:
+        body['search_after'] = after
+    return body
 
-    if _from or _to:
-        date_range = {}
 
-        if _from:
-            try:
-                # Adds it to the query
-                date_range['gte'] = _from
-                _from = datetime.strptime(_from, '%Y-%m-%d').date()
-            except ValueError:
-                return {'errors': [f'Invalid date format: {_from}']}, 400
+def export_page(export: dict, response: dict) -> tuple[str, Optional[str]]:
+    """
+    Formats a page of the export. Returns its lines, and the cursor to the next page (None for the last one).
+    """
+    hits = response['hits']['hits']
+    cursor = None
+    if len(hits) == EXPORT_PAGE_SIZE:
+        cursor = encode_cursor({'pit': response['pit_id'], 'after': hits[-1]['sort']})
 
-        if _to:
-            try:
-                # Adds it to the query
-                date_range['lte'] = _to
-                _to = datetime.strptime(_to, '%Y-%m-%d').date()
-            except ValueError:
-                return {'errors': [f'Invalid date format: {_to}']}, 400
+    measurements = [hit['_source'] for hit in hits]
+    if export['country']:
+        measurements = [measurement for measurement in measurements if measurement['country'] == export['country']]
+
+    if export['format'] == 'csv':
+        lines = csv_lines([
+            measurement['day'][:10],
+            measurement.get('average_temperature', ''),
+            measurement.get('average_temperature_uncertainty', ''),
+            measurement['city'],
+            measurement['country'],
+            measurement['location']['lat'],
+            measurement['location']['lon']
+        ] for measurement in measurements)
+        # Same resume points, as comment lines (`comment='#'` with pandas)
+        return f'{lines}# cursor={cursor or "null"}\n', cursor
+
+    lines = ''.join(f'{json.dumps(measurement)}\n' for measurement in measurements)
+    # Resume points, the last one (null) tells the export is complete
+    return f'{lines}{json.dumps({"cursor": cursor})}\n', cursor
+
+
+def csv_lines(rows: Iterable[list]) -> str:
+    lines = StringIO()
+    csv.writer(lines).writerows(rows)
+    return lines.getvalue()
+
+
+def export_header(export: dict) -> str:
+    """
+    First lines of an export: the CSV header, unless it's resuming a previous export.
+    """
+    if export['format'] == 'csv' and not export['cursor']:
+        return csv_lines([EXPORT_CSV_HEADER])
+    return ''
 
-        if _from and _to and _from > _to:
-            return {'errors': ["'from' has to be before 'to'"]}, 400
 
-        indexes = Measurement.get_indexes_for_range(_from, _to)
+def export_mimetype(export: dict) -> str:
+    return 'text/csv' if export['format'] == 'csv' else 'application/x-ndjson'
 
-        body['query'] = {'range': {'day': date_range}}
-    else:
-        indexes = 'global_land_temperatures_by_city-*'
+
+# @app.route('/api/measurements/export')
+def measurements_export():
+    errors, export = parse_export(request.args)
+    if errors:
+        return {'errors': errors}, 400
 
     client = get_es_client()
 
+    # The first page is read before the response starts, so its errors get a status code
     try:
-        response = client.search(index=indexes, body=body, ignore_unavailable=True)
+        if export['cursor']:
+            pit, after = export['cursor']['pit'], export['cursor']['after']
+        else:
+            if (export['from'] or export['to']) and index_catalog.indexes() is None:
+                index_catalog.refresh(client)
+            indexes = Measurement.get_indexes_for_range(export['from'], export['to'], index_catalog.indexes())
+            pit = client.open_point_in_time(
+                index=indexes, keep_alive=EXPORT_KEEP_ALIVE, ignore_unavailable=True
+            )['id']
+            after = None
+        response = client.search(body=export_search_body(export, pit, after), request_timeout=TIMEOUTS['search'])
     except ConnectionError:
         return {'errors': ['ES does not seem to be reachable']}, 400
+    except NotFoundError:
+        return {'errors': ['The cursor has expired, please start the export again']}, 410
 
-    return jsonify(
-        {'cities': [hit['_source'] for hit in response['hits']['hits']]}
-    )
+    def pages(response):
+        yield export_header(export)
+        while True:
+            lines, cursor = export_page(export, response)
+            yield lines
+            if cursor is None:
+                break
+            response = client.search(
+                body=export_search_body(export, response['pit_id'], response['hits']['hits'][-1]['sort']),
+                request_timeout=TIMEOUTS['search']
+            )
+        client.close_point_in_time(body={'id': response['pit_id']}, ignore=404)
+
+    return Response(pages(response), mimetype=export_mimetype(export))
@@ -0,0 +1,314 @@
+"""
+Async variant of the API in coruscant.api, served by an ASGI server (see app_async.py).
+
+The handlers share the validation and responses of the sync ones, but wait for Elasticsearch without
+blocking a thread, so a single process can have hundreds of requests in flight (up to ES_ASYNC_POOL_SIZE
+connections to ES). The rollups bookkeeping after a write reuses the sync functions of coruscant.rollups,
+in a worker thread.
+"""
+import asyncio
+
+from elasticsearch.exceptions import ConnectionError, NotFoundError
+from quart import Response, request, jsonify
+
+from coruscant import series
+from coruscant.api import (
+    EXPORT_KEEP_ALIVE,
+    bulk_index_request,
+    bulk_index_results,
+    bulk_response,
+    bulk_update_request,
+    bulk_update_results,
+    measurement_add_status as _measurement_add_status,
+    buffered_add_response,
+    buffered_measurement,
+    export_header,
+    export_mimetype,
+    export_page,
+    export_search_body,
+    geo_buckets,
+    geo_cache_key,
+    geo_search,
+    measurement_corrected,
+    measurements_corrected,
+    measurements_indexed,
+    parse_export,
+    parse_geo,
+    parse_measurements_list,
+    parse_ndjson,
+    parse_series,
+    parse_update,
+    series_cache_key,
+    top_cities_cache_key,
+    top_cities_page,
+    top_cities_search,
+    update_search,
+    validate_bulk_items,
+    validate_measurement
+)
+from coruscant.cache import measurements_cache, measurements_flights, years_for_range
+from coruscant.documents import Measurement
+from coruscant.es import TIMEOUTS, execute_async, get_async_es_client, get_es_client
+from coruscant.indexes import CATALOG_PATTERN, index_catalog
+from coruscant.writebehind import WRITE_BEHIND, write_buffer
+
+
+# @app.route('/api/measurement/add')
+async def measurement_add():
+    body = await request.get_json()
+
+    errors = validate_measurement(body)
+    if errors:
+        return {'errors': errors}, 400
+
+    measurement = Measurement(**body)
+    if WRITE_BEHIND:
+        # Writing the journal may wait for the disk
+        write_id = await asyncio.to_thread(write_buffer.add, buffered_measurement(body))
+        return buffered_add_response(write_id, measurement)
+
+    await measurement.save_async(request_timeout=TIMEOUTS['write'])
+    # The rollups are updated with the sync client
+    await asyncio.to_thread(measurements_indexed, get_es_client(), [measurement.to_dict()])
+
+    return measurement.to_dict(), 201
+
+
+# @app.route('/api/measurement/add/<write_id>')
+async def measurement_add_status(write_id: str):
+    # The statuses are read from files, see coruscant.writebehind
+    return await asyncio.to_thread(_measurement_add_status, write_id)
+
+
+async def _bulk_items() -> list:
+    """
+    Same as coruscant.api._bulk_items.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        return parse_ndjson(await request.get_data(as_text=True))
+
+    return await request.get_json(silent=True)
+
+
+# @app.route('/api/measurements/bulk')
+async def measurements_bulk():
+    items = await _bulk_items()
+    errors = validate_bulk_items(items, 'measurements')
+    if errors:
+        return {'errors': errors}, 400
+
+    results, measurements, body = bulk_index_request(items)
+
+    if body:
+        try:
+            response = await get_async_es_client().bulk(body=body, request_timeout=TIMEOUTS['bulk'])
+        except ConnectionError:
+            return {'errors': ['ES does not seem to be reachable']}, 400
+
+        indexed = bulk_index_results(results, measurements, response)
+        await asyncio.to_thread(measurements_indexed, get_es_client(), indexed)
+
+    return jsonify(bulk_response(results, 201))
+
+
+# @app.route('/api/measurement/update')
+async def measurament_update():
+    errors, update = parse_update(request.args, await request.get_json())
+    if errors:
+        return {'errors': errors}, 400
+    city, day, fields = update
+
+    try:
+        response = await execute_async(update_search(city, day))
+    except ConnectionError:
+        return {'errors': ['ES does not seem to be reachable']}, 400
+
+    if len(response.hits) == 0:
+        return {'errors': ['Could not find the document']}, 404
+
+    measurement = response.hits[0]
+    previous = measurement.to_dict()
+    await get_async_es_client().update(
+        index=measurement.meta.index, id=measurement.meta.id, body={'doc': fields}, routing=city,
+        request_timeout=TIMEOUTS['write']
+    )
+    for field, value in fields.items():
+        setattr(measurement, field, value)
+    await asyncio.to_thread(measurement_corrected, get_es_client(), day, previous, measurement.to_dict())
+
+    return measurement.to_dict(), 200
+
+
+# @app.route('/api/measurements/bulk', methods=['PATCH'])
+async def measurements_bulk_update():
+    items = await _bulk_items()
+    errors = validate_bulk_items(items, 'corrections')
+    if errors:
+        return {'errors': errors}, 400
+
+    results, corrections, body = bulk_update_request(items)
+
+    if body:
+        try:
+            response = await get_async_es_client().bulk(body=body, request_timeout=TIMEOUTS['bulk'])
+        except ConnectionError:
+            return {'errors': ['ES does not seem to be reachable']}, 400
+
+        updated = bulk_update_results(results, corrections, response)
+        await asyncio.to_thread(measurements_corrected, get_es_client(), updated)
+
+    return jsonify(bulk_response(results, 200))
+
+
+# @app.route('/api/measurements')
+async def measurements_list():
+    errors, query = parse_measurements_list(request.args)
+    if errors:
+        return {'errors': errors}, 400
+
+    cache_key = top_cities_cache_key(query)
+    cities, generation = measurements_cache.get(cache_key)
+    if cities is not None:
+        return jsonify(top_cities_page(cities, query))
+
+    async def search() -> list[dict]:
+        client = get_async_es_client()
+
+        # The partial years of the range are only searched in the indexes that exist,
+        # and the full years in the rollups once they have been backfilled
+        if index_catalog.indexes() is None:
+            index_catalog.load(await client.indices.get_alias(index=CATALOG_PATTERN))
+
+        # Full years are read from the rollups, see coruscant.rollups
+        indexes, body = top_cities_search(query)
+        response = await client.search(
+            index=indexes, body=body, ignore_unavailable=True, request_timeout=TIMEOUTS['search']
+        )
+
+        cities = [hit['_source'] for hit in response['hits']['hits']]
+        measurements_cache.put(cache_key, years_for_range(query['from'], query['to']), cities, generation)
+        return cities
+
+    try:
+        # Identical queries missing the cache at the same time share a single search, see api.measurements_list
+        cities = await measurements_flights.do_async((cache_key, generation), search)
+    except ConnectionError:
+        return {'errors': ['ES does not seem to be reachable']}, 400
+
+    return jsonify(
+        top_cities_page(cities, query)
+    )
+
+
+async def _geo_aggregation(kind: str):
+    errors, query = parse_geo(request.args, area_required=kind == 'cities')
+    if errors:
+        return {'errors': errors}, 400
+
+    cache_key = geo_cache_key(kind, query)
+    buckets, generation = measurements_cache.get(cache_key)
+    if buckets is not None:
+        return jsonify(buckets)
+
+    client = get_async_es_client()
+
+    try:
+        if (query['from'] or query['to']) and index_catalog.indexes() is None:
+            index_catalog.load(await client.indices.get_alias(index=CATALOG_PATTERN))
+        indexes, body = geo_search(kind, query)
+        response = await client.search(
+            index=indexes, body=body, ignore_unavailable=True, request_timeout=TIMEOUTS['search']
+        )
+    except ConnectionError:
+        return {'errors': ['ES does not seem to be reachable']}, 400
+
+    buckets = geo_buckets(kind, response)
+    measurements_cache.put(cache_key, years_for_range(query['from'], query['to']), buckets, generation)
+
+    return jsonify(buckets)
+
+
+# @app.route('/api/measurements/geo/cities')
+async def measurements_geo_cities():
+    return await _geo_aggregation('cities')
+
+
+# @app.route('/api/measurements/geo/grid')
+async def measurements_geo_grid():
+    return await _geo_aggregation('grid')
+
+
+# @app.route('/api/cities/<city>/series')
+async def city_series(city: str):
+    errors, query = parse_series(request.args)
+    if errors:
+        return {'errors': errors}, 400
+
+    cache_key = series_cache_key(city, query)
+    result, generation = measurements_cache.get(cache_key)
+    if result is not None:
+        return jsonify(result)
+
+    client = get_async_es_client()
+
+    try:
+        if (query['from'] or query['to']) and index_catalog.indexes() is None:
+            index_catalog.load(await client.indices.get_alias(index=CATALOG_PATTERN))
+        indexes, body = series.series_query(city, query['interval'], query['country'], query['from'], query['to'])
+        response = await client.search(
+            index=indexes, body=body, routing=city, ignore_unavailable=True, request_timeout=TIMEOUTS['search']
+        )
+    except ConnectionError:
+        return {'errors': ['ES does not seem to be reachable']}, 400
+
+    result = {
+        'city': city,
+        'interval': query['interval'],
+        'series': series.series_points(response, query['interval'], query['points'])
+    }
+    measurements_cache.put(cache_key, years_for_range(query['from'], query['to']), result, generation)
+
+    return jsonify(result)
+
+
+# @app.route('/api/measurements/export')
+async def measurements_export():
+    errors, export = parse_export(request.args)
+    if errors:
+        return {'errors': errors}, 400
+
+    client = get_async_es_client()
+
+    try:
+        if export['cursor']:
+            pit, after = export['cursor']['pit'], export['cursor']['after']
+        else:
+            if (export['from'] or export['to']) and index_catalog.indexes() is None:
+                index_catalog.load(await client.indices.get_alias(index=CATALOG_PATTERN))
+            indexes = Measurement.get_indexes_for_range(export['from'], export['to'], index_catalog.indexes())
+            pit = (await client.open_point_in_time(
+                index=indexes, keep_alive=EXPORT_KEEP_ALIVE, ignore_unavailable=True
+            ))['id']
+            after = None
+        response = await client.search(
+            body=export_search_body(export, pit, after), request_timeout=TIMEOUTS['search']
+        )
+    except ConnectionError:
+        return {'errors': ['ES does not seem to be reachable']}, 400
+    except NotFoundError:
+        return {'errors': ['The cursor has expired, please start the export again']}, 410
+
+    async def pages(response):
+        yield export_header(export)
+        while True:
+            lines, cursor = export_page(export, response)
+            yield lines
+            if cursor is None:
+                break
+            response = await client.search(
+                body=export_search_body(export, response['pit_id'], response['hits']['hits'][-1]['sort']),
+                request_timeout=TIMEOUTS['search']
+            )
+        await client.close_point_in_time(body={'id': response['pit_id']}, ignore=404)
+
+    return Response(pages(response), mimetype=export_mimetype(export))
@@ -0,0 +1,70 @@
+"""
+Backend of the API in coruscant.api serving the measurements from memory, without Elasticsearch
+(see app_local.py), for local development, CI and small deployments.
+
+The measurements are in a coruscant.columnar.ColumnarStore loaded from the CSV file (or its snapshot,
+see coruscant.snapshot) in LOCAL_DATA. Changes are not persisted.
+"""
+import os
+from datetime import datetime
+from threading import Lock
+from typing import Optional
+
+from coruscant.api import TOP_CITIES_PARAMS, UPDATE_FIELDS, Backend, top_cities_size
+from coruscant.columnar import ColumnarStore
+from coruscant.documents import Measurement
+from coruscant.loader import PATH_TO_FILE
+from coruscant.snapshot import is_snapshot
+
+LOCAL_DATA = os.environ.get('LOCAL_DATA', PATH_TO_FILE)
+
+_store: Optional[ColumnarStore] = None
+_lock = Lock()
+
+
+def get_store() -> ColumnarStore:
+    """
+    Returns the store of the process, loading it on first use.
+    """
+    global _store
+    with _lock:
+        if _store is None:
+            if is_snapshot(LOCAL_DATA):
+                _store = ColumnarStore.from_snapshot(LOCAL_DATA)
+            else:
+                _store = ColumnarStore.from_csv(LOCAL_DATA)
+        return _store
+
+
+class ColumnarBackend(Backend):
+    """
+    Measurements in the store of the process, see `get_store`.
+    """
+
+    def add(self, body: dict) -> Optional[str]:
+        get_store().add(Measurement(**body).to_dict())
+        return None
+
+    def bulk_add(self, results: list, measurements: list[tuple[int, Measurement]]) -> None:
+        store = get_store()
+        for position, measurement in measurements:
+            store.add(measurement.to_dict())
+            results[position] = {'status': 201, 'measurement': measurement.to_dict()}
+
+    def update(self, city: str, day: str, fields: dict) -> Optional[dict]:
+        return get_store().update(city, datetime.strptime(day, '%Y-%m-%d').date(), fields)
+
+    def bulk_update(self, results: list, corrections: list[tuple[int, dict]]) -> None:
+        store = get_store()
+        for position, correction in corrections:
+            fields = {field: correction[field] for field in UPDATE_FIELDS if field in correction}
+            measurement = store.update_exact(correction['city'], correction['country'], correction['day'], fields)
+            if measurement is None:
+                results[position] = {'status': 404, 'errors': ['Could not find the document']}
+            else:
+                results[position] = {'status': 200, 'measurement': measurement}
+
+    def top_cities(self, query: dict) -> list[dict]:
+        return get_store().top_cities(
+            top_cities_size(query), query['from'], query['to'], **{param: query[param] for param in TOP_CITIES_PARAMS}
+        )
@@ -0,0 +1,312 @@
+"""
+In-process cache for the results of the top cities query and the geo aggregations, and coalescing of the
+identical top cities queries running at the same time.
+
+The writes are shared by the processes serving the API (i.e. the workers of gunicorn or hypercorn) through
+CACHE_WRITES_FILE, so a write handled by one of them invalidates the cache of every one.
+"""
+import asyncio
+import fcntl
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from datetime import date
+from threading import Event, Lock
+from typing import Any, Awaitable, Callable, Hashable, Optional
+from weakref import WeakKeyDictionary
+
+CACHE_SIZE = 1024
+CACHE_TTL = 300  # seconds
+# Writes are not visible to searches until the index is refreshed (every second, see
+# Measurement.Index.settings), so results for a year that has just been written are not cached.
+WRITE_SETTLE_TIME = 2
+# Empty to only invalidate the cache of the process handling the write, i.e. with a single server process
+WRITES_FILE = os.environ.get('CACHE_WRITES_FILE', 'data/cache-writes')
+WRITES_LOG_SIZE = 4096  # writes kept in the file, a process missing more than that clears its whole cache
+
+
+class SharedWrites:
+    """
+    Log of the latest writes (their year, time and process) of the processes serving the API, in a memory-mapped
+    file: a counter of the writes, followed by a ring of the last `size` ones.
+    """
+
+    _COUNTER = struct.Struct('q')
+    _WRITE = struct.Struct('qdq')  # year, time.time() of the write, pid
+
+    def __init__(self, path: str, size: int = WRITES_LOG_SIZE):
+        self.path = path
+        self.size = size
+        self._reset()
+
+    def _reset(self) -> None:
+        # The lock of the file belongs to its open file description, so a forked process opens its own
+        self._lock = Lock()
+        self._fd = None
+        self._map = None
+
+    def _mapped(self) -> mmap.mmap:
+        with self._lock:
+            if self._map is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                length = self._COUNTER.size + self._WRITE.size * self.size
+                if os.fstat(self._fd).st_size < length:
+                    os.ftruncate(self._fd, length)  # zeros: no writes
+                self._map = mmap.mmap(self._fd, length)
+            return self._map
+
+    def _offset(self, write: int) -> int:
+        return self._COUNTER.size + self._WRITE.size * (write % self.size)
+
+    def count(self) -> int:
+        return self._COUNTER.unpack_from(self._mapped(), 0)[0]
+
+    def record(self, year: int) -> None:
+        shared = self._mapped()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            count = self._COUNTER.unpack_from(shared, 0)[0]
+            self._WRITE.pack_into(shared, self._offset(count), year, time.time(), os.getpid())
+            self._COUNTER.pack_into(shared, 0, count + 1)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def since(self, seen: int) -> tuple[int, Optional[list[tuple[int, float]]]]:
+        """
+        Returns the count of writes, and the (year, time) of the writes of other processes after the first `seen`
+        ones, or None if they are not in the log anymore.
+        """
+        count = self.count()
+        if count == seen:
+            return count, []
+        if count - seen > self.size:
+            return count, None
+
+        shared = self._mapped()
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
+        try:
+            count = self._COUNTER.unpack_from(shared, 0)[0]
+            writes = [self._WRITE.unpack_from(shared, self._offset(write)) for write in range(seen, count)]
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if count - seen > self.size:
+            return count, None
+        pid = os.getpid()
+        return count, [(year, written) for year, written, writer in writes if writer != pid]
+
+
+class QueryCache:
+    """
+    LRU cache with a time to live, for results of queries over a range of years.
+
+    Every key comes with the (first, last) years its result depends on, where None means unbounded.
+    When a measurement is written, the entries overlapping its year are invalidated, and results read
+    concurrently with the write are not stored. With `shared` writes, the same happens with the writes of
+    the other processes, as soon as the cache is used after them.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = CACHE_SIZE,
+        ttl: float = CACHE_TTL,
+        settle_time: float = WRITE_SETTLE_TIME,
+        shared: Optional[SharedWrites] = None
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.settle_time = settle_time
+        self.shared = shared
+        self._seen = None  # writes in `shared` already applied
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (expires, years, value)
+        self._recent_writes = {}  # year -> time until the writes in that year might not be visible
+        self._unsettled_until = 0  # time until writes of any year might not be visible, see _sync
+        self._generation = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def _overlaps(years: tuple[Optional[int], Optional[int]], year: int) -> bool:
+        first, last = years
+        return (first is None or first <= year) and (last is None or year <= last)
+
+    def _sync(self) -> None:
+        """
+        Applies the writes of the other processes, called with the lock held.
+        """
+        if self.shared is None:
+            return
+        if self._seen is None:
+            self._seen = self.shared.count()  # nothing cached yet
+            return
+
+        self._seen, writes = self.shared.since(self._seen)
+        if writes is None:  # too many to know their years
+            self._entries.clear()
+            self._generation += 1
+            self._unsettled_until = time.monotonic() + self.settle_time
+            return
+        now, wall_now = time.monotonic(), time.time()
+        for year, written in writes:
+            self._invalidate(year, now + self.settle_time - (wall_now - written))
+
+    def _invalidate(self, year: int, until: float) -> None:
+        self._generation += 1
+        self._recent_writes[year] = max(until, self._recent_writes.get(year, 0))
+        for key in [key for key, (_, years, _) in self._entries.items() if self._overlaps(years, year)]:
+            del self._entries[key]
+            self.invalidations += 1
+
+    def get(self, key: Hashable) -> tuple[Optional[Any], int]:
+        """
+        Returns the cached value (or None), and the generation to pass to `put` on a miss.
+        """
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2], self._generation
+
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None, self._generation
+
+    def put(self, key: Hashable, years: tuple[Optional[int], Optional[int]], value: Any, generation: int) -> None:
+        """
+        Stores the value, unless a write overlapping its years has happened since `generation` was
+        returned by `get`, or recently enough to not be visible in the value yet.
+        """
+        with self._lock:
+            self._sync()
+            now = time.monotonic()
+            self._recent_writes = {year: until for year, until in self._recent_writes.items() if until > now}
+            if generation != self._generation or now < self._unsettled_until or any(
+                self._overlaps(years, year) for year in self._recent_writes
+            ):
+                return
+
+            self._entries[key] = (now + self.ttl, years, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_year(self, year: int) -> None:
+        with self._lock:
+            self._invalidate(year, time.monotonic() + self.settle_time)
+        if self.shared is not None:
+            self.shared.record(year)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._recent_writes.clear()
+            self._generation += 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs a single call at a time per key: the callers arriving while it runs wait for it, and get its result
+    (or exception) instead of making their own call.
+
+    The calls made by threads (`do`) and by coroutines (`do_async`) are coalesced separately, the latter per
+    event loop.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._calls = {}  # key -> _Call
+        self._tasks = WeakKeyDictionary()  # event loop -> key -> task
+        self._lock = Lock()
+
+    def do(self, key: Hashable, call: Callable[[], Any]) -> Any:
+        with self._lock:
+            running = self._calls.get(key)
+            leader = running is None
+            if leader:
+                running = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            running.done.wait()
+            if running.error is not None:
+                raise running.error
+            return running.result
+
+        try:
+            running.result = call()
+            return running.result
+        except Exception as error:
+            running.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            running.done.set()
+
+    async def do_async(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        tasks = self._tasks.setdefault(asyncio.get_running_loop(), {})
+        task = tasks.get(key)
+        with self._lock:
+            if task is None:
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if task is None:
+            task = tasks[key] = asyncio.ensure_future(call())
+
+            def finished(task):
+                del tasks[key]
+                if not task.cancelled():
+                    task.exception()  # retrieved, even if every caller has been cancelled meanwhile
+            task.add_done_callback(finished)
+
+        # A caller being cancelled (i.e. its client going away) doesn't cancel the call of the others
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'in_flight': len(self._calls) + sum(len(tasks) for tasks in self._tasks.values()),
+                'calls': self.calls,
+                'coalesced': self.coalesced
+            }
+
+
+def years_for_range(_from: Optional[date], _to: Optional[date]) -> tuple[Optional[int], Optional[int]]:
+    return _from.year if _from else None, _to.year if _to else None
+
+
+measurements_cache = QueryCache(shared=SharedWrites(WRITES_FILE) if WRITES_FILE else None)
+if measurements_cache.shared is not None:
+    os.register_at_fork(after_in_child=measurements_cache.shared._reset)
+measurements_flights = SingleFlight()
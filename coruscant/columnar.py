@@ -0,0 +1,339 @@
+"""
+In-memory columnar store of the measurements, to serve the API without Elasticsearch (see coruscant/api_local.py).
+
+Every measurement is a row of NumPy columns: the day as months since 1970-01 (int32) plus the day of the
+month (int8), the temperatures as float32 (NaN when missing), the location as float32, and the city and
+country as codes in a dictionary of names. Rows are sorted by city, country and day, so the top cities
+query is a single vectorized max per city over the rows in the date range.
+
+New measurements go to an append buffer, merged into the sorted columns once it has BUFFER_SIZE rows.
+"""
+import csv
+from datetime import date
+from threading import RLock
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+from coruscant.loader import convert_location
+from coruscant.snapshot import Snapshot
+
+BUFFER_SIZE = 10000
+MONTH_OFFSET = 2 ** 15  # months are stored shifted in the row keys, to keep them positive
+FIELDS = ('month', 'dom', 'average_temperature', 'average_temperature_uncertainty', 'city', 'country', 'lat', 'lon')
+DTYPES = {
+    'month': np.int32,
+    'dom': np.int8,
+    'average_temperature': np.float32,
+    'average_temperature_uncertainty': np.float32,
+    'city': np.int32,
+    'country': np.int32,
+    'lat': np.float32,
+    'lon': np.float32,
+}
+
+
+def to_month(day: date) -> int:
+    return (day.year - 1970) * 12 + day.month - 1
+
+
+def from_month(month: int, dom: int) -> date:
+    return date(1970 + month // 12, month % 12 + 1, dom)
+
+
+def row_keys(city, country, month, dom):
+    """
+    Unique key of the rows, sorting them by city, country and day. Works for scalars and arrays.
+    """
+    return (
+        (np.int64(city) << 40) | (np.int64(country) << 21) | ((np.int64(month) + MONTH_OFFSET) << 5) | np.int64(dom)
+    )
+
+
+def day_keys(month, dom):
+    """
+    Key sorting the days, for the date range filters. Works for scalars and arrays.
+    """
+    return np.int32(month) * 32 + np.int32(dom)
+
+
+def _float(value: float) -> Optional[float]:
+    # Shortest representation of the float32, so 39.156 isn't returned as 39.15599822998047
+    value = np.float32(value)
+    return None if np.isnan(value) else float(str(value))
+
+
+class ColumnarStore:
+    """
+    Measurements stored in NumPy columns, answering the same queries as the Elasticsearch API.
+
+    Like the Elasticsearch documents, a measurement is identified by its city, country and day, and adding
+    it again overwrites it. The store is thread-safe.
+    """
+
+    def __init__(self, cities: list[str], countries: list[str], columns: dict[str, np.ndarray]):
+        self.cities = list(cities)
+        self.countries = list(countries)
+        self._city_codes = {city: code for code, city in enumerate(self.cities)}
+        self._country_codes = {country: code for code, country in enumerate(self.countries)}
+        self._buffer = []  # rows as {field: value}
+        self._buffer_index = {}  # key -> position in the buffer
+        self._lock = RLock()
+        self._set_columns(columns)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[list[str]]) -> 'ColumnarStore':
+        """
+        Builds the store from CSV rows, in the column order of the file.
+        """
+        cities, countries = {}, {}
+        values = {field: [] for field in FIELDS}
+        for day, temperature, uncertainty, city, country, lat, lon in rows:
+            year, month, dom = int(day[:4]), int(day[5:7]), int(day[8:10])
+            location = convert_location(lat, lon)
+            values['month'].append((year - 1970) * 12 + month - 1)
+            values['dom'].append(dom)
+            values['average_temperature'].append(float(temperature) if temperature else np.nan)
+            values['average_temperature_uncertainty'].append(float(uncertainty) if uncertainty else np.nan)
+            values['city'].append(cities.setdefault(city, len(cities)))
+            values['country'].append(countries.setdefault(country, len(countries)))
+            values['lat'].append(location['lat'])
+            values['lon'].append(location['lon'])
+
+        columns = {field: np.array(values[field], dtype=DTYPES[field]) for field in FIELDS}
+        return cls(list(cities), list(countries), columns)
+
+    @classmethod
+    def from_csv(cls, filename: str) -> 'ColumnarStore':
+        with open(filename, 'r') as csv_file:
+            reader = csv.reader(csv_file)
+            next(reader)  # header
+            return cls.from_rows(reader)
+
+    @classmethod
+    def from_snapshot(cls, filename: str) -> 'ColumnarStore':
+        """
+        Builds the store from a snapshot of the CSV file (see coruscant.snapshot), without parsing it.
+        """
+        with Snapshot(filename) as snapshot:
+            columns = {field: snapshot.columns[field].astype(DTYPES[field]) for field in FIELDS}
+            return cls(snapshot.cities, snapshot.countries, columns)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._keys) + len(self._buffer)
+
+    def _set_columns(self, columns: dict[str, np.ndarray]) -> None:
+        keys = row_keys(columns['city'], columns['country'], columns['month'], columns['dom'])
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        # Like in ES, the last write of a measurement wins
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        self._keys = keys[last]
+        self._columns = {field: columns[field][order][last] for field in FIELDS}
+        self._days = day_keys(self._columns['month'], self._columns['dom'])
+
+        # Rows of every city are contiguous: _segments[i] is where the rows of the city _segment_cities[i] start
+        city = self._columns['city']
+        self._segments = np.flatnonzero(np.diff(city, prepend=-1)) if len(city) else np.zeros(0, dtype=np.int64)
+        self._segment_cities = city[self._segments]
+
+    def _merge_buffer(self) -> None:
+        buffered = {field: np.array([row[field] for row in self._buffer], dtype=DTYPES[field]) for field in FIELDS}
+        self._set_columns({field: np.concatenate([self._columns[field], buffered[field]]) for field in FIELDS})
+        self._buffer = []
+        self._buffer_index = {}
+
+    def _code(self, names: list[str], codes: dict[str, int], name: str) -> int:
+        if name not in codes:
+            codes[name] = len(names)
+            names.append(name)
+        return codes[name]
+
+    def _find(self, key: int) -> Optional[int]:
+        position = int(np.searchsorted(self._keys, key))
+        if position < len(self._keys) and self._keys[position] == key:
+            return position
+        return None
+
+    def _row(self, position: Optional[int] = None, buffered: Optional[dict] = None) -> dict[str, Any]:
+        """
+        Returns a row of the columns (or of the buffer) as a measurement, with the fields of the ES documents.
+        """
+        if buffered is None:
+            buffered = {field: self._columns[field][position] for field in FIELDS}
+        measurement = {'day': from_month(int(buffered['month']), int(buffered['dom']))}
+        for field in ('average_temperature', 'average_temperature_uncertainty'):
+            value = _float(buffered[field])
+            if value is not None:
+                measurement[field] = value
+        measurement['city'] = self.cities[int(buffered['city'])]
+        measurement['country'] = self.countries[int(buffered['country'])]
+        measurement['location'] = {'lat': _float(buffered['lat']), 'lon': _float(buffered['lon'])}
+        return measurement
+
+    def add(self, measurement: dict[str, Any]) -> None:
+        """
+        Adds a measurement, as validated by coruscant.api.validate_measurement, or overwrites it.
+        """
+        with self._lock:
+            row = {
+                'month': to_month(measurement['day']),
+                'dom': measurement['day'].day,
+                'average_temperature': measurement.get('average_temperature', np.nan),
+                'average_temperature_uncertainty': measurement.get('average_temperature_uncertainty', np.nan),
+                'city': self._code(self.cities, self._city_codes, measurement['city']),
+                'country': self._code(self.countries, self._country_codes, measurement['country']),
+                'lat': measurement['location']['lat'],
+                'lon': measurement['location']['lon'],
+            }
+            key = int(row_keys(row['city'], row['country'], row['month'], row['dom']))
+
+            position = self._find(key)
+            if position is not None:
+                for field in FIELDS:
+                    self._columns[field][position] = row[field]
+            elif key in self._buffer_index:
+                self._buffer[self._buffer_index[key]] = row
+            else:
+                self._buffer_index[key] = len(self._buffer)
+                self._buffer.append(row)
+                if len(self._buffer) >= BUFFER_SIZE:
+                    self._merge_buffer()
+
+    def _update(self, position: Optional[int], buffered: Optional[dict], fields: dict[str, float]) -> dict[str, Any]:
+        for field, value in fields.items():
+            if buffered is None:
+                self._columns[field][position] = value
+            else:
+                buffered[field] = value
+        return self._row(position, buffered)
+
+    def update(self, city: str, day: date, fields: dict[str, float]) -> Optional[dict[str, Any]]:
+        """
+        Updates the temperatures of the measurement of a city (from any country) in the given day.
+        Returns the updated measurement, or None if there is no such measurement.
+        """
+        with self._lock:
+            code = self._city_codes.get(city)
+            if code is None:
+                return None
+            month = to_month(day)
+
+            segment = int(np.searchsorted(self._segment_cities, code))
+            if segment < len(self._segment_cities) and self._segment_cities[segment] == code:
+                start = self._segments[segment]
+                end = self._segments[segment + 1] if segment + 1 < len(self._segments) else len(self._keys)
+                found = np.flatnonzero(
+                    (self._columns['month'][start:end] == month) & (self._columns['dom'][start:end] == day.day)
+                )
+                if len(found):
+                    return self._update(start + int(found[0]), None, fields)
+
+            for row in self._buffer:
+                if row['city'] == code and row['month'] == month and row['dom'] == day.day:
+                    return self._update(None, row, fields)
+            return None
+
+    def update_exact(self, city: str, country: str, day: date, fields: dict[str, float]) -> Optional[dict[str, Any]]:
+        """
+        Same as `update`, for the measurement of a city in the given country.
+        """
+        with self._lock:
+            if city not in self._city_codes or country not in self._country_codes:
+                return None
+            key = int(row_keys(self._city_codes[city], self._country_codes[country], to_month(day), day.day))
+
+            position = self._find(key)
+            if position is not None:
+                return self._update(position, None, fields)
+            if key in self._buffer_index:
+                return self._update(None, self._buffer[self._buffer_index[key]], fields)
+            return None
+
+    def top_cities(
+        self,
+        number_of_cities: int,
+        _from: Optional[date] = None,
+        _to: Optional[date] = None,
+        order: str = 'desc',
+        country: Optional[str] = None,
+        min_uncertainty: Optional[float] = None,
+        max_uncertainty: Optional[float] = None,
+    ) -> list[dict[str, Any]]:
+        """
+        Returns the hottest measurement of the `number_of_cities` hottest cities in the range, hottest first,
+        or the coldest measurement of the coldest cities with `order='asc'`. Ties are ranked by city name.
+        Cities are grouped by name only, like the collapse of the ES query.
+
+        Only the measurements of the `country`, and with an uncertainty between `min_uncertainty` and
+        `max_uncertainty`, are taken into account when given.
+        """
+        hottest = order == 'desc'
+        with self._lock:
+            if country is not None and country not in self._country_codes:
+                return []
+
+            def matches(month, dom, uncertainty, country_code):
+                # Works for the columns and for the rows of the buffer
+                matching = True
+                if _from:
+                    matching = matching & (day_keys(month, dom) >= day_keys(to_month(_from), _from.day))
+                if _to:
+                    matching = matching & (day_keys(month, dom) <= day_keys(to_month(_to), _to.day))
+                if country is not None:
+                    matching = matching & (country_code == self._country_codes[country])
+                # Like the ES range filter, missing uncertainties (NaN) never match
+                if min_uncertainty is not None:
+                    matching = matching & (uncertainty >= min_uncertainty)
+                if max_uncertainty is not None:
+                    matching = matching & (uncertainty <= max_uncertainty)
+                return matching
+
+            columns = self._columns
+            in_range = np.broadcast_to(
+                matches(columns['month'], columns['dom'], columns['average_temperature_uncertainty'],
+                        columns['country']),
+                len(self._keys)
+            )
+
+            # Hottest (or coldest) temperature per city, ignoring the missing ones (NaN)
+            best = np.full(len(self.cities), np.nan, dtype=np.float32)
+            if len(self._keys):
+                temperatures = np.where(in_range, columns['average_temperature'], np.nan)
+                reduce = np.fmax if hottest else np.fmin
+                best[self._segment_cities] = reduce.reduceat(temperatures, self._segments)
+
+            best_buffered = {}
+            for row in self._buffer:
+                temperature = row['average_temperature']
+                if np.isnan(temperature) or not matches(
+                    row['month'], row['dom'], row['average_temperature_uncertainty'], row['country']
+                ):
+                    continue
+                current = best[row['city']]
+                if np.isnan(current) or (temperature > current if hottest else temperature < current):
+                    best[row['city']] = temperature
+                    best_buffered[row['city']] = row
+
+            candidates = np.flatnonzero(~np.isnan(best))
+            names = np.array(self.cities, dtype=object)[candidates]
+            ranking = np.lexsort((names, -best[candidates] if hottest else best[candidates]))
+            top = candidates[ranking[:number_of_cities]]
+
+            cities = []
+            for city in top:
+                if city in best_buffered:
+                    measurement = self._row(buffered=best_buffered[city])
+                else:
+                    segment = int(np.searchsorted(self._segment_cities, city))
+                    start = self._segments[segment]
+                    end = self._segments[segment + 1] if segment + 1 < len(self._segments) else len(self._keys)
+                    position = start + int(np.flatnonzero(
+                        in_range[start:end] & (columns['average_temperature'][start:end] == best[city])
+                    )[0])
+                    measurement = self._row(position)
+                measurement['day'] = measurement['day'].isoformat()
+                cities.append(measurement)
+            return cities
@@ -1,10 +1,57 @@
-from datetime import date
-from typing import Optional
+import os
+from datetime import date, datetime
+from hashlib import sha1
+from typing import Collection, Optional, Union
 
-from elasticsearch_dsl import Date, Document, Float, GeoPoint, Keyword, Text
+from elasticsearch_dsl import Date, Document, Float, GeoPoint, IndexTemplate, Integer, Keyword, MetaField, Text
+from elasticsearch_dsl.utils import META_FIELDS
+
+from coruscant.es import get_async_es_client
+
+# Primary shards of the yearly and the decade indexes. Every measurement is routed by its city, so a single
+# city lookup or update hits one shard of every index whatever the number of shards, and more shards only
+# spread the larger indexes across the nodes. Only applies to the indexes created afterwards.
+INDEX_SHARDS = int(os.environ.get('INDEX_SHARDS', 1))
+INDEX_DECADE_SHARDS = int(os.environ.get('INDEX_DECADE_SHARDS', INDEX_SHARDS))
+# Mapping profile of the measurement indexes, see OptimizedMeasurement. Like the shards, it only applies to the
+# indexes created afterwards: reindex-profile.py rebuilds the existing ones.
+INDEX_PROFILE = os.environ.get('INDEX_PROFILE', 'standard')
+
+
+class IndexLayout:
+    """
+    Policy deciding the index storing every year: the years since `hot_since` (the ones being written) get
+    an index each, while the historical ones share an index per decade, as per-shard overhead dominates
+    for hundreds of tiny indexes. Indexes are named after their year (`2013`) or decade (`1850s`).
+    """
+
+    def __init__(self, hot_since: int):
+        if hot_since % 10:
+            raise ValueError('hot_since must be the first year of a decade')
+        self.hot_since = hot_since
+
+    def suffix(self, year: int) -> str:
+        if year >= self.hot_since:
+            return str(year)
+        return f'{year - year % 10}s'
+
+    @staticmethod
+    def span(suffix: str) -> Optional[tuple[int, int]]:
+        """
+        First and last years stored in the index with the given suffix, or None if it's not a valid one.
+        """
+        if suffix.isdigit():
+            return int(suffix), int(suffix)
+        if suffix.endswith('0s') and suffix[:-1].isdigit():
+            return int(suffix[:-1]), int(suffix[:-1]) + 9
+        return None
 
 
 class Measurement(Document):
+    """
+    Monthly measurement of a city. Documents are routed by city: every write has to set the routing
+    (see `save`), and ES rejects the ones that don't.
+    """
     day = Date()
     average_temperature = Float()
     average_temperature_uncertainty = Float()
@@ -15,34 +62,231 @@ class Measurement(Document):
     class Index:
         name = 'global_land_temperatures_by_city-*'
         settings = {
-            'number_of_shards': 1
+            'number_of_shards': INDEX_SHARDS,
+            'number_of_replicas': 1,
+            'refresh_interval': '1s',
+            'translog.flush_threshold_size': '512mb'
         }
 
+    class Meta:
+        routing = MetaField(required=True)
+
+    layout = IndexLayout(hot_since=int(os.environ.get('INDEX_HOT_SINCE', 2000)))
+
+    # Dynamic settings overriding the production ones while bulk loading: no refreshes nor
+    # replicas (they are rebuilt from the primaries afterwards), and fewer translog flushes.
+    BULK_LOAD_SETTINGS = {
+        'number_of_replicas': 0,
+        'refresh_interval': '-1',
+        'translog.flush_threshold_size': '2gb'
+    }
+    # Settings of the decade indexes, which are not written once loaded
+    COLD_SETTINGS = {}
+
     def save(self, **kwargs):
         # override the index name using the year
-        kwargs['index'] = self.day.strftime('global_land_temperatures_by_city-%Y')
+        kwargs['index'] = self.index_for_day(self.day)
+        if 'id' not in self.meta:
+            self.meta.id = self.generate_id(self.city, self.country, self.day)
+        self.meta.routing = self.city
         return super().save(**kwargs)
 
+    async def save_async(self, **kwargs):
+        """
+        Same as `save`, with the async client of the running event loop.
+        """
+        self.full_clean()
+        if 'id' not in self.meta:
+            self.meta.id = self.generate_id(self.city, self.country, self.day)
+        self.meta.routing = self.city
+
+        meta = await get_async_es_client().index(
+            index=self.index_for_day(self.day), id=self.meta.id, body=self.to_dict(), routing=self.city, **kwargs
+        )
+        for field in META_FIELDS:
+            if f'_{field}' in meta:
+                setattr(self.meta, field, meta[f'_{field}'])
+        return meta['result']
+
+    @classmethod
+    def index_for_day(cls, day: date) -> str:
+        """
+        Name of the index storing the measurements of the given day.
+        """
+        return cls.index_for_year(day.year)
+
+    @classmethod
+    def index_for_year(cls, year: int) -> str:
+        """
+        Name of the index storing the measurements of the given year, according to the layout.
+        """
+        return f'{cls.Index.name[:-1]}{cls.layout.suffix(year)}'
+
+    @staticmethod
+    def as_template(bulk_load: bool = False, profile: Optional[str] = None) -> IndexTemplate:
+        """
+        Index template for the yearly indexes, with the mapping of the given profile (INDEX_PROFILE by default)
+        and either the production or the bulk load settings.
+        """
+        template = PROFILES[profile or INDEX_PROFILE]._index.as_template('global_land_temperatures_by_city', order=0)
+        if bulk_load:
+            template.settings(**Measurement.BULK_LOAD_SETTINGS)
+        return template
+
+    @classmethod
+    def decade_template(cls, profile: Optional[str] = None) -> IndexTemplate:
+        """
+        Index template overriding the settings of the decade indexes (the only ones ending in `s`): their number
+        of shards, and the codec of the cold indexes of the profile.
+        """
+        template = IndexTemplate('global_land_temperatures_by_city_decades', f'{cls.Index.name}s', order=1)
+        template.settings(number_of_shards=INDEX_DECADE_SHARDS, **PROFILES[profile or INDEX_PROFILE].COLD_SETTINGS)
+        return template
+
+    @classmethod
+    def dynamic_settings(cls, bulk_load: bool = False) -> dict:
+        """
+        Settings to switch existing yearly indexes between the production and the bulk load profiles.
+        """
+        if bulk_load:
+            return dict(cls.BULK_LOAD_SETTINGS)
+        return {setting: cls.Index.settings[setting] for setting in cls.BULK_LOAD_SETTINGS}
+
+    @staticmethod
+    def generate_id(city: str, country: str, day: Union[date, str]) -> str:
+        """
+        Deterministic document id for the measurement of a city in a given day.
+
+        The country is part of it to prevent clashes between cities with the same name (London, UK or
+        London, Canada). Writing the same measurement twice overwrites the document instead of duplicating it.
+        """
+        if isinstance(day, datetime):
+            day = day.date()
+        if isinstance(day, date):
+            day = day.isoformat()
+        return sha1(f'{city}|{country}|{day}'.encode('utf-8')).hexdigest()
+
     @classmethod
-    def get_indexes_for_range(cls, _from: Optional[date] = None, _to: Optional[date] = None) -> str:
+    def get_indexes_for_range(
+        cls, _from: Optional[date] = None, _to: Optional[date] = None, indexes: Optional[Collection[str]] = None
+    ) -> str:
         """
         Method to generate the list of indexes between a given time range.
 
-        This could be a bit more clever to use wildcards like global_land_temperatures_by_city-2*,
-        but for now, it will do.
+        `indexes` are the indexes in the cluster (see coruscant.indexes). If given, only those are targeted,
+        whatever the layout they were created with. Otherwise, the indexes of the current layout for every
+        year from 1500 to the current one might exist. Indexes are collapsed into wildcards (i.e.
+        global_land_temperatures_by_city-18*) whenever every index the wildcard may match is in the range,
+        so the list stays short for wide ranges.
         """
         if not (_from or _to):  # if both are missing, we return the wildcard
             return cls.Index.name
 
-        if not _from:
-            _from = date(1500, 1, 1)  # for example, but we can be more clever than this
-        if not _to:
-            _to = date.today()
+        prefix = cls.Index.name[:-1]
+        if indexes is not None:
+            spans = {
+                index[len(prefix):]: cls.layout.span(index[len(prefix):])
+                for index in indexes if index.startswith(prefix)
+            }
+            spans = {suffix: span for suffix, span in spans.items() if span}
+            first = _from.year if _from else min((span[0] for span in spans.values()), default=0)
+            last = _to.year if _to else max((span[1] for span in spans.values()), default=0)
+        else:
+            first = _from.year if _from else 1500
+            last = _to.year if _to else date.today().year
+            suffixes = {cls.layout.suffix(year) for year in range(min(first, 1500), max(last, date.today().year) + 1)}
+            spans = {suffix: cls.layout.span(suffix) for suffix in suffixes}
+
+        def cover(start: str, spans: dict[str, tuple[int, int]]) -> list[str]:
+            selected = [suffix for suffix, (low, high) in spans.items() if low <= last and high >= first]
+            if len(selected) == 1:
+                return [f'{prefix}{selected[0]}']
+            if selected and len(selected) == len(spans):
+                return [f'{prefix}{start}*']
+
+            found = [f'{prefix}{start}'] if start in selected else []
+            for char in sorted({suffix[len(start)] for suffix in selected if len(suffix) > len(start)}):
+                found += cover(start + char, {
+                    suffix: span for suffix, span in spans.items() if suffix.startswith(start + char)
+                })
+            return found
+
+        found = cover('', spans)
+        if not found:
+            # No index in the range: target one that can't exist, as no layout has that suffix (the index of
+            # `first` may exist, e.g. if it's the first index in the cluster and the range ends before it)
+            return f'{prefix}none'
+        return ','.join(found)
+
+
+class OptimizedMeasurement(Measurement):
+    """
+    Mapping of the `optimized` profile, trading flexibility for storage and top cities query speed:
+
+    - the country is a keyword, matched as a whole (`match_phrase` queries keep working, but no longer
+      match part of the name),
+    - the temperature is only sorted and aggregated, so it's kept in doc values without an inverted index.
+      ES 7 can't search fields with doc values only, so the ranged uncertainty and day stay indexed,
+    - the segments are sorted like the hottest cities query (temperature desc, then city), so the hottest
+      measurements are read first,
+    - the decade indexes are compressed with DEFLATE instead of LZ4, as they are rarely read in full.
+
+    Index sorting and the codec can't be changed on an existing index, so switching profiles needs a reindex.
+    """
+    average_temperature = Float(index=False)
+    country = Keyword()
+
+    class Index:
+        name = Measurement.Index.name
+        settings = {
+            **Measurement.Index.settings,
+            'sort.field': ['average_temperature', 'city'],
+            'sort.order': ['desc', 'asc'],
+            'sort.missing': ['_last', '_last']
+        }
+
+    COLD_SETTINGS = {'codec': 'best_compression'}
+
+
+PROFILES = {'standard': Measurement, 'optimized': OptimizedMeasurement}
+if INDEX_PROFILE not in PROFILES:
+    raise ValueError(f'INDEX_PROFILE must be one of {", ".join(PROFILES)}')
 
-        current = _from
-        indexes = []
-        while current <= _to:
-            indexes.append(current.year)
-            current = current.replace(year=current.year + 1)
 
-        return ','.join(map(lambda x: f'global_land_temperatures_by_city-{x}', indexes))
+class MeasurementRollup(Document):
+    """
+    Hottest measurement of a city in a given period: either a year (`period='year'`, with `year` set),
+    or a month of the year across every year (`period='month'`, with `month` set).
+
+    Like the collapse in the top cities query, the rollups are grouped by city name only. The index is only
+    searched once it has every rollup, i.e. once coruscant.rollups.backfill has added the READY_ALIAS to it.
+    """
+    READY_ALIAS = 'global_land_temperatures_by_city_rollup_ready'
+
+    period = Keyword()
+    year = Integer()
+    month = Integer()
+    day = Date()
+    average_temperature = Float()
+    average_temperature_uncertainty = Float()
+    city = Keyword()
+    country = Text()
+    location = GeoPoint()
+
+    class Index:
+        name = 'global_land_temperatures_by_city_rollup'
+        settings = {
+            'number_of_shards': 1
+        }
+
+    @classmethod
+    def as_template(cls) -> IndexTemplate:
+        """
+        Index template of the rollups index, so it has its mapping even when created by a write, before any
+        backfill (an update upserting the rollup of a new measurement).
+        """
+        return cls._index.as_template('global_land_temperatures_by_city_rollup', cls.Index.name)
+
+    @staticmethod
+    def generate_id(city: str, period: str, value: int) -> str:
+        return sha1(f'{city}|{period}|{value}'.encode('utf-8')).hexdigest()
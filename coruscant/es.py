@@ -1,12 +1,187 @@
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import connections
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import Lock
+from typing import TYPE_CHECKING, Iterator, Optional, Union
+from weakref import WeakKeyDictionary
 
-ES_HOST = 'es01:9200'
+from elasticsearch import Elasticsearch, Transport
+from elasticsearch_dsl import Search, connections
+from elasticsearch_dsl.response import Response
 
+from coruscant.metrics import observe_es_request
 
-# Connection needed for elasticsearch-dsl
-connections.create_connection(hosts=[ES_HOST], timeout=20)
+if TYPE_CHECKING:
+    from elasticsearch import AsyncElasticsearch
+
+ES_HOST = os.environ.get('ES_HOST', 'es01:9200')
+
+
+def _bounded_params(transport: Transport, params: Optional[dict]) -> Optional[dict]:
+    """
+    Params of a request, with its `request_timeout` capped by the bounds of the transport (see `bounded_requests`).
+    """
+    bounds = getattr(transport, 'bounds', None)
+    if bounds is None:
+        return params
+    deadline, max_timeout = bounds
+    timeout = min(max_timeout, max(deadline - time.monotonic(), 0.001))
+    params = dict(params or {})
+    if params.get('request_timeout') is not None:
+        timeout = min(timeout, float(params['request_timeout']))
+    params['request_timeout'] = timeout
+    return params
+
+
+class InstrumentedTransport(Transport):
+    """
+    Transport recording the round trip time of every request, and the time ES spent in it (see coruscant.metrics).
+    """
+
+    bounds = None  # (deadline, max timeout) of the requests, see `bounded_requests`
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        params = _bounded_params(self, params)
+        start, response = time.perf_counter(), None
+        try:
+            response = super().perform_request(method, url, headers=headers, params=params, body=body)
+            return response
+        finally:
+            observe_es_request(method, url, body, time.perf_counter() - start, response)
+
+
+# Settings of the client shared by the whole process. The connections of the pool are persistent
+# (HTTP keep-alive), so the pool size bounds how many requests can be in flight at the same time.
+CLIENT_SETTINGS = {
+    'hosts': [ES_HOST],
+    'timeout': int(os.environ.get('ES_TIMEOUT', 30)),
+    'maxsize': int(os.environ.get('ES_POOL_SIZE', 25)),
+    'retry_on_timeout': True,
+    'sniff_on_start': os.environ.get('ES_SNIFF', '') == '1',
+    'sniff_on_connection_fail': os.environ.get('ES_SNIFF', '') == '1',
+    'sniffer_timeout': 60,
+    'transport_class': InstrumentedTransport,
+}
+
+# The async client multiplexes every request of the process in a single thread, so its pool is
+# much larger: it bounds the ES requests in flight across all the concurrent API requests
+ASYNC_CLIENT_SETTINGS = {
+    **{setting: value for setting, value in CLIENT_SETTINGS.items() if setting != 'transport_class'},
+    'maxsize': int(os.environ.get('ES_ASYNC_POOL_SIZE', 256)),
+}
+
+# Timeouts (in seconds) per kind of request, to pass as `request_timeout`
+TIMEOUTS = {
+    'search': float(os.environ.get('ES_SEARCH_TIMEOUT', 10)),
+    'write': float(os.environ.get('ES_WRITE_TIMEOUT', 10)),
+    'bulk': float(os.environ.get('ES_BULK_TIMEOUT', 60)),
+}
+
+# Connection needed for elasticsearch-dsl. It's only created when first used, and it's the same
+# client returned by get_es_client
+connections.configure(default=CLIENT_SETTINGS)
+
+_lock = Lock()
+_async_clients = WeakKeyDictionary()  # event loop -> AsyncElasticsearch
 
 
 def get_es_client() -> Elasticsearch:
-    return Elasticsearch(ES_HOST, timeout=30)
+    """
+    Returns the client shared by every request of the process, creating it on its first use.
+
+    The client is thread-safe. It is discarded when the process forks (i.e. the workers of a
+    pre-forking server), so every worker opens its own connections instead of sharing the sockets.
+    """
+    with _lock:
+        return connections.get_connection()
+
+
+def get_async_es_client() -> 'AsyncElasticsearch':
+    """
+    Returns the async client shared by every request handled by the running event loop, creating
+    it on its first use.
+
+    Its connections are bound to the loop, so there is one client per loop (in practice, one per process).
+    It needs aiohttp, which is only imported here so the sync API doesn't depend on it.
+    """
+    from elasticsearch import AsyncElasticsearch
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncElasticsearch(
+            **ASYNC_CLIENT_SETTINGS, transport_class=_async_transport_class()
+        )
+    return client
+
+
+@lru_cache(maxsize=None)
+def _async_transport_class() -> type:
+    """
+    Async equivalent of InstrumentedTransport, only defined when used, like the async client.
+    """
+    from elasticsearch import AsyncTransport
+
+    class InstrumentedAsyncTransport(AsyncTransport):
+        bounds = None
+
+        async def perform_request(self, method, url, headers=None, params=None, body=None):
+            params = _bounded_params(self, params)
+            start, response = time.perf_counter(), None
+            try:
+                response = await super().perform_request(method, url, headers=headers, params=params, body=body)
+                return response
+            finally:
+                observe_es_request(method, url, body, time.perf_counter() - start, response)
+
+    return InstrumentedAsyncTransport
+
+
+@contextmanager
+def bounded_requests(
+    client: Union[Elasticsearch, 'AsyncElasticsearch'], deadline: float, max_timeout: float
+) -> Iterator[None]:
+    """
+    While in the context, the requests of the client time out after `max_timeout` seconds, or at the `deadline`
+    (a time.monotonic() time) if sooner, and they are not retried. For the warmup of the process, which runs
+    before it serves any request.
+    """
+    transport = client.transport
+    retries = transport.max_retries, transport.retry_on_timeout
+    transport.max_retries, transport.retry_on_timeout = 0, False
+    transport.bounds = (deadline, max_timeout)
+    try:
+        yield
+    finally:
+        transport.max_retries, transport.retry_on_timeout = retries
+        transport.bounds = None
+
+
+async def close_async_es_client() -> None:
+    """
+    Closes the async client of the running event loop, if any. To be called when the server stops.
+    """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+async def execute_async(search: Search) -> Response:
+    """
+    Same as `search.execute()`, with the async client.
+    """
+    raw = await get_async_es_client().search(index=search._index, body=search.to_dict(), **search._params)
+    return search._response_class(search, raw)
+
+
+def _reset_after_fork() -> None:
+    global _lock
+    _lock = Lock()
+    _async_clients.clear()
+    connections.remove_connection('default')
+    connections.configure(default=CLIENT_SETTINGS)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
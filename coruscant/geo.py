@@ -0,0 +1,143 @@
+"""
+Geo-spatial aggregations over the `location` (a geo_point) of the measurements, for map dashboards.
+
+The area is either a circle (`lat`, `lon` and `distance` in km) or a bounding box (`top`, `left`,
+`bottom` and `right`). The searches only target the yearly indexes in the date range, and return the
+average and max temperature of buckets (the cities in the area, or the geohash cells of a grid), never
+the measurements themselves, so a heatmap costs a single search of size 0.
+"""
+from datetime import date
+from typing import Any, Optional
+
+from coruscant.documents import Measurement
+from coruscant.indexes import index_catalog
+
+DEFAULT_PRECISION = 3  # geohash cells of ~156x156 km
+MAX_PRECISION = 12
+MAX_CELLS = 10000
+MAX_CITIES = 10000
+CIRCLE_PARAMS = ('lat', 'lon', 'distance')
+BOX_PARAMS = ('top', 'left', 'bottom', 'right')
+
+
+def parse_area(args: dict) -> tuple[list[str], Optional[dict[str, float]]]:
+    """
+    Parses the circle or bounding box URL params.
+    Returns the list of errors found, and the area (None if there are no area params).
+    """
+    circle = any(args.get(param) for param in CIRCLE_PARAMS)
+    box = any(args.get(param) for param in BOX_PARAMS)
+    if circle and box:
+        return ['Please, provide either lat, lon and distance, or top, left, bottom and right'], None
+    if not (circle or box):
+        return [], None
+
+    errors, area = [], {}
+    for param in CIRCLE_PARAMS if circle else BOX_PARAMS:
+        try:
+            area[param] = float(args[param])
+        except KeyError:
+            errors.append(f'Missing param {param}')
+        except ValueError:
+            errors.append(f'Invalid {param}: {args[param]}')
+    if errors:
+        return errors, None
+
+    latitudes = ('lat',) if circle else ('top', 'bottom')
+    longitudes = ('lon',) if circle else ('left', 'right')
+    errors += [f'{param} must be between -90 and 90' for param in latitudes if not -90 <= area[param] <= 90]
+    errors += [f'{param} must be between -180 and 180' for param in longitudes if not -180 <= area[param] <= 180]
+    if circle and area['distance'] <= 0:
+        errors.append('distance must be positive')
+    if box and area['top'] < area['bottom']:
+        errors.append('top has to be north of bottom')
+    if errors:
+        return errors, None
+
+    return [], area
+
+
+def area_filter(area: dict[str, float]) -> dict[str, Any]:
+    if 'distance' in area:
+        return {'geo_distance': {
+            'distance': f'{area["distance"]}km',
+            'location': {'lat': area['lat'], 'lon': area['lon']}
+        }}
+    # A box with left > right crosses the antimeridian, which ES supports
+    return {'geo_bounding_box': {'location': {
+        'top_left': {'lat': area['top'], 'lon': area['left']},
+        'bottom_right': {'lat': area['bottom'], 'lon': area['right']}
+    }}}
+
+
+def _search(
+    area: Optional[dict[str, float]], _from: Optional[date], _to: Optional[date], aggs: dict[str, Any]
+) -> tuple[str, dict[str, Any]]:
+    filters = [{'exists': {'field': 'average_temperature'}}]
+    if area:
+        filters.append(area_filter(area))
+    if _from or _to:
+        date_range = {}
+        if _from:
+            date_range['gte'] = _from.isoformat()
+        if _to:
+            date_range['lte'] = _to.isoformat()
+        filters.append({'range': {'day': date_range}})
+
+    body = {
+        'size': 0,
+        'query': {'bool': {'filter': filters}},
+        'aggs': aggs
+    }
+    return Measurement.get_indexes_for_range(_from, _to, index_catalog.indexes()), body
+
+
+def _temperature_aggs() -> dict[str, Any]:
+    return {
+        'average_temperature': {'avg': {'field': 'average_temperature'}},
+        'max_temperature': {'max': {'field': 'average_temperature'}},
+        'location': {'geo_centroid': {'field': 'location'}},
+    }
+
+
+def cities_query(
+    area: dict[str, float], number_of_cities: int, _from: Optional[date] = None, _to: Optional[date] = None
+) -> tuple[str, dict[str, Any]]:
+    """
+    Returns the indexes and body of the search for the hottest `number_of_cities` cities in the area,
+    by their max temperature in the range.
+    """
+    return _search(area, _from, _to, {'cities': {
+        'terms': {'field': 'city', 'size': number_of_cities, 'order': [{'max_temperature': 'desc'}, {'_key': 'asc'}]},
+        'aggs': _temperature_aggs()
+    }})
+
+
+def grid_query(
+    area: Optional[dict[str, float]], precision: int, _from: Optional[date] = None, _to: Optional[date] = None
+) -> tuple[str, dict[str, Any]]:
+    """
+    Returns the indexes and body of the search for the temperatures in the geohash cells of `precision`
+    (1 to 12 characters) in the area, or in the whole world.
+    """
+    return _search(area, _from, _to, {'grid': {
+        'geohash_grid': {'field': 'location', 'precision': precision, 'size': MAX_CELLS},
+        'aggs': _temperature_aggs()
+    }})
+
+
+def _bucket(bucket: dict[str, Any]) -> dict[str, Any]:
+    return {
+        'average_temperature': bucket['average_temperature']['value'],
+        'max_temperature': bucket['max_temperature']['value'],
+        'measurements': bucket['doc_count'],
+        'location': bucket['location'].get('location'),
+    }
+
+
+def cities_buckets(response: dict[str, Any]) -> list[dict[str, Any]]:
+    return [{'city': bucket['key'], **_bucket(bucket)} for bucket in response['aggregations']['cities']['buckets']]
+
+
+def grid_buckets(response: dict[str, Any]) -> list[dict[str, Any]]:
+    return [{'geohash': bucket['key'], **_bucket(bucket)} for bucket in response['aggregations']['grid']['buckets']]
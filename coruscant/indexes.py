@@ -0,0 +1,94 @@
+"""
+In-process catalog of the measurement indexes that exist in the cluster, so the searches only target those,
+and of whether the rollups can be searched.
+"""
+import time
+from threading import Lock
+from typing import Iterable, Optional
+
+from elasticsearch import Elasticsearch
+
+from coruscant.documents import Measurement, MeasurementRollup
+
+CATALOG_TTL = 300  # seconds
+# Indexes to read the catalog from, with `indices.get_alias`
+CATALOG_PATTERN = f'{Measurement.Index.name},{MeasurementRollup.Index.name}*'
+
+
+class IndexCatalog:
+    """
+    Names of the measurement indexes (see Measurement.layout), read from the cluster and kept for `ttl` seconds.
+
+    Writes through the API add the index of the measurement right away, as they may create it.
+    Indexes created by other processes are picked up when the catalog expires: until then, the wildcards
+    returned by Measurement.get_indexes_for_range might match them, which is why the searches still filter
+    on the day.
+    """
+
+    def __init__(self, ttl: float = CATALOG_TTL):
+        self.ttl = ttl
+        self._indexes = None
+        self._rollups_ready = False
+        self._expires = 0
+        self._lock = Lock()
+
+    def indexes(self) -> Optional[frozenset[str]]:
+        """
+        Returns the names of the indexes, or None if they are unknown or expired.
+        """
+        with self._lock:
+            if self._indexes is not None and self._expires > time.monotonic():
+                return self._indexes
+            return None
+
+    def rollups_ready(self) -> Optional[bool]:
+        """
+        Whether the rollups index has been backfilled, None if unknown or expired.
+        """
+        with self._lock:
+            if self._indexes is not None and self._expires > time.monotonic():
+                return self._rollups_ready
+            return None
+
+    def update(self, indexes: Iterable[str], rollups_ready: bool = False) -> frozenset[str]:
+        """
+        Replaces the indexes with the given ones, ignoring those that are not measurement indexes.
+        """
+        prefix = Measurement.Index.name[:-1]
+        indexes = frozenset(
+            index for index in indexes
+            if index.startswith(prefix) and Measurement.layout.span(index[len(prefix):])
+        )
+        with self._lock:
+            self._indexes = indexes
+            self._rollups_ready = rollups_ready
+            self._expires = time.monotonic() + self.ttl
+        return indexes
+
+    def load(self, aliases: dict[str, dict]) -> frozenset[str]:
+        """
+        Replaces the indexes with the ones in the response of `indices.get_alias(index=CATALOG_PATTERN)`.
+        """
+        rollups = aliases.get(MeasurementRollup.Index.name) or {}
+        return self.update(aliases, MeasurementRollup.READY_ALIAS in rollups.get('aliases', {}))
+
+    def refresh(self, client: Elasticsearch) -> frozenset[str]:
+        """
+        Reads the measurement indexes, and the aliases of the rollups index, from the cluster.
+        """
+        return self.load(client.indices.get_alias(index=CATALOG_PATTERN))
+
+    def add_year(self, year: int) -> None:
+        """
+        Adds the index of the given year, if the catalog has been read.
+        """
+        with self._lock:
+            if self._indexes is not None:
+                self._indexes = self._indexes | {Measurement.index_for_year(year)}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes = None
+
+
+index_catalog = IndexCatalog()
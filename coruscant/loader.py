@@ -0,0 +1,512 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from csv import DictReader, reader as csv_reader
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+from threading import BoundedSemaphore, Lock
+from typing import Any, BinaryIO, Iterable, Iterator, Optional, TextIO
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import BulkIndexError, bulk
+
+from coruscant import snapshot
+from coruscant.documents import Measurement, MeasurementRollup
+
+PATH_TO_FILE = 'data/GlobalLandTemperaturesByCity.csv'
+CHUNK_SIZE = 10000
+SHARD_SIZE = 4 * 1024 * 1024  # ~65k rows per shard with the current CSV
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_SENDERS = 4
+DEFAULT_MAX_IN_FLIGHT = 8
+MAX_RETRIES = 5
+INITIAL_BACKOFF = 2  # seconds, doubled on every retry
+MAX_BACKOFF = 60
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+FORCE_MERGE_TIMEOUT = 6 * 60 * 60
+
+
+def generate_es_document(obj: dict[str: Any]) -> Measurement:
+    """
+    Converts the obj containing the CSV data into the dictionary that will
+    conform the ES document
+    """
+
+    def convert_latitude_longitude(lat: str, lon: str) -> dict[str: Decimal]:
+        """
+        Helper method to convert latitude and longitude data into a single dictionary.
+        This will help ES understand it's a geopoint data field.
+        """
+        location = {}
+        if lat.endswith('N'):
+            location['lat'] = Decimal(lat.replace('N', ''))
+        else:
+            location['lat'] = Decimal(f'-{lat.replace("S", "")}')
+        if lon.endswith('E'):
+            location['lon'] = Decimal(lon.replace('E', ''))
+        else:
+            location['lon'] = Decimal(f'-{lon.replace("W", "")}')
+
+        return location
+
+    def clean_temperature(temp: str) -> Optional[Decimal]:
+        """
+        To prevent python issues with float accuracy, I'm using decimal here
+        """
+        if temp == '':
+            return None
+        else:
+            return Decimal(temp)
+
+    measurement = Measurement(
+        day=datetime.strptime(obj['dt'], '%Y-%m-%d').date(),
+        average_temperature=clean_temperature(obj['AverageTemperature']),
+        average_temperature_uncertainty=clean_temperature(obj['AverageTemperatureUncertainty']),
+        city=obj['City'],
+        country=obj['Country'],
+        location=convert_latitude_longitude(obj['Latitude'], obj['Longitude'])
+    )
+    measurement.meta.index = Measurement.index_for_day(measurement.day)
+    measurement.meta.id = Measurement.generate_id(measurement.city, measurement.country, measurement.day)
+    measurement.meta.routing = measurement.city
+
+    return measurement
+
+
+def docs_from_csv(filename: str, chunk_size: int = CHUNK_SIZE) -> Iterable[list[dict[str:Any]]]:
+    """
+    Generate our ES document based on the content of the given CSV file.
+
+    As the file is very large (over 8M rows), I'm using iterators to chunk the processing. This way, we
+    can create 10k documents in a single ES request, rather than one request per document.
+    """
+    with open(filename, 'r') as csv_file:
+        reader = DictReader(csv_file)
+        current_chunk = []
+        for row in reader:
+            doc = generate_es_document(row)
+            current_chunk.append(doc.to_dict(True))
+            if len(current_chunk) >= chunk_size:
+                yield current_chunk
+                current_chunk = []
+        if current_chunk:
+            yield current_chunk
+
+
+@lru_cache(maxsize=None)
+def convert_location(lat: str, lon: str) -> dict[str: float]:
+    """
+    Same as the `convert_latitude_longitude` helper from `generate_es_document`, but returning floats
+    and cached: there are only ~3.5k distinct coordinates in the dataset, so each one is parsed once.
+    The returned dictionary is shared between documents, so it must not be modified.
+    """
+    return {
+        'lat': float(lat[:-1]) if lat[-1] == 'N' else -float(lat[:-1]),
+        'lon': float(lon[:-1]) if lon[-1] == 'E' else -float(lon[:-1]),
+    }
+
+
+@lru_cache(maxsize=None)
+def index_for_year(year: str) -> str:
+    """
+    Cached `Measurement.index_for_year`, for the year as it comes in the CSV.
+    """
+    return Measurement.index_for_year(int(year))
+
+
+def fast_action(row: list[str]) -> dict[str, Any]:
+    """
+    Converts a CSV row (as a list, in the column order of the file) straight into a bulk action.
+
+    This skips the `Measurement` construction, `strptime` and the `Decimal` round-trip that
+    `generate_es_document` does, while producing exactly the same JSON once serialized: the day is
+    already an ISO date in the CSV, and `Decimal`s are serialized as floats anyway.
+    """
+    day, temperature, uncertainty, city, country, lat, lon = row
+    source = {'day': day}
+    if temperature:
+        source['average_temperature'] = float(temperature)
+    if uncertainty:
+        source['average_temperature_uncertainty'] = float(uncertainty)
+    source['city'] = city
+    source['country'] = country
+    source['location'] = convert_location(lat, lon)
+
+    return {
+        '_routing': city,
+        '_id': Measurement.generate_id(city, country, day),
+        '_index': index_for_year(day[:4]),
+        '_source': source
+    }
+
+
+def actions_from_csv(filename: str, chunk_size: int = CHUNK_SIZE) -> Iterable[list[dict[str:Any]]]:
+    """
+    Same as `docs_from_csv`, but using the `fast_action` converter.
+    """
+    with open(filename, 'r') as csv_file:
+        reader = csv_reader(csv_file)
+        next(reader)  # header
+        current_chunk = []
+        for row in reader:
+            current_chunk.append(fast_action(row))
+            if len(current_chunk) >= chunk_size:
+                yield current_chunk
+                current_chunk = []
+        if current_chunk:
+            yield current_chunk
+
+
+def header_size(filename: str) -> int:
+    """
+    Returns the byte offset where the first data row of the CSV file starts.
+    """
+    with open(filename, 'rb') as csv_file:
+        return len(csv_file.readline())
+
+
+def csv_byte_ranges(
+    filename: str, shard_size: int = SHARD_SIZE, start: Optional[int] = None
+) -> Iterable[tuple[int, int]]:
+    """
+    Splits the data rows of the CSV file into (start, end) byte ranges of roughly `shard_size` bytes.
+
+    Every boundary is moved forward to the next line start, so each row belongs to exactly one range
+    and the ranges can be parsed independently. This relies on the dataset not having quoted newlines.
+    `start` has to be a line start, like the ones stored by `Checkpoint`. By default, it's the first data row.
+    """
+    if start is None:
+        start = header_size(filename)
+    file_size = os.path.getsize(filename)
+
+    with open(filename, 'rb') as csv_file:
+        while start < file_size:
+            end = min(start + shard_size, file_size)
+            if end < file_size:
+                csv_file.seek(end)
+                csv_file.readline()
+                end = csv_file.tell()
+            yield start, end
+            start = end
+
+
+def read_byte_range(csv_file: BinaryIO, start: int, end: int) -> Iterable[list[str]]:
+    """
+    Parses the CSV rows found between the `start` and `end` byte offsets of an open binary file.
+    """
+    csv_file.seek(start)
+    return csv_reader(csv_file.read(end - start).decode('utf-8').splitlines())
+
+
+def convert_byte_range(filename: str, start: int, end: int) -> list[dict[str, Any]]:
+    """
+    Converts a byte range of the CSV file into bulk actions. Meant to run inside a worker process.
+    """
+    with open(filename, 'rb') as csv_file:
+        return [fast_action(row) for row in read_byte_range(csv_file, start, end)]
+
+
+def data_ranges(
+    filename: str, shard_size: int = SHARD_SIZE, start: Optional[int] = None
+) -> Iterable[tuple[int, int]]:
+    """
+    Splits the data file into ranges that can be converted independently: byte ranges of a CSV file (see
+    `csv_byte_ranges`), or row ranges of a snapshot (see coruscant.snapshot).
+    """
+    if snapshot.is_snapshot(filename):
+        return snapshot.row_ranges(filename, start=start)
+    return csv_byte_ranges(filename, shard_size, start)
+
+
+def convert_range(filename: str, start: int, end: int) -> list[dict[str, Any]]:
+    """
+    Converts a range returned by `data_ranges` into bulk actions. Meant to run inside a worker process.
+    """
+    if snapshot.is_snapshot(filename):
+        return snapshot.convert_row_range(filename, start, end)
+    return convert_byte_range(filename, start, end)
+
+
+def first_offset(filename: str) -> int:
+    """
+    Start of the first range of the data file: the first data row of a CSV file, or 0 for a snapshot.
+    """
+    return 0 if snapshot.is_snapshot(filename) else header_size(filename)
+
+
+class Progress:
+    """
+    Thread-safe counter of indexed rows, printing the throughput every `every` seconds.
+    """
+
+    def __init__(self, every: float = 5.0, out: TextIO = sys.stdout):
+        self.every = every
+        self.out = out
+        self.rows = 0
+        self.rejected = 0
+        self.started = time.monotonic()
+        self._last_report = self.started
+        self._lock = Lock()
+
+    @property
+    def rows_per_second(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.rows / elapsed if elapsed else 0.0
+
+    def add(self, rows: int) -> None:
+        with self._lock:
+            self.rows += rows
+            now = time.monotonic()
+            if now - self._last_report >= self.every:
+                self._last_report = now
+                self.report()
+
+    def reject(self, error: dict[str, Any]) -> None:
+        with self._lock:
+            self.rejected += 1
+        print(f'Rejected document: {error}', file=sys.stderr)
+
+    def report(self) -> None:
+        print(
+            f'Inserted {self.rows} documents ({self.rows_per_second:.0f} rows/sec, {self.rejected} rejected)',
+            file=self.out
+        )
+
+
+class Checkpoint:
+    """
+    Keeps the CSV byte offset (or the snapshot row) up to which every row has been acknowledged by ES,
+    in a JSON file.
+
+    Byte ranges can be acknowledged out of order when loading in parallel: the offset only moves forward
+    once every range before it has been acknowledged too, so resuming from it never skips rows.
+    """
+
+    def __init__(self, path: str, filename: str):
+        self.path = path
+        self.filename = filename
+        self.offset = None
+        self._acknowledged = {}  # start -> end of the ranges acknowledged past the offset
+        self._lock = Lock()
+
+    def begin(self, resume: bool = False) -> int:
+        """
+        Returns the offset the load has to start from: the stored one when resuming, or
+        the first data row otherwise.
+        """
+        self.offset = first_offset(self.filename)
+        if resume:
+            try:
+                with open(self.path) as checkpoint_file:
+                    data = json.load(checkpoint_file)
+            except FileNotFoundError:
+                return self.offset
+
+            if data['file'] != os.path.abspath(self.filename):
+                raise ValueError(f"Checkpoint {self.path} belongs to {data['file']}")
+            self.offset = data['offset']
+
+        return self.offset
+
+    def acknowledge(self, start: int, end: int) -> None:
+        with self._lock:
+            self._acknowledged[start] = end
+            if self.offset not in self._acknowledged:
+                return
+            while self.offset in self._acknowledged:
+                self.offset = self._acknowledged.pop(self.offset)
+            self._save()
+
+    def _save(self) -> None:
+        # Written to a temporary file first, so a crash never leaves a half written checkpoint
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump({'file': os.path.abspath(self.filename), 'offset': self.offset}, checkpoint_file)
+        os.replace(tmp_path, self.path)
+
+
+def send_with_retries(
+    client: Elasticsearch,
+    actions: list[dict[str, Any]],
+    chunk_size: int = CHUNK_SIZE,
+    max_retries: int = MAX_RETRIES,
+    initial_backoff: float = INITIAL_BACKOFF,
+    progress: Optional[Progress] = None,
+) -> None:
+    """
+    Sends the actions with bulk requests, retrying the failed ones with exponential backoff.
+
+    Documents rejected with a retryable status (e.g. 429 when the ES queues are full), or every pending
+    one if the whole request failed, go back to the retry queue. As the document ids are deterministic,
+    sending the same document twice just overwrites it. Documents rejected for any other reason (i.e.
+    mapping errors) won't succeed by retrying them, so they are reported and skipped.
+    """
+    pending = actions
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(min(initial_backoff * 2 ** (attempt - 1), MAX_BACKOFF))
+
+        try:
+            _, errors = bulk(client, pending, chunk_size=chunk_size, raise_on_error=False)
+        except TransportError:
+            continue
+
+        by_id = {action['_id']: action for action in pending}
+        pending = []
+        for error in errors:
+            (info,) = error.values()
+            if info.get('status') in RETRYABLE_STATUSES:
+                pending.append(by_id[info['_id']])
+            elif progress:
+                progress.reject(info)
+
+        if not pending:
+            return
+
+    raise BulkIndexError(f'{len(pending)} document(s) failed after {max_retries} retries.', pending)
+
+
+def serial_load(
+    client: Elasticsearch,
+    filename: str = PATH_TO_FILE,
+    chunk_size: int = CHUNK_SIZE,
+    shard_size: int = SHARD_SIZE,
+    checkpoint: Optional[Checkpoint] = None,
+    resume: bool = False,
+    max_retries: int = MAX_RETRIES,
+    progress: Optional[Progress] = None,
+) -> Progress:
+    """
+    Loads the CSV file (or snapshot) one range after another, storing the progress in the checkpoint (if any)
+    every time a range has been acknowledged.
+    """
+    progress = progress or Progress()
+    start = checkpoint.begin(resume) if checkpoint else None
+
+    for start, end in data_ranges(filename, shard_size, start):
+        actions = convert_range(filename, start, end)
+        send_with_retries(client, actions, chunk_size, max_retries, progress=progress)
+        progress.add(len(actions))
+        if checkpoint:
+            checkpoint.acknowledge(start, end)
+
+    progress.report()
+    return progress
+
+
+def parallel_load(
+    client: Elasticsearch,
+    filename: str = PATH_TO_FILE,
+    workers: int = DEFAULT_WORKERS,
+    senders: int = DEFAULT_SENDERS,
+    chunk_size: int = CHUNK_SIZE,
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    shard_size: int = SHARD_SIZE,
+    checkpoint: Optional[Checkpoint] = None,
+    resume: bool = False,
+    max_retries: int = MAX_RETRIES,
+    progress: Optional[Progress] = None,
+) -> Progress:
+    """
+    Loads the CSV file (or snapshot) splitting it into ranges that are converted in a process pool, and sent
+    to ES from a pool of `senders` threads, each one doing bulk requests of `chunk_size` documents.
+
+    At most `max_in_flight` ranges are being converted or sent at any given time: once that limit
+    is reached, we wait until a bulk request is acknowledged before reading more of the file. This keeps
+    the memory usage flat no matter how many workers we use.
+    """
+    progress = progress or Progress()
+    start = checkpoint.begin(resume) if checkpoint else None
+    slots = BoundedSemaphore(max_in_flight)
+    errors = []
+
+    def send(actions: list[dict[str, Any]], start: int, end: int) -> None:
+        try:
+            send_with_retries(client, actions, chunk_size, max_retries, progress=progress)
+            progress.add(len(actions))
+            if checkpoint:
+                checkpoint.acknowledge(start, end)
+        finally:
+            slots.release()
+
+    def on_sent(future) -> None:
+        if future.exception():
+            errors.append(future.exception())
+
+    def converted(start: int, end: int):
+        def callback(future) -> None:
+            if future.exception():
+                errors.append(future.exception())
+                slots.release()
+            else:
+                sender_pool.submit(send, future.result(), start, end).add_done_callback(on_sent)
+        return callback
+
+    with ProcessPoolExecutor(workers) as converter_pool, ThreadPoolExecutor(senders) as sender_pool:
+        for start, end in data_ranges(filename, shard_size, start):
+            slots.acquire()
+            if errors:
+                slots.release()
+                break
+            converter_pool.submit(
+                convert_range, filename, start, end
+            ).add_done_callback(converted(start, end))
+
+        # Wait for every in-flight range to be acknowledged before closing the pools
+        for _ in range(max_in_flight):
+            slots.acquire()
+
+    if errors:
+        raise errors[0]
+
+    progress.report()
+    return progress
+
+
+def set_index_profile(client: Elasticsearch, bulk_load: bool) -> None:
+    """
+    Switches the template, and every existing measurement index, to the bulk load or the production settings.
+    The template of the rollups is saved too, before any measurement is written.
+    """
+    Measurement.as_template(bulk_load).save(using=client)
+    Measurement.decade_template().save(using=client)
+    MeasurementRollup.as_template().save(using=client)
+    client.indices.put_settings(
+        index=Measurement.Index.name,
+        body={'index': Measurement.dynamic_settings(bulk_load)},
+        allow_no_indices=True
+    )
+
+
+def force_merge_historical(client: Elasticsearch, current_year: Optional[int] = None) -> None:
+    """
+    Merges the segments of every index but the current year's one, as they won't receive more writes.
+    """
+    current_year = current_year or date.today().year
+    client.indices.forcemerge(
+        index=f'{Measurement.Index.name},-{Measurement.index_for_year(current_year)}',
+        max_num_segments=1,
+        allow_no_indices=True,
+        request_timeout=FORCE_MERGE_TIMEOUT
+    )
+
+
+@contextmanager
+def bulk_load_mode(client: Elasticsearch, force_merge: bool = True) -> Iterator[None]:
+    """
+    Keeps the measurement indexes with the bulk load settings while loading, restoring the production ones
+    afterwards. Historical years are only force merged if the load has finished successfully, and before
+    the replicas are enabled again, so they are built from the merged segments.
+    """
+    set_index_profile(client, bulk_load=True)
+    try:
+        yield
+        if force_merge:
+            force_merge_historical(client)
+    finally:
+        set_index_profile(client, bulk_load=False)
@@ -0,0 +1,247 @@
+"""
+Performance metrics of the API, exposed on /metrics in the Prometheus text format.
+
+Tracked per process (so every worker of a pre-forking server exposes its own, as Prometheus expects):
+
+- the latency and response size of the requests, per endpoint,
+- the round trip time of the ES requests, and the time ES reports it spent in them (`took`),
+- the number of indexes (or wildcards) targeted by every search, from its URL,
+- the hits, misses, evictions and invalidations of coruscant.cache.measurements_cache,
+- the top cities searches, and the requests coalesced into them (coruscant.cache.measurements_flights).
+
+Requests slower than SLOW_REQUEST_SECONDS (if set) are logged with the ES requests they made, bodies included.
+"""
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from typing import Any, Optional
+
+from coruscant.cache import measurements_cache, measurements_flights
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+INDEXES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 0))  # 0 disables the slow request log
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger(__name__)
+
+# Start time and ES requests of the request being served, see `start_request`
+_current_request: ContextVar[Optional[dict[str, Any]]] = ContextVar('current_request', default=None)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple[str, ...], values: tuple[Any, ...]) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{_labels(self.labels, key)} {value}' for key, value in sorted(values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> (count per bucket, sum)
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels((*self.labels, "le"), (*key, bound))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    'coruscant_request_duration_seconds', 'Latency of the API requests.', ('method', 'endpoint', 'status')
+)
+RESPONSE_SIZE = Histogram(
+    'coruscant_response_size_bytes', 'Size of the API responses, but the streamed ones.', ('method', 'endpoint'),
+    buckets=SIZE_BUCKETS
+)
+ES_REQUEST_DURATION = Histogram(
+    'coruscant_es_request_duration_seconds', 'Round trip time of the ES requests.', ('api',)
+)
+ES_TOOK = Histogram(
+    'coruscant_es_took_seconds', 'Time ES reports it spent in the requests (took).', ('api',)
+)
+ES_ERRORS = Counter('coruscant_es_errors_total', 'ES requests failed.', ('api',))
+INDEXES_PER_SEARCH = Histogram(
+    'coruscant_indexes_per_search', 'Indexes and wildcards targeted by every search.', buckets=INDEXES_BUCKETS
+)
+METRICS = (REQUEST_DURATION, RESPONSE_SIZE, ES_REQUEST_DURATION, ES_TOOK, ES_ERRORS, INDEXES_PER_SEARCH)
+
+
+def _cache_lines() -> list[str]:
+    stats = measurements_cache.stats()
+    lines = [
+        '# HELP coruscant_cache_entries Entries in the query cache.',
+        '# TYPE coruscant_cache_entries gauge',
+        f'coruscant_cache_entries {stats["size"]}',
+    ]
+    for stat in ('hits', 'misses', 'evictions', 'invalidations'):
+        lines += [
+            f'# HELP coruscant_cache_{stat}_total Query cache {stat}.',
+            f'# TYPE coruscant_cache_{stat}_total counter',
+            f'coruscant_cache_{stat}_total {stats[stat]}',
+        ]
+    return lines
+
+
+def _coalescing_lines() -> list[str]:
+    stats = measurements_flights.stats()
+    return [
+        '# HELP coruscant_coalescing_in_flight Top cities searches running.',
+        '# TYPE coruscant_coalescing_in_flight gauge',
+        f'coruscant_coalescing_in_flight {stats["in_flight"]}',
+        '# HELP coruscant_coalescing_searches_total Top cities searches sent, on a cache miss.',
+        '# TYPE coruscant_coalescing_searches_total counter',
+        f'coruscant_coalescing_searches_total {stats["calls"]}',
+        '# HELP coruscant_coalesced_requests_total Requests served by the search of an identical request.',
+        '# TYPE coruscant_coalesced_requests_total counter',
+        f'coruscant_coalesced_requests_total {stats["coalesced"]}',
+    ]
+
+
+def render() -> str:
+    """
+    Every metric, in the Prometheus text format.
+    """
+    lines = [line for metric in METRICS for line in metric.render()]
+    return '\n'.join(lines + _cache_lines() + _coalescing_lines()) + '\n'
+
+
+def es_api(url: str) -> str:
+    """
+    ES API of a request URL: its first path segment starting with an underscore (`_search`, `_bulk`...).
+    """
+    return next((segment for segment in url.split('?')[0].split('/') if segment.startswith('_')), 'other')
+
+
+def observe_es_request(method: str, url: str, body: Any, seconds: float, response: Any = None) -> None:
+    """
+    Records an ES request that took `seconds` to get the `response` (None if it failed).
+    """
+    api = es_api(url)
+    ES_REQUEST_DURATION.observe(seconds, api=api)
+    took = response.get('took') if isinstance(response, dict) else None
+    if took is not None:
+        ES_TOOK.observe(took / 1000, api=api)
+    if response is None:
+        ES_ERRORS.inc(api=api)
+    targets = url.split('?')[0].lstrip('/').split('/')[0]
+    if api == '_search' and not targets.startswith('_'):  # searches of a point in time have no index
+        INDEXES_PER_SEARCH.observe(targets.count(',') + 1)
+
+    current = _current_request.get()
+    if current is not None and SLOW_REQUEST_SECONDS:
+        current['es'].append({'method': method, 'url': url, 'body': body, 'seconds': seconds, 'took': took})
+
+
+def start_request() -> None:
+    _current_request.set({'start': time.perf_counter(), 'es': []})
+
+
+def finish_request(method: str, endpoint: Optional[str], path: str, status: int, size: Optional[int]) -> None:
+    """
+    Records the request started with `start_request`. `endpoint` is its route, None if it didn't match any.
+    """
+    current = _current_request.get()
+    if current is None:
+        return
+    _current_request.set(None)
+
+    seconds = time.perf_counter() - current['start']
+    endpoint = endpoint or 'unmatched'
+    REQUEST_DURATION.observe(seconds, method=method, endpoint=endpoint, status=str(status))
+    if size is not None:
+        RESPONSE_SIZE.observe(size, method=method, endpoint=endpoint)
+
+    if SLOW_REQUEST_SECONDS and seconds >= SLOW_REQUEST_SECONDS:
+        logger.warning('Slow request %s %s (%s) took %.3fs, ES requests: %s', method, path, status, seconds,
+                       json.dumps(current['es'], default=str))
+
+
+def instrument(app) -> None:
+    """
+    Records the requests of a Flask app, and serves the metrics on /metrics.
+    """
+    from flask import Response, request
+
+    app.before_request(start_request)
+
+    @app.after_request
+    def record(response):
+        finish_request(
+            request.method, request.url_rule and request.url_rule.rule, request.path, response.status_code,
+            response.content_length
+        )
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', lambda: Response(render(), content_type=CONTENT_TYPE))
+
+
+def instrument_async(app) -> None:
+    """
+    Same as `instrument`, for a Quart app. The hooks are coroutines, so they run in the context of the request.
+    """
+    from quart import Response, request
+
+    @app.before_request
+    async def start():
+        start_request()
+
+    @app.after_request
+    async def record(response):
+        finish_request(
+            request.method, request.url_rule and request.url_rule.rule, request.path, response.status_code,
+            response.content_length
+        )
+        return response
+
+    async def metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,145 @@
+"""
+Moves the measurements into the indexes of the current layout (see Measurement.layout), i.e. after
+loading the data with yearly indexes only, or after changing INDEX_HOT_SINCE. Also rebuilds the indexes
+with the mapping and settings of the current profile (see INDEX_PROFILE), after changing it.
+"""
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from elasticsearch import Elasticsearch
+
+from coruscant.documents import INDEX_PROFILE, Measurement
+
+REINDEX_TIMEOUT = 60 * 60  # seconds
+# Out of the measurement indexes pattern, so the staging copies are never searched
+STAGING_PREFIX = 'global_land_temperatures_by_city_staging-'
+# The reindex keeps the routing of the source documents, and the ones indexed before every write was routed by
+# city have none: the templates require it, and the city lookups need the documents in the shard of their city
+ROUTING_SCRIPT = {'source': 'ctx._routing = ctx._source.city', 'lang': 'painless'}
+
+
+def migration_plan(indexes: Iterable[str]) -> dict[str, list[str]]:
+    """
+    Returns the indexes of the layout that need to be filled, with the existing indexes to read them from.
+    Indexes already matching the layout are left out.
+    """
+    prefix = Measurement.Index.name[:-1]
+    plan = defaultdict(list)
+
+    for index in sorted(indexes):
+        span = Measurement.layout.span(index[len(prefix):]) if index.startswith(prefix) else None
+        if not span:
+            continue
+        targets = sorted({Measurement.index_for_year(year) for year in range(span[0], span[1] + 1)})
+        if targets == [index]:
+            continue
+        for target in targets:
+            plan[target].append(index)
+
+    return dict(plan)
+
+
+def migrate(client: Elasticsearch, delete_sources: bool = True) -> dict[str, list[str]]:
+    """
+    Reindexes the measurements following the migration plan, deleting the indexes left out of the layout
+    once every reindex has succeeded. Returns the plan.
+
+    Documents keep their deterministic ids, so an interrupted migration can just be run again. Until the
+    sources are deleted, the migrated documents are in two indexes, so searches count them twice.
+    """
+    prefix = Measurement.Index.name[:-1]
+    plan = migration_plan(client.indices.get_alias(index=Measurement.Index.name))
+
+    for target, sources in plan.items():
+        first, last = Measurement.layout.span(target[len(prefix):])
+        response = client.reindex(body={
+            'source': {
+                'index': ','.join(sources),
+                'query': {'range': {'day': {'gte': f'{first:04}-01-01', 'lte': f'{last:04}-12-31'}}}
+            },
+            'dest': {'index': target},
+            'script': ROUTING_SCRIPT
+        }, refresh=True, wait_for_completion=True, request_timeout=REINDEX_TIMEOUT)
+        if response['failures']:
+            raise RuntimeError(f'Reindexing into {target} failed: {response["failures"][:3]}')
+
+    leftovers = sorted({source for sources in plan.values() for source in sources} - set(plan))
+    if delete_sources and leftovers:
+        client.indices.delete(index=','.join(leftovers))
+
+    return plan
+
+
+def index_profile(index: dict) -> str:
+    """
+    Profile of an existing index, from its settings: only the optimized one sorts the segments.
+    """
+    return 'optimized' if index['settings']['index'].get('sort') else 'standard'
+
+
+def profile_plan(indexes: dict[str, dict], profile: Optional[str] = None) -> list[str]:
+    """
+    Returns the measurement indexes (from the response of `indices.get`) not following the given profile,
+    INDEX_PROFILE by default.
+    """
+    profile = profile or INDEX_PROFILE
+    prefix = Measurement.Index.name[:-1]
+    return sorted(
+        name for name, index in indexes.items()
+        if name.startswith(prefix) and Measurement.layout.span(name[len(prefix):]) and index_profile(index) != profile
+    )
+
+
+def _copy(client: Elasticsearch, source: str, dest: str) -> None:
+    # Only creates the missing documents, so the ones written to `dest` meanwhile are kept
+    response = client.reindex(
+        body={
+            'conflicts': 'proceed',
+            'source': {'index': source},
+            'dest': {'index': dest, 'op_type': 'create'},
+            'script': ROUTING_SCRIPT
+        },
+        refresh=True, wait_for_completion=True, request_timeout=REINDEX_TIMEOUT
+    )
+    if response['failures']:
+        raise RuntimeError(f'Reindexing {source} into {dest} failed: {response["failures"][:3]}')
+    if client.count(index=source)['count'] > client.count(index=dest)['count']:
+        raise RuntimeError(f'Reindexing {source} into {dest} lost documents')
+
+
+def reindex_profile(client: Elasticsearch, profile: Optional[str] = None) -> list[str]:
+    """
+    Rebuilds the measurement indexes not following the profile (INDEX_PROFILE by default), as index sorting
+    and codecs can only be set when an index is created. Returns the rebuilt indexes.
+
+    Every index is blocked for writes and copied into a staging index, then deleted and recreated from the
+    staging copy with the templates of the profile. Searches miss the index while it's recreated, and writes
+    fail while it's copied into staging. If interrupted, running it again resumes from the staging copies.
+    """
+    Measurement.as_template(profile=profile).save(using=client)
+    Measurement.decade_template(profile).save(using=client)
+
+    profile = profile or INDEX_PROFILE
+    prefix = Measurement.Index.name[:-1]
+    existing = client.indices.get(index=Measurement.Index.name, allow_no_indices=True)
+    staged = client.indices.get_alias(index=f'{STAGING_PREFIX}*', allow_no_indices=True)
+    # The staging copies left by an interrupted run are complete, as the source is only deleted once copied
+    plan = sorted(set(profile_plan(existing, profile)) | {
+        f'{prefix}{staging[len(STAGING_PREFIX):]}' for staging in staged
+    })
+
+    for index in plan:
+        staging = f'{STAGING_PREFIX}{index[len(prefix):]}'
+        if index in existing and index_profile(existing[index]) != profile:
+            client.indices.delete(index=staging, ignore_unavailable=True)
+            client.indices.add_block(index=index, block='write')
+            client.indices.create(index=staging, body={
+                'settings': {'number_of_shards': 1, 'number_of_replicas': 0},
+                'mappings': existing[index]['mappings']
+            })
+            _copy(client, index, staging)
+        client.indices.delete(index=index, ignore_unavailable=True)
+        _copy(client, staging, index)
+        client.indices.delete(index=staging)
+
+    return plan
@@ -0,0 +1,353 @@
+"""
+Materialized rollups with the hottest measurement per (city, year) and per (city, month of the year).
+
+The top cities query only needs the hottest measurement of every city, so for the years fully
+covered by a date range it can read the ~3.4k yearly rollups of each year, instead of every
+measurement. Only the partial years at the boundaries of the range touch the yearly indexes.
+"""
+from datetime import date, datetime
+from typing import Any, Iterable, Optional, Union
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+
+from coruscant.documents import Measurement, MeasurementRollup
+from coruscant.es import TIMEOUTS
+from coruscant.indexes import index_catalog
+
+ROLLUP_INDEX = MeasurementRollup.Index.name
+MEASUREMENT_FIELDS = [
+    'day',
+    'average_temperature',
+    'average_temperature_uncertainty',
+    'city',
+    'country',
+    'location'
+]
+MAX_CITIES = 10000
+# (city, month) buckets per search of the backfill, well below search.max_buckets (65535 by default in ES 7)
+BACKFILL_PAGE_SIZE = 1000
+RECORD_SCRIPT = (
+    'if (ctx._source.average_temperature == null '
+    '|| params.doc.average_temperature > ctx._source.average_temperature) '
+    '{ ctx._source.putAll(params.doc) } else { ctx.op = "none" }'
+)
+
+
+def _as_date(day: Union[date, str]) -> date:
+    if isinstance(day, datetime):
+        return day.date()
+    if isinstance(day, date):
+        return day
+    return date.fromisoformat(day[:10])
+
+
+def rollup_documents(measurement: dict[str, Any]) -> list[dict[str, Any]]:
+    """
+    Returns the yearly and monthly rollup documents the given measurement would be stored as.
+    """
+    day = _as_date(measurement['day'])
+    source = {field: measurement[field] for field in MEASUREMENT_FIELDS if field in measurement}
+    source['day'] = day.isoformat()
+
+    return [
+        {**source, 'period': 'year', 'year': day.year},
+        {**source, 'period': 'month', 'month': day.month},
+    ]
+
+
+def _rollup_id(doc: dict[str, Any]) -> str:
+    period = doc['period']
+    return MeasurementRollup.generate_id(doc['city'], period, doc[period])
+
+
+def record(client: Elasticsearch, measurement: dict[str, Any]) -> None:
+    """
+    Updates the rollups of the measurement's city if the measurement is hotter than the current ones.
+
+    The comparison happens in an update script, so concurrent writes can't overwrite a hotter value.
+    """
+    record_many(client, [measurement])
+
+
+def record_many(client: Elasticsearch, measurements: list[dict[str, Any]]) -> None:
+    """
+    Same as `record`, for many measurements in a single bulk request.
+    """
+    actions = [
+        {
+            '_op_type': 'update',
+            '_index': ROLLUP_INDEX,
+            '_id': _rollup_id(doc),
+            'retry_on_conflict': 3,
+            'script': {'source': RECORD_SCRIPT, 'lang': 'painless', 'params': {'doc': doc}},
+            'upsert': doc
+        }
+        for measurement in measurements if measurement.get('average_temperature') is not None
+        for doc in rollup_documents(measurement)
+    ]
+    if actions:
+        bulk(client, actions, chunk_size=len(actions), request_timeout=TIMEOUTS['bulk'])
+
+
+def _hottest(client: Elasticsearch, indexes: str, city: str, query: list[dict[str, Any]]) -> Optional[dict[str, Any]]:
+    response = client.search(index=indexes, routing=city, body={
+        'query': {'bool': {'filter': [{'term': {'city': city}}, *query, {'exists': {'field': 'average_temperature'}}]}},
+        'sort': [{'average_temperature': 'desc'}],
+        '_source': MEASUREMENT_FIELDS,
+        'size': 1
+    }, ignore_unavailable=True, request_timeout=TIMEOUTS['search'])
+    hits = response['hits']['hits']
+    return hits[0]['_source'] if hits else None
+
+
+def recompute(client: Elasticsearch, city: str, day: Union[date, str]) -> None:
+    """
+    Rebuilds the rollups of the city for the year and month of the given day, searching the yearly
+    indexes. Needed when a measurement gets colder, as it may not be the hottest one anymore.
+    """
+    day = _as_date(day)
+    year_indexes = Measurement.get_indexes_for_range(
+        date(day.year, 1, 1), date(day.year, 12, 31), index_catalog.indexes()
+    )
+    client.indices.refresh(index=year_indexes, ignore_unavailable=True)
+
+    hottest_in_year = _hottest(client, year_indexes, city, [])
+    hottest_in_month = _hottest(client, Measurement.Index.name, city, [{
+        'script': {'script': {
+            'source': "doc['day'].value.getMonthValue() == params.month",
+            'params': {'month': day.month}
+        }}
+    }])
+
+    actions = []
+    for period, value, hottest in (('year', day.year, hottest_in_year), ('month', day.month, hottest_in_month)):
+        _id = MeasurementRollup.generate_id(city, period, value)
+        if hottest:
+            doc = next(doc for doc in rollup_documents(hottest) if doc['period'] == period)
+            actions.append({'_index': ROLLUP_INDEX, '_id': _id, '_source': doc})
+        else:
+            actions.append({'_op_type': 'delete', '_index': ROLLUP_INDEX, '_id': _id})
+
+    bulk(client, actions, ignore_status=(404,))
+
+
+def measurement_updated(client: Elasticsearch, previous: dict[str, Any], current: dict[str, Any]) -> None:
+    """
+    Keeps the rollups up to date after a measurement update.
+    """
+    before = previous.get('average_temperature')
+    after = current.get('average_temperature')
+    if before is not None and (after is None or after < before):
+        recompute(client, current['city'], current['day'])
+    else:
+        record(client, current)
+
+
+def measurements_updated(client: Elasticsearch, measurements: list[dict[str, Any]]) -> None:
+    """
+    Keeps the rollups up to date after writing many measurements, without knowing their previous values:
+    either updates, or adds that may overwrite a measurement of the same city and day.
+
+    The rollups of a city are only rebuilt if one of the updated measurements is the hottest one
+    in them and it got colder. Otherwise, the measurements are recorded as usual.
+    """
+    if not measurements:
+        return
+
+    docs = [rollup_documents(measurement) for measurement in measurements]
+    response = client.mget(
+        index=ROLLUP_INDEX, body={'ids': [_rollup_id(doc) for pair in docs for doc in pair]}, _source=True
+    )
+    current = {found['_id']: found['_source'] for found in response['docs'] if found.get('found')}
+
+    to_record = []
+    for measurement, pair in zip(measurements, docs):
+        got_colder = False
+        for doc in pair:
+            rollup = current.get(_rollup_id(doc))
+            if rollup and rollup['day'][:10] == doc['day'] and (
+                doc.get('average_temperature') is None or doc['average_temperature'] < rollup['average_temperature']
+            ):
+                got_colder = True
+
+        if got_colder:
+            recompute(client, measurement['city'], measurement['day'])
+        else:
+            to_record.append(measurement)
+
+    record_many(client, to_record)
+
+
+def _hottest_per_month(client: Elasticsearch, index: str, page_size: int) -> Iterable[dict[str, Any]]:
+    """
+    Yields the hottest measurement of every (city, month) in the index, paginating over them: a decade
+    index has ~400k of them, far more buckets than a single search can return (search.max_buckets).
+    """
+    after = None
+    while True:
+        composite = {
+            'size': page_size,
+            'sources': [
+                {'city': {'terms': {'field': 'city'}}},
+                {'month': {'date_histogram': {'field': 'day', 'calendar_interval': 'month'}}},
+            ]
+        }
+        if after:
+            composite['after'] = after
+        response = client.search(index=index, body={
+            'size': 0,
+            'query': {'exists': {'field': 'average_temperature'}},
+            'aggs': {
+                'months': {
+                    'composite': composite,
+                    'aggs': {
+                        'hottest': {
+                            'top_hits': {
+                                'size': 1,
+                                'sort': [{'average_temperature': 'desc'}],
+                                '_source': MEASUREMENT_FIELDS
+                            }
+                        }
+                    }
+                }
+            }
+        }, request_timeout=TIMEOUTS['bulk'])
+
+        months = response['aggregations']['months']
+        for month in months['buckets']:
+            yield month['hottest']['hits']['hits'][0]['_source']
+        after = months.get('after_key')
+        if not after or len(months['buckets']) < page_size:
+            return
+
+
+def _backfill_actions(client: Elasticsearch, page_size: int = BACKFILL_PAGE_SIZE) -> Iterable[dict[str, Any]]:
+    hottest_months = {}
+
+    for index in sorted(client.indices.get_alias(index=Measurement.Index.name)):
+        hottest_years = {}
+        for measurement in _hottest_per_month(client, index, page_size):
+            for doc in rollup_documents(measurement):
+                rollups = hottest_years if doc['period'] == 'year' else hottest_months
+                key = (doc['city'], doc[doc['period']])
+                if key not in rollups or doc['average_temperature'] > rollups[key]['average_temperature']:
+                    rollups[key] = doc
+
+        # The yearly rollups are complete once the index has been read, the monthly ones
+        # need every index to be read first
+        for doc in hottest_years.values():
+            yield {'_index': ROLLUP_INDEX, '_id': _rollup_id(doc), '_source': doc}
+
+    for doc in hottest_months.values():
+        yield {'_index': ROLLUP_INDEX, '_id': _rollup_id(doc), '_source': doc}
+
+
+def _without_template(client: Elasticsearch) -> bool:
+    mappings = client.indices.get_mapping(index=ROLLUP_INDEX)[ROLLUP_INDEX]['mappings']
+    return mappings.get('properties', {}).get('city', {}).get('type') != 'keyword'
+
+
+def backfill(client: Elasticsearch, chunk_size: int = 10000) -> None:
+    """
+    Builds every rollup from the yearly indexes, one index at a time, and then adds the
+    MeasurementRollup.READY_ALIAS to the rollups index, so the top cities query starts reading it.
+
+    A rollups index created by a write before its template was saved (with a dynamic mapping, which
+    can't be collapsed on the city) is deleted first, as its rollups are rebuilt anyway.
+    """
+    MeasurementRollup.as_template().save(using=client)
+    if client.indices.exists(index=ROLLUP_INDEX) and _without_template(client):
+        client.indices.delete(index=ROLLUP_INDEX)
+    MeasurementRollup.init(using=client)
+
+    client.indices.refresh(index=Measurement.Index.name, allow_no_indices=True)
+    bulk(client, _backfill_actions(client), chunk_size=chunk_size)
+    client.indices.refresh(index=ROLLUP_INDEX)
+    client.indices.put_alias(index=ROLLUP_INDEX, name=MeasurementRollup.READY_ALIAS)
+
+
+def top_cities_query(
+    number_of_cities: int,
+    _from: Optional[date] = None,
+    _to: Optional[date] = None,
+    order: str = 'desc',
+    country: Optional[str] = None,
+    min_uncertainty: Optional[float] = None,
+    max_uncertainty: Optional[float] = None,
+) -> tuple[str, dict[str, Any]]:
+    """
+    Returns the indexes and body of the search for the hottest (or coldest, with `order='asc'`)
+    `number_of_cities` cities in the range, ranked by temperature and then by name.
+
+    The years fully covered by the range are read from the yearly rollups, and the partial years
+    at its boundaries from the yearly indexes. If there are no full years in the range, only the
+    yearly indexes are used. As the rollups only have the hottest measurement of every city, the coldest
+    cities, and the ones filtered by country or uncertainty, are always read from the yearly indexes.
+    So is every year until the catalog (coruscant.indexes.index_catalog) knows that the rollups have
+    been backfilled. Only the indexes in the catalog are targeted, when it's up to date.
+    """
+    body = {
+        'collapse': {'field': 'city'},
+        'sort': [{'average_temperature': order}, {'city': 'asc'}],
+        'size': number_of_cities,
+        '_source': MEASUREMENT_FIELDS
+    }
+
+    filters = []
+    if country:
+        # The country is a text field (a keyword with the optimized profile, matched as a whole)
+        filters.append({'match_phrase': {'country': country}})
+    if min_uncertainty is not None or max_uncertainty is not None:
+        uncertainty = {}
+        if min_uncertainty is not None:
+            uncertainty['gte'] = min_uncertainty
+        if max_uncertainty is not None:
+            uncertainty['lte'] = max_uncertainty
+        filters.append({'range': {'average_temperature_uncertainty': uncertainty}})
+
+    first_full_year = _from.year + (_from != date(_from.year, 1, 1)) if _from else None
+    last_full_year = _to.year - (_to != date(_to.year, 12, 31)) if _to else None
+
+    if (
+        filters or order != 'desc' or not index_catalog.rollups_ready()
+        or (first_full_year and last_full_year and first_full_year > last_full_year)
+    ):
+        if _from or _to:
+            date_range = {}
+            if _from:
+                date_range['gte'] = _from.isoformat()
+            if _to:
+                date_range['lte'] = _to.isoformat()
+            filters.append({'range': {'day': date_range}})
+        filters.append({'exists': {'field': 'average_temperature'}})
+        body['query'] = {'bool': {'filter': filters}}
+        return Measurement.get_indexes_for_range(_from, _to, index_catalog.indexes()), body
+
+    years = {}
+    if first_full_year:
+        years['gte'] = first_full_year
+    if last_full_year:
+        years['lte'] = last_full_year
+    year_rollups = [{'term': {'period': 'year'}}]
+    if years:
+        year_rollups.append({'range': {'year': years}})
+
+    clauses = [{'bool': {'filter': year_rollups}}]
+    indexes = [ROLLUP_INDEX]
+    partial_years = []
+    if _from and _from.year < first_full_year:
+        partial_years.append((_from, date(_from.year, 12, 31)))
+    if _to and _to.year > last_full_year:
+        partial_years.append((date(_to.year, 1, 1), _to))
+
+    for start, end in partial_years:
+        clauses.append({'bool': {
+            'filter': [{'range': {'day': {'gte': start.isoformat(), 'lte': end.isoformat()}}}],
+            'must_not': [{'exists': {'field': 'period'}}]
+        }})
+        indexes.append(Measurement.get_indexes_for_range(start, end, index_catalog.indexes()))
+
+    body['query'] = {'bool': {'should': clauses, 'minimum_should_match': 1}}
+
+    return ','.join(indexes), body
@@ -0,0 +1,122 @@
+"""
+Temperature time series of a city, aggregated by ES into monthly, yearly or decade buckets.
+
+Every bucket has the average, min and max temperature of its measurements, and their mean weighted by
+the inverse of the squared uncertainty (so the precise measurements count more than the old, uncertain
+ones). ES has no decade interval, so decades are merged from the yearly buckets, the same way long
+series are downsampled to a max number of points: the sums behind every statistic are kept, so merged
+buckets are exact.
+"""
+from datetime import date
+from math import ceil
+from typing import Any, Optional
+
+from coruscant.documents import Measurement
+from coruscant.indexes import index_catalog
+
+INTERVALS = ('month', 'year', 'decade')
+CALENDAR_INTERVALS = {'month': '1M', 'year': '1y', 'decade': '1y'}
+MAX_POINTS = 10000
+# Measurements without uncertainty don't count for the weighted mean, and 0 uncertainties are clamped
+WEIGHT = (
+    "if (doc['average_temperature_uncertainty'].size() == 0) { return 0 } "
+    "double uncertainty = Math.max(doc['average_temperature_uncertainty'].value, 0.001); "
+    "return 1.0 / (uncertainty * uncertainty);"
+)
+WEIGHTED_TEMPERATURE = (
+    "if (doc['average_temperature_uncertainty'].size() == 0) { return 0 } "
+    "double uncertainty = Math.max(doc['average_temperature_uncertainty'].value, 0.001); "
+    "return doc['average_temperature'].value / (uncertainty * uncertainty);"
+)
+
+
+def series_query(
+    city: str,
+    interval: str,
+    country: Optional[str] = None,
+    _from: Optional[date] = None,
+    _to: Optional[date] = None
+) -> tuple[str, dict[str, Any]]:
+    """
+    Returns the indexes and body of the search for the series of `city`, in buckets of `interval`.
+    The search has to be routed by city, see coruscant.api.update_search.
+    """
+    filters = [{'term': {'city': city}}, {'exists': {'field': 'average_temperature'}}]
+    if country:
+        filters.append({'match_phrase': {'country': country}})
+    if _from or _to:
+        date_range = {}
+        if _from:
+            date_range['gte'] = _from.isoformat()
+        if _to:
+            date_range['lte'] = _to.isoformat()
+        filters.append({'range': {'day': date_range}})
+
+    body = {
+        'size': 0,
+        'query': {'bool': {'filter': filters}},
+        'aggs': {'series': {
+            'date_histogram': {
+                'field': 'day',
+                'calendar_interval': CALENDAR_INTERVALS[interval],
+                'format': 'yyyy-MM-dd',
+                'min_doc_count': 1
+            },
+            'aggs': {
+                'temperature': {'stats': {'field': 'average_temperature'}},
+                'weight': {'sum': {'script': {'source': WEIGHT}}},
+                'weighted_temperature': {'sum': {'script': {'source': WEIGHTED_TEMPERATURE}}},
+            }
+        }}
+    }
+    return Measurement.get_indexes_for_range(_from, _to, index_catalog.indexes()), body
+
+
+def _merge(buckets: list[dict[str, Any]]) -> dict[str, Any]:
+    count = sum(bucket['temperature']['count'] for bucket in buckets)
+    return {
+        'day': buckets[0]['key_as_string'],
+        'count': count,
+        'sum': sum(bucket['temperature']['sum'] for bucket in buckets),
+        'min': min(bucket['temperature']['min'] for bucket in buckets),
+        'max': max(bucket['temperature']['max'] for bucket in buckets),
+        'weight': sum(bucket['weight']['value'] for bucket in buckets),
+        'weighted': sum(bucket['weighted_temperature']['value'] for bucket in buckets),
+    }
+
+
+def _point(merged: dict[str, Any]) -> dict[str, Any]:
+    return {
+        'day': merged['day'],
+        'average_temperature': merged['sum'] / merged['count'],
+        'min_temperature': merged['min'],
+        'max_temperature': merged['max'],
+        'weighted_temperature': merged['weighted'] / merged['weight'] if merged['weight'] else None,
+        'measurements': merged['count'],
+    }
+
+
+def series_points(response: dict[str, Any], interval: str, points: Optional[int] = None) -> list[dict[str, Any]]:
+    """
+    Converts the buckets of the series search into points, merging the years of every decade, and then
+    consecutive buckets so there are at most `points` points.
+    """
+    buckets = response['aggregations']['series']['buckets']
+
+    groups = [[bucket] for bucket in buckets]
+    if interval == 'decade':
+        decades = {}
+        for bucket in buckets:
+            decades.setdefault(int(bucket['key_as_string'][:4]) // 10, []).append(bucket)
+        groups = list(decades.values())
+        for group in groups:
+            group[0] = {**group[0], 'key_as_string': f'{int(group[0]["key_as_string"][:4]) // 10 * 10}-01-01'}
+
+    if points and len(groups) > points:
+        size = ceil(len(groups) / points)
+        groups = [
+            [bucket for group in groups[start:start + size] for bucket in group]
+            for start in range(0, len(groups), size)
+        ]
+
+    return [_point(_merge(group)) for group in groups]
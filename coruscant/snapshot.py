@@ -0,0 +1,227 @@
+"""
+Compact binary snapshot of the temperatures CSV, so it's parsed only once.
+
+A snapshot is a fixed header followed by a JSON header and one fixed-width array per column, with the
+rows in the order of the CSV file:
+
+    MAGIC (8 bytes) | version (uint32) | JSON header length (uint32) | JSON header | columns
+
+The JSON header has the number of rows, the dtype and offset of every column, the city and country
+dictionaries, and the CRC32 of the columns. Columns are 64-byte aligned, so they are memory-mapped and
+read zero-copy with NumPy: the day as months since 1970-01 (int32) plus the day of the month (int8), the
+temperatures and location as float64 (NaN when missing) to keep the values of the CSV, and the city and
+country as codes of the dictionaries.
+"""
+import json
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from csv import reader as csv_reader
+from functools import lru_cache
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+from coruscant import loader  # imports this module, so its functions are only used at call time
+from coruscant.documents import Measurement
+
+MAGIC = b'CORUSNAP'
+VERSION = 1
+PRELUDE = struct.Struct('<8sII')  # magic, version, JSON header length
+ALIGNMENT = 64
+SHARD_ROWS = 65536
+COLUMNS = {
+    'month': 'i4',
+    'dom': 'i1',
+    'average_temperature': 'f8',
+    'average_temperature_uncertainty': 'f8',
+    'city': 'i4',
+    'country': 'i4',
+    'lat': 'f8',
+    'lon': 'f8',
+}
+ARRAY_TYPECODES = {'i4': 'i', 'i1': 'b', 'f8': 'd'}
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_snapshot(
+    filename: str, columns: dict[str, Any], cities: list[str], countries: list[str]
+) -> None:
+    """
+    Writes the columns (arrays of the same length, see COLUMNS) and the dictionaries of the city and
+    country codes into a snapshot file. The file is replaced atomically.
+    """
+    columns = {name: np.ascontiguousarray(columns[name], dtype=dtype) for name, dtype in COLUMNS.items()}
+    rows = len(columns['month'])
+    if any(len(column) != rows for column in columns.values()):
+        raise ValueError('Every column must have the same number of rows')
+
+    layout, offset, checksum = [], 0, 0
+    for name, column in columns.items():
+        offset = _aligned(offset)
+        layout.append({'name': name, 'dtype': COLUMNS[name], 'offset': offset})
+        checksum = zlib.crc32(column.data, checksum)
+        offset += column.nbytes
+
+    header = json.dumps({
+        'rows': rows,
+        'columns': layout,
+        'cities': cities,
+        'countries': countries,
+        'checksum': checksum,
+    }).encode('utf-8')
+    data_start = _aligned(PRELUDE.size + len(header))
+
+    # Written to a temporary file first, so a crash never leaves a half written snapshot
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'wb') as snapshot_file:
+        snapshot_file.write(PRELUDE.pack(MAGIC, VERSION, len(header)) + header)
+        for column_layout, column in zip(layout, columns.values()):
+            snapshot_file.seek(data_start + column_layout['offset'])
+            snapshot_file.write(column.data)
+    os.replace(tmp_filename, filename)
+
+
+def convert_csv(csv_filename: str, filename: str) -> int:
+    """
+    Converts the temperatures CSV into a snapshot. Returns the number of rows.
+    """
+    columns = {name: array(ARRAY_TYPECODES[dtype]) for name, dtype in COLUMNS.items()}
+    cities, countries = {}, {}
+    nan = float('nan')
+
+    with open(csv_filename, 'r') as csv_file:
+        reader = csv_reader(csv_file)
+        next(reader)  # header
+        for day, temperature, uncertainty, city, country, lat, lon in reader:
+            location = loader.convert_location(lat, lon)
+            columns['month'].append((int(day[:4]) - 1970) * 12 + int(day[5:7]) - 1)
+            columns['dom'].append(int(day[8:10]))
+            columns['average_temperature'].append(float(temperature) if temperature else nan)
+            columns['average_temperature_uncertainty'].append(float(uncertainty) if uncertainty else nan)
+            columns['city'].append(cities.setdefault(city, len(cities)))
+            columns['country'].append(countries.setdefault(country, len(countries)))
+            columns['lat'].append(location['lat'])
+            columns['lon'].append(location['lon'])
+
+    write_snapshot(filename, columns, list(cities), list(countries))
+    return len(columns['month'])
+
+
+def is_snapshot(filename: str) -> bool:
+    with open(filename, 'rb') as data_file:
+        return data_file.read(len(MAGIC)) == MAGIC
+
+
+class Snapshot:
+    """
+    Memory-mapped snapshot file. Its columns are read-only NumPy arrays backed by the file, so opening it
+    doesn't read the data, and slices of them (see `actions`) only touch the pages they need.
+    """
+
+    def __init__(self, filename: str, verify: bool = True):
+        with open(filename, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, header_length = PRELUDE.unpack_from(self._mmap)
+            if magic != MAGIC:
+                raise ValueError(f'{filename} is not a snapshot')
+            if version != VERSION:
+                raise ValueError(f'Unsupported snapshot version {version}, expected {VERSION}')
+            header = json.loads(self._mmap[PRELUDE.size:PRELUDE.size + header_length])
+        except (struct.error, ValueError):
+            self._mmap.close()
+            raise
+
+        self.rows = header['rows']
+        self.cities = header['cities']
+        self.countries = header['countries']
+        data_start = _aligned(PRELUDE.size + header_length)
+        self.columns = {
+            column['name']: np.frombuffer(
+                self._mmap, dtype=column['dtype'], count=self.rows, offset=data_start + column['offset']
+            )
+            for column in header['columns']
+        }
+
+        if verify:
+            checksum = 0
+            for column in self.columns.values():
+                checksum = zlib.crc32(column, checksum)
+            if checksum != header['checksum']:
+                self.close()
+                raise ValueError(f'{filename} is corrupted, its checksum does not match')
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __enter__(self) -> 'Snapshot':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # The arrays keep the map alive until they are garbage collected
+        self.columns = {}
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def actions(self, start: int, end: int) -> list[dict[str, Any]]:
+        """
+        Converts the rows between `start` and `end` into bulk actions, the same ones
+        coruscant.loader.fast_action returns for the rows of the CSV.
+        """
+        rows = zip(*(self.columns[name][start:end].tolist() for name in COLUMNS))
+        actions = []
+        for month, dom, temperature, uncertainty, city, country, lat, lon in rows:
+            day = _iso_day(month, dom)
+            source = {'day': day}
+            if temperature == temperature:  # not NaN
+                source['average_temperature'] = temperature
+            if uncertainty == uncertainty:
+                source['average_temperature_uncertainty'] = uncertainty
+            source['city'] = city = self.cities[city]
+            source['country'] = country = self.countries[country]
+            source['location'] = {'lat': lat, 'lon': lon}
+            actions.append({
+                '_routing': city,
+                '_id': Measurement.generate_id(city, country, day),
+                '_index': loader.index_for_year(day[:4]),
+                '_source': source
+            })
+        return actions
+
+
+@lru_cache(maxsize=None)
+def _iso_day(month: int, dom: int) -> str:
+    return f'{1970 + month // 12:04}-{month % 12 + 1:02}-{dom:02}'
+
+
+def row_ranges(
+    filename: str, shard_rows: int = SHARD_ROWS, start: Optional[int] = None
+) -> Iterable[tuple[int, int]]:
+    """
+    Splits the rows of the snapshot into (start, end) ranges of `shard_rows` rows, from the `start` row.
+    The checksum of the snapshot is verified first.
+    """
+    with Snapshot(filename) as snapshot:
+        rows = len(snapshot)
+    for range_start in range(start or 0, rows, shard_rows):
+        yield range_start, min(range_start + shard_rows, rows)
+
+
+def convert_row_range(filename: str, start: int, end: int) -> list[dict[str, Any]]:
+    """
+    Converts a range of rows of the snapshot into bulk actions. Meant to run inside a worker process.
+    """
+    with Snapshot(filename, verify=False) as snapshot:
+        return snapshot.actions(start, end)
@@ -0,0 +1,139 @@
+"""
+Warmup of a server process before it accepts traffic (see gunicorn.conf.py and app_async.py).
+
+Importing the app doesn't touch Elasticsearch, so it can be preloaded before forking the workers. Every
+worker then warms up on its own, as the connections and caches are per process:
+
+- opens WARMUP_CONNECTIONS connections of the ES client pool (and the product check of the client),
+- saves the template of the rollups index, so a write creating it gets its mapping,
+- reads the measurement indexes into coruscant.indexes.index_catalog,
+- runs WARMUP_QUERIES (the popular top cities queries, by default) to fill coruscant.cache.measurements_cache,
+- starts the write-behind buffer, if enabled, sending what the previous processes left in their journals.
+
+A failing step is logged and skipped, and the ES ones are all skipped if ES can't be reached within
+WARMUP_TIMEOUT: a worker starting while ES is down serves anyway, once ES is back.
+
+The whole warmup takes WARMUP_DEADLINE seconds at most, which must stay under the time the server gives a
+starting worker (see gunicorn.conf.py): every ES request of the warmup times out after WARMUP_TIMEOUT seconds,
+or at the deadline if sooner, without retries, and the steps left once the deadline has passed are skipped.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from coruscant.documents import MeasurementRollup
+from coruscant.es import bounded_requests, get_async_es_client, get_es_client
+from coruscant.indexes import index_catalog
+from coruscant.writebehind import WRITE_BEHIND, write_buffer
+
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', 4))
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', 5))  # seconds, per request
+WARMUP_DEADLINE = float(os.environ.get('WARMUP_DEADLINE', 30))  # seconds, for the whole warmup
+WARMUP_QUERIES = os.environ.get('WARMUP_QUERIES', ' '.join([
+    '/api/measurements',
+    '/api/measurements?cities=100',
+    f'/api/measurements?from={time.localtime().tm_year - 1}-01-01',
+    '/api/measurements?from=2000-01-01',
+    '/api/measurements?from=1900-01-01&to=1999-12-31',
+])).split()
+
+logger = logging.getLogger(__name__)
+
+
+def _step(name: str, step: Callable[[], None], deadline: float = float('inf')) -> bool:
+    if time.monotonic() >= deadline:
+        logger.warning('Warmup step %s skipped, past the deadline', name)
+        return False
+    start = time.perf_counter()
+    try:
+        step()
+    except Exception:
+        logger.warning('Warmup step %s failed', name, exc_info=True)
+        return False
+    logger.info('Warmup step %s took %.3fs', name, time.perf_counter() - start)
+    return True
+
+
+def open_connections(connections: int = WARMUP_CONNECTIONS) -> None:
+    """
+    Opens `connections` connections to ES, by sending as many concurrent requests.
+    """
+    client = get_es_client()
+    with ThreadPoolExecutor(connections) as executor:
+        list(executor.map(lambda _: client.info(request_timeout=WARMUP_TIMEOUT), range(connections)))
+
+
+def _check(query: str, status_code: int) -> None:
+    if status_code != 200:
+        logger.warning('Warmup query %s failed with %s', query, status_code)
+
+
+def _queries_left(queries: list[str], deadline: float) -> bool:
+    if time.monotonic() < deadline:
+        return True
+    logger.warning('Warmup queries %s skipped, past the deadline', ' '.join(queries))
+    return False
+
+
+def run_queries(app, queries: list[str] = WARMUP_QUERIES, deadline: float = float('inf')) -> None:
+    with app.test_client() as client:
+        for i, query in enumerate(queries):
+            if not _queries_left(queries[i:], deadline):
+                break
+            _check(query, client.get(query).status_code)
+
+
+async def run_queries_async(app, queries: list[str] = WARMUP_QUERIES, deadline: float = float('inf')) -> None:
+    client = app.test_client()
+    for i, query in enumerate(queries):
+        if not _queries_left(queries[i:], deadline):
+            break
+        _check(query, (await client.get(query)).status_code)
+
+
+def warmup_process(deadline: float) -> bool:
+    """
+    Warms up everything but the queries, which need the app, until the `deadline` (a time.monotonic() time).
+    Returns whether ES could be reached.
+    """
+    if WRITE_BEHIND:
+        _step('write-behind buffer', write_buffer.start)
+    client = get_es_client()
+    with bounded_requests(client, deadline, WARMUP_TIMEOUT):
+        if not _step('connections', open_connections, deadline):
+            return False
+        _step('rollups template', lambda: MeasurementRollup.as_template().save(using=client), deadline)
+        _step('index catalog', lambda: index_catalog.refresh(client), deadline)
+    return True
+
+
+def warmup(app, seconds: float = WARMUP_DEADLINE) -> None:
+    """
+    Warms up the process serving the given Flask app, in `seconds` at most.
+    """
+    deadline = time.monotonic() + seconds
+    if warmup_process(deadline):
+        with bounded_requests(get_es_client(), deadline, WARMUP_TIMEOUT):
+            _step('queries', lambda: run_queries(app, deadline=deadline), deadline)
+
+
+async def warmup_async(app, seconds: float = WARMUP_DEADLINE) -> None:
+    """
+    Same as `warmup`, for a Quart app. The queries run in its event loop, the rest in a thread.
+    """
+    deadline = time.monotonic() + seconds
+    if not await asyncio.to_thread(warmup_process, deadline):
+        return
+
+    start = time.perf_counter()
+    try:
+        with bounded_requests(get_es_client(), deadline, WARMUP_TIMEOUT), \
+                bounded_requests(get_async_es_client(), deadline, WARMUP_TIMEOUT):
+            await run_queries_async(app, deadline=deadline)
+    except Exception:
+        logger.warning('Warmup step queries failed', exc_info=True)
+    else:
+        logger.info('Warmup step queries took %.3fs', time.perf_counter() - start)
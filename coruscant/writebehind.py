@@ -0,0 +1,357 @@
+"""
+Write-behind mode of POST /api/measurement/add, enabled with WRITE_BEHIND=1.
+
+The validated measurements are appended to a local journal and buffered in memory, and the request returns
+right away with the id of the write. A background thread sends the buffer as a bulk request once it has
+WRITE_BEHIND_MAX_ITEMS measurements, or its oldest one has waited WRITE_BEHIND_MAX_AGE seconds. Measurements
+failing with a transient error (ES unreachable, or its queues full) stay in the buffer and are sent again.
+
+Every process (i.e. every worker of a pre-forking server) has its own buffer and journal, locked while it's
+alive. When a buffer starts, it takes over the journals of the processes that are gone, so the measurements
+accepted but not indexed before a crash or a restart are sent anyway. The status of the writes already sent is
+shared by every process through a SQLite database next to the journals, and the pending ones are read from
+the journals, so any process can answer for any write.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+from itertools import islice
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Optional
+
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND') == '1'
+JOURNAL_DIR = os.environ.get('WRITE_BEHIND_DIR', 'data/write-behind')
+MAX_ITEMS = int(os.environ.get('WRITE_BEHIND_MAX_ITEMS', 500))
+MAX_AGE = float(os.environ.get('WRITE_BEHIND_MAX_AGE', 1))  # seconds
+# fsync the journal after every write, so it survives a crash of the host and not only of the process
+FSYNC = os.environ.get('WRITE_BEHIND_FSYNC', '1') == '1'
+MAX_STATUSES = 100000  # of the writes already sent, the oldest ones are forgotten
+STATUSES_FILE = 'statuses.db'  # in the directory of the journals
+STATUSES_TIMEOUT = 5  # seconds, waiting for the lock of the database
+RETRY_DELAY = 1  # seconds, doubled after every failed attempt
+MAX_RETRY_DELAY = 30
+STOP_TIMEOUT = 10  # seconds, to send the buffer when the process exits
+
+logger = logging.getLogger(__name__)
+
+
+def retriable(result: dict[str, Any]) -> bool:
+    """
+    Whether the result of a measurement is a transient error, so it's worth sending it again.
+    """
+    return result['status'] == 429 or result['status'] >= 500
+
+
+class SharedStatuses:
+    """
+    Statuses of the writes sent by every process, in a SQLite database at `path`. Only the last `size` are kept.
+    """
+
+    def __init__(self, path: str, size: int = MAX_STATUSES):
+        self.path = path
+        self.size = size
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per call: they are used by the sender thread and the requests, and can't cross a fork
+        db = sqlite3.connect(self.path, timeout=STATUSES_TIMEOUT, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')  # the readers don't wait for the writers
+        db.execute('CREATE TABLE IF NOT EXISTS statuses (id TEXT PRIMARY KEY, status TEXT NOT NULL)')
+        return db
+
+    def record(self, statuses: dict[str, dict[str, Any]]) -> None:
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany(
+                'INSERT OR REPLACE INTO statuses (id, status) VALUES (?, ?)',
+                ((_id, json.dumps(status)) for _id, status in statuses.items())
+            )
+            db.execute('DELETE FROM statuses WHERE rowid <= (SELECT MAX(rowid) FROM statuses) - ?', (self.size,))
+            db.execute('COMMIT')
+
+    def get(self, _id: str) -> Optional[dict[str, Any]]:
+        if not os.path.exists(self.path):
+            return None
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT status FROM statuses WHERE id = ?', (_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+class WriteBuffer:
+    """
+    Buffer of the measurements accepted but not indexed yet, backed by an append-only journal in `directory`.
+
+    `send` indexes a list of measurements (JSON objects, as received by the API), returning the result of each
+    one: a dict with its HTTP `status` (201 if indexed), and its `errors` otherwise. It may raise if the whole
+    request failed.
+
+    The journal has a JSON object per line: either an accepted measurement (`{"add": id, "measurement": {...}}`),
+    or the ids of the ones already sent (`{"done": [id, ...]}`). It's emptied whenever the buffer is, and
+    rewritten with the pending measurements only after `max_items * 10` lines otherwise.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        send: Callable[[list[dict[str, Any]]], list[dict[str, Any]]],
+        max_items: int = MAX_ITEMS,
+        max_age: float = MAX_AGE,
+        fsync: bool = FSYNC
+    ):
+        self.directory = directory
+        self.send = send
+        self.max_items = max_items
+        self.max_age = max_age
+        self.fsync = fsync
+        self.statuses = SharedStatuses(os.path.join(directory, STATUSES_FILE))
+        self._reset()
+
+    def _reset(self) -> None:
+        self._lock = Lock()
+        self._send_lock = Lock()  # a single batch in flight, from the flusher or `flush`
+        self._changed = Condition(self._lock)
+        self._pending = OrderedDict()  # id -> (accepted at, measurement)
+        self._journal = None
+        self._path = None
+        self._journal_lines = 0
+        self._thread = None
+        self._stopping = False
+
+    def _write(self, *records: dict[str, Any]) -> None:
+        self._journal.write(''.join(json.dumps(record, default=str) + '\n' for record in records))
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self._journal_lines += len(records)
+
+    @staticmethod
+    def _replay(journal) -> OrderedDict:
+        pending = OrderedDict()
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:  # the last line, if the process died while writing it
+                continue
+            if 'add' in record:
+                pending[record['add']] = record['measurement']
+            for done in record.get('done', []):
+                pending.pop(done, None)
+        return pending
+
+    def start(self) -> None:
+        """
+        Opens the journal of the process, takes over the journals left by other processes, and starts the
+        thread sending the buffer. Called by the first `add` otherwise.
+        """
+        with self._lock:
+            if self._journal is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._path = os.path.join(self.directory, f'{uuid.uuid4().hex}.journal')
+            self._journal = open(self._path, 'a', encoding='utf-8')
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            for name in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, name)
+                if name.endswith('.journal') and path != self._path:
+                    self._take_over(path)
+
+            self._thread = Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _take_over(self, path: str) -> None:
+        try:
+            journal = open(path, encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with journal:
+            try:
+                fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if os.stat(path).st_ino != os.fstat(journal.fileno()).st_ino:
+                    return  # taken over, or compacted, before being locked
+            except (BlockingIOError, FileNotFoundError):  # the journal of a live process, or taken over
+                return
+
+            now = time.monotonic()
+            recovered = self._replay(journal)
+            self._write(*({'add': _id, 'measurement': item} for _id, item in recovered.items()))
+            self._pending.update((_id, (now, item)) for _id, item in recovered.items())
+            os.remove(path)
+        if recovered:
+            logger.warning('Recovered %d measurements not indexed from %s', len(recovered), path)
+
+    def add(self, measurement: dict[str, Any]) -> str:
+        """
+        Buffers a validated measurement, once written to the journal. Returns the id of the write.
+        """
+        if self._journal is None:
+            self.start()
+        _id = uuid.uuid4().hex
+        with self._lock:
+            self._write({'add': _id, 'measurement': measurement})
+            self._pending[_id] = (time.monotonic(), measurement)
+            if len(self._pending) in (1, self.max_items):  # starts the wait for max_age, or ends it
+                self._changed.notify()
+        return _id
+
+    def status(self, _id: str) -> Optional[dict[str, Any]]:
+        """
+        Status of a write accepted by any process: `pending`, `indexed` or `failed` (with its `errors`).
+        None if it's unknown.
+        """
+        with self._lock:
+            if _id in self._pending:
+                return {'status': 'pending'}
+        # The statuses are recorded before the writes leave the journals, so these are read first
+        if self._pending_elsewhere(_id):
+            return {'status': 'pending'}
+        return self.statuses.get(_id)
+
+    def _pending_elsewhere(self, _id: str) -> bool:
+        """
+        Whether the write is pending in the journal of another process.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return False
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.journal') or path == self._path:
+                continue
+            try:
+                with open(path, encoding='utf-8') as journal:
+                    if _id in self._replay(journal):
+                        return True
+            except FileNotFoundError:  # taken over, or compacted
+                continue
+        return False
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _due(self) -> Optional[float]:
+        """
+        Seconds until the buffer has to be sent, 0 if it's due, or None if it's empty.
+        """
+        if not self._pending:
+            return None
+        if len(self._pending) >= self.max_items or self._stopping:
+            return 0
+        accepted, _ = next(iter(self._pending.values()))
+        return max(0, accepted + self.max_age - time.monotonic())
+
+    def _send_batch(self) -> bool:
+        """
+        Sends the oldest `max_items` pending measurements. Returns False if some have to be sent again.
+        """
+        with self._lock:
+            batch = [(_id, item) for _id, (_, item) in islice(self._pending.items(), self.max_items)]
+        if not batch:
+            return True
+
+        try:
+            results = self.send([dict(item) for _, item in batch])
+        except Exception:
+            logger.exception('Could not send %d buffered measurements, retrying', len(batch))
+            return False
+
+        statuses = {}
+        for (_id, _), result in zip(batch, results):
+            if retriable(result):
+                continue
+            if result['status'] < 300:
+                statuses[_id] = {'status': 'indexed'}
+            else:
+                statuses[_id] = {'status': 'failed', 'errors': result.get('errors', [])}
+        if statuses:
+            try:
+                self.statuses.record(statuses)
+            except sqlite3.Error:
+                logger.exception('Could not record the status of %d writes', len(statuses))
+
+        with self._lock:
+            done = list(statuses)
+            for _id in done:
+                del self._pending[_id]
+
+            if not self._pending:
+                self._journal.truncate(0)
+                self._journal_lines = 0
+            else:
+                self._write({'done': done})
+                if self._journal_lines > self.max_items * 10:
+                    self._compact()
+        return len(done) == len(batch)
+
+    def _compact(self) -> None:
+        # The new journal is locked before replacing the old one, so it can't be taken over meanwhile
+        journal = open(f'{self._path}.tmp', 'w', encoding='utf-8')
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        previous, self._journal, self._journal_lines = self._journal, journal, 0
+        self._write(*({'add': _id, 'measurement': item} for _id, (_, item) in self._pending.items()))
+        os.replace(f'{self._path}.tmp', self._path)
+        previous.close()
+
+    def flush(self) -> bool:
+        """
+        Sends every pending measurement now, in the calling thread. Returns False if some are still pending.
+        """
+        with self._send_lock:
+            while self.pending():
+                if not self._send_batch():
+                    return False
+            return True
+
+    def _run(self) -> None:
+        retry_delay = 0
+        while True:
+            with self._lock:
+                if retry_delay:
+                    self._changed.wait_for(lambda: self._stopping, retry_delay)
+                due = self._due()
+                while due != 0:
+                    if due is None and self._stopping:
+                        return
+                    self._changed.wait(due)
+                    due = self._due()
+
+            with self._send_lock:
+                sent = self._send_batch()
+            if sent:
+                retry_delay = 0
+            elif self._stopping:
+                return
+            else:
+                retry_delay = min(MAX_RETRY_DELAY, max(RETRY_DELAY, retry_delay * 2))
+
+    def stop(self, timeout: float = STOP_TIMEOUT) -> None:
+        """
+        Sends the buffer, and stops the thread. What can't be sent stays in the journal, for the next start.
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._changed.notify()
+        self._thread.join(timeout)
+
+
+def _index_measurements(measurements: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    from coruscant.api import index_buffered  # the API imports this module
+
+    return index_buffered(measurements)
+
+
+write_buffer = WriteBuffer(JOURNAL_DIR, _index_measurements)
+
+# The buffer of the parent belongs to its journal: a forked worker starts its own
+os.register_at_fork(after_in_child=write_buffer._reset)
@@ -0,0 +1,27 @@
+import time
+from argparse import ArgumentParser
+
+from coruscant.loader import PATH_TO_FILE
+from coruscant.snapshot import convert_csv
+
+SNAPSHOT_FILE = 'data/GlobalLandTemperaturesByCity.snapshot'
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description='Converts the temperatures CSV into a binary snapshot, that initial-load.py and the local '
+                    'backend read without parsing it'
+    )
+    parser.add_argument('--file', default=PATH_TO_FILE, help='CSV file to convert')
+    parser.add_argument('--output', default=SNAPSHOT_FILE, help='Snapshot file to write')
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    start = time.monotonic()
+    rows = convert_csv(args.file, args.output)
+    print(f'Wrote {rows} rows to {args.output} in {time.monotonic() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,33 @@
+"""
+Production settings of the Flask app: `gunicorn app:app` (this file is read from the working directory).
+
+The app is imported once by the master and forked into the workers (preload_app), which share the memory
+of the imported modules. Importing it doesn't connect to Elasticsearch: every worker creates its own client
+on first use (see coruscant.es.get_es_client), and warms up before accepting requests (see coruscant.warmup).
+The query cache is per worker too, but writes invalidate the caches of every worker (see coruscant.cache).
+The handlers mostly wait for ES, so every worker serves WEB_THREADS requests at the same time.
+"""
+import multiprocessing
+import os
+
+from coruscant.warmup import WARMUP_DEADLINE, warmup
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+preload_app = True
+# Workers are restarted after serving that many requests (plus up to the jitter), so memory can't grow forever
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+# Also applies to the warmup, as a worker doesn't report to the master until it's done: the warmup is cut to
+# half of it, or the worker would be killed and restarted, warming up again, for as long as ES is slow
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = 30  # longer than the write-behind buffer needs to be sent on exit
+keepalive = 5
+accesslog = os.environ.get('WEB_ACCESS_LOG')
+
+
+def post_worker_init(worker):
+    # Called once the worker has loaded the app, before it accepts requests
+    warmup(worker.wsgi, min(WARMUP_DEADLINE, timeout / 2))
@@ -1,99 +1,92 @@
-from csv import DictReader
-from datetime import datetime
-from decimal import Decimal
-from typing import Any, Iterable, Optional
+from argparse import ArgumentParser
 
-from elasticsearch.helpers import bulk
 from elasticsearch_dsl import connections
 
-from coruscant.documents import Measurement
+from coruscant import rollups
 from coruscant.es import ES_HOST
-
-PATH_TO_FILE = 'data/GlobalLandTemperaturesByCity.csv'
-CHUNK_SIZE = 10000
-
-
-def generate_es_document(obj: dict[str: Any]) -> Measurement:
-    """
-    Converts the obj containing the CSV data into the dictionary that will
-    conform the ES document
-    """
-
-    def convert_latitude_longitude(lat: str, lon: str) -> dict[str: Decimal]:
-        """
-        Helper method to convert latitude and longitude data into a single dictionary.
-        This will help ES understand it's a geopoint data field.
-        """
-        location = {}
-        if lat.endswith('N'):
-            location['lat'] = Decimal(lat.replace('N', ''))
-        else:
-            location['lat'] = Decimal(f'-{lat.replace("S", "")}')
-        if lon.endswith('E'):
-            location['lon'] = Decimal(lon.replace('E', ''))
-        else:
-            location['lon'] = Decimal(f'-{lon.replace("W", "")}')
-
-        return location
-
-    def clean_temperature(temp: str) -> Optional[Decimal]:
-        """
-        To prevent python issues with float accuracy, I'm using decimal here
-        """
-        if temp == '':
-            return None
-        else:
-            return Decimal(temp)
-
-    measurement = Measurement(
-        day=datetime.strptime(obj['dt'], '%Y-%m-%d').date(),
-        average_temperature=clean_temperature(obj['AverageTemperature']),
-        average_temperature_uncertainty=clean_temperature(obj['AverageTemperatureUncertainty']),
-        city=obj['City'],
-        country=obj['Country'],
-        location=convert_latitude_longitude(obj['Latitude'], obj['Longitude'])
+from coruscant.loader import (
+    CHUNK_SIZE,
+    DEFAULT_MAX_IN_FLIGHT,
+    DEFAULT_SENDERS,
+    DEFAULT_WORKERS,
+    MAX_RETRIES,
+    PATH_TO_FILE,
+    Checkpoint,
+    bulk_load_mode,
+    parallel_load,
+    serial_load
+)
+
+
+def parse_args():
+    parser = ArgumentParser(description='Loads the temperatures CSV into Elasticsearch')
+    parser.add_argument('--file', default=PATH_TO_FILE, help='CSV file (or snapshot) to load')
+    parser.add_argument(
+        '--parallel', action='store_true',
+        help='Convert rows in a process pool and send them with concurrent bulk requests'
     )
-    measurement.meta.index = measurement.day.strftime('global_land_temperatures_by_city-%Y')
-
-    return measurement
-
-
-def docs_from_csv(filename: str, chunk_size: int = CHUNK_SIZE) -> Iterable[dict[str:Any]]:
-    """
-    Generate our ES document based on the content of the given CSV file.
-
-    As the file is very large (over 8M rows), I'm using iterators to chunk the processing. This way, we
-    can create 10k documents in a single ES request, rather than one request per document.
-    """
-    with open(filename, 'r') as csv_file:
-        reader = DictReader(csv_file)
-        current_chunk = []
-        for row in reader:
-            doc = generate_es_document(row)
-            current_chunk.append(doc.to_dict(True))
-            if len(current_chunk) >= chunk_size:
-                yield current_chunk
-                current_chunk = []
-        if current_chunk:
-            yield current_chunk
-
-
-def main() -> None:
-    i = 0
-
-    # We batch the insert for performance reasons
-    for rows in docs_from_csv(PATH_TO_FILE):
-        bulk(connections.get_connection(), rows)
-        i += 1
-
-        print(f'Inserted {i * CHUNK_SIZE} documents')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of converter processes')
+    parser.add_argument('--senders', type=int, default=DEFAULT_SENDERS, help='Number of concurrent bulk senders')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Documents per bulk request')
+    parser.add_argument(
+        '--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+        help='Maximum number of CSV shards being converted or sent at the same time'
+    )
+    parser.add_argument(
+        '--checkpoint', help='File where the load progress is stored. Defaults to the CSV file name + .checkpoint'
+    )
+    parser.add_argument('--resume', action='store_true', help='Resume the load from the last checkpoint')
+    parser.add_argument(
+        '--max-retries', type=int, default=MAX_RETRIES, help='Retries for documents failing to be indexed'
+    )
+    parser.add_argument(
+        '--skip-force-merge', action='store_true', help='Do not force merge the historical years after loading'
+    )
+    parser.add_argument(
+        '--skip-rollups', action='store_true', help='Do not rebuild the hottest measurement rollups after loading'
+    )
+    return parser.parse_args()
+
+
+def load(args) -> None:
+    checkpoint = Checkpoint(args.checkpoint or f'{args.file}.checkpoint', args.file)
+
+    if args.parallel:
+        parallel_load(
+            connections.get_connection(),
+            filename=args.file,
+            workers=args.workers,
+            senders=args.senders,
+            chunk_size=args.chunk_size,
+            max_in_flight=args.max_in_flight,
+            checkpoint=checkpoint,
+            resume=args.resume,
+            max_retries=args.max_retries
+        )
+    else:
+        serial_load(
+            connections.get_connection(),
+            filename=args.file,
+            chunk_size=args.chunk_size,
+            checkpoint=checkpoint,
+            resume=args.resume,
+            max_retries=args.max_retries
+        )
+
+
+def main(args) -> None:
+    # The indexes are switched to the bulk load settings (no refreshes nor replicas) while loading
+    with bulk_load_mode(connections.get_connection(), force_merge=not args.skip_force_merge):
+        load(args)
+
+    if not args.skip_rollups:
+        rollups.backfill(connections.get_connection(), args.chunk_size)
 
 
 if __name__ == '__main__':
-    # ES setup
-    connections.create_connection(hosts=[ES_HOST], timeout=20)
+    args = parse_args()
 
-    measurements = Measurement._index.as_template('global_land_temperatures_by_city', order=0)
-    measurements.save()
+    # ES setup
+    connections.create_connection(hosts=[ES_HOST], timeout=20, maxsize=args.senders)
 
-    main()
+    main(args)
@@ -0,0 +1,41 @@
+from argparse import ArgumentParser
+
+from elasticsearch_dsl import connections
+
+from coruscant.documents import Measurement
+from coruscant.es import ES_HOST
+from coruscant.migration import migrate, migration_plan
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description='Moves the measurements into the indexes of the current layout (yearly indexes since '
+                    'INDEX_HOT_SINCE, one index per decade before)'
+    )
+    parser.add_argument('--dry-run', action='store_true', help='Only print the indexes that would be reindexed')
+    parser.add_argument(
+        '--keep-sources', action='store_true', help='Do not delete the indexes left out of the layout'
+    )
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    client = connections.get_connection()
+    if args.dry_run:
+        plan = migration_plan(client.indices.get_alias(index=Measurement.Index.name))
+    else:
+        plan = migrate(client, delete_sources=not args.keep_sources)
+
+    for target, sources in plan.items():
+        print(f'{target} <- {", ".join(sources)}')
+    if not plan:
+        print(f'Every index already follows the layout (hot since {Measurement.layout.hot_since})')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # ES setup
+    connections.create_connection(hosts=[ES_HOST], timeout=20)
+
+    main(args)
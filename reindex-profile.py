@@ -0,0 +1,38 @@
+from argparse import ArgumentParser
+
+from elasticsearch_dsl import connections
+
+from coruscant.documents import INDEX_PROFILE, Measurement
+from coruscant.es import ES_HOST
+from coruscant.migration import profile_plan, reindex_profile
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description='Rebuilds the measurement indexes with the mapping and settings of the INDEX_PROFILE profile '
+                    '(standard or optimized)'
+    )
+    parser.add_argument('--dry-run', action='store_true', help='Only print the indexes that would be rebuilt')
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    client = connections.get_connection()
+    if args.dry_run:
+        plan = profile_plan(client.indices.get(index=Measurement.Index.name, allow_no_indices=True))
+    else:
+        plan = reindex_profile(client)
+
+    for index in plan:
+        print(index)
+    if not plan:
+        print(f'Every index already follows the {INDEX_PROFILE} profile')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # ES setup
+    connections.create_connection(hosts=[ES_HOST], timeout=20)
+
+    main(args)
@@ -0,0 +1,173 @@
+import json
+import urllib
+from unittest.mock import patch
+
+import pytest
+
+from app_local import app
+from coruscant.columnar import ColumnarStore
+from tests.api_test import BULK_MEASUREMENT
+from tests.columnar_test import ROWS
+
+AHVAZ = {
+    'day': 'Mon, 01 Jul 2013 00:00:00 GMT',
+    'average_temperature': 39.156,
+    'average_temperature_uncertainty': 0.37,
+    'city': 'Ahvaz',
+    'country': 'Iran',
+    'location': {'lat': 31.35, 'lon': 49.01}
+}
+
+
+@pytest.fixture
+def client():
+    with patch('coruscant.api_local._store', ColumnarStore.from_rows(ROWS)):
+        with app.test_client() as client:
+            yield client
+
+
+def test_add_measurement(client):
+    resp = client.post('/api/measurement/add', json=BULK_MEASUREMENT)
+
+    assert resp.status_code == 201
+    assert resp.json == {**BULK_MEASUREMENT, 'day': 'Sun, 01 Aug 2021 00:00:00 GMT'}
+    assert client.get('/api/measurements?cities=1').json['cities'] == [{**BULK_MEASUREMENT, 'day': '2021-08-01'}]
+
+
+def test_add_invalid_measurement(client):
+    resp = client.post('/api/measurement/add', json={**BULK_MEASUREMENT, 'day': '202108-01'})
+
+    assert resp.status_code == 400
+    assert resp.json == {'errors': ['Invalid date format for day']}
+
+
+@pytest.mark.parametrize('params, payload, result, status_code', [
+    (
+        {'city': 'Ahvaz', 'day': '2013-07-01'},
+        {'average_temperature': 40.2},
+        {**AHVAZ, 'average_temperature': 40.2},
+        200
+    ),
+    (
+        {'city': 'Ahvaz'},
+        {'average_temperature': 40.2},
+        {'errors': ['city and day fields required as URL params']},
+        400
+    ),
+    (
+        {'city': 'Ahvaz', 'day': '2013-07-01'},
+        {'somethingelse': 40.2},
+        {'errors': ['Please, provide either average_temperature or average_temperature_uncertainty']},
+        400
+    ),
+    (
+        {'city': 'Ahvaz', 'day': '2013-07-01'},
+        {'average_temperature': 'hot'},
+        {'errors': ['average_temperature must be a float']},
+        400
+    ),
+    (
+        {'city': 'Ahvaz', 'day': '2013-07-1x'},
+        {'average_temperature': 40.2},
+        {'errors': ['Invalid date format for day']},
+        400
+    ),
+    (
+        {'city': 'Ahvaz', 'day': '2013-06-01'},
+        {'average_temperature': 40.2},
+        {'errors': ['Could not find the document']},
+        404
+    )
+])
+def test_update_measurement(client, params, payload, result, status_code):
+    resp = client.patch(f'/api/measurement/update?{urllib.parse.urlencode(params)}', json=payload)
+
+    assert resp.status_code == status_code
+    assert resp.json == result
+
+
+@pytest.mark.parametrize('params, cities', [
+    ({}, ['Ahvaz', 'Abadan', 'London']),
+    ({'cities': 1}, ['Ahvaz']),
+    ({'from': '2013-01-01'}, ['Ahvaz']),
+    ({'from': '1800-01-01', 'to': '1900-01-01'}, ['London']),
+    ({'order': 'asc'}, ['London', 'Ahvaz', 'Abadan']),
+    ({'country': 'Iran'}, ['Ahvaz', 'Abadan']),
+    ({'country': 'Spain'}, []),
+    ({'max_uncertainty': '0.35'}, ['Ahvaz']),
+    ({'min_uncertainty': '0.4'}, ['Abadan']),
+])
+def test_measurements_list(client, params, cities):
+    resp = client.get(f'/api/measurements?{urllib.parse.urlencode(params)}')
+
+    assert resp.status_code == 200
+    assert [measurement['city'] for measurement in resp.json['cities']] == cities
+
+
+def test_measurements_pagination(client):
+    first = client.get('/api/measurements?cities=2').json
+    second = client.get(f'/api/measurements?cities=2&cursor={first["cursor"]}').json
+
+    assert [measurement['city'] for measurement in first['cities'] + second['cities']] == ['Ahvaz', 'Abadan', 'London']
+    assert second['cursor'] is None
+
+
+@pytest.mark.parametrize('params', [
+    {'cities': 'a'}, {'from': 'xxxxx'}, {'from': '2020-02-28', 'to': '2019-05-01'}, {'order': 'up'}, {'cursor': 'x'}
+])
+def test_invalid_measurements_list(client, params):
+    resp = client.get(f'/api/measurements?{urllib.parse.urlencode(params)}')
+    assert resp.status_code == 400
+
+
+def test_convert_response(client):
+    resp = client.get('/api/measurements?cities=1')
+    assert resp.json['cities'] == [{**AHVAZ, 'day': '2013-07-01'}]
+    assert resp.json['cursor']
+
+
+@pytest.mark.parametrize('ndjson', [False, True])
+def test_measurements_bulk(client, ndjson):
+    items = [
+        {**BULK_MEASUREMENT, 'day': '2021-08-01'},
+        {**BULK_MEASUREMENT, 'day': '202108-01'},
+        'nope',
+    ]
+
+    if ndjson:
+        data = '\n'.join(json.dumps(item) for item in items)
+        resp = client.post('/api/measurements/bulk', data=data, content_type='application/x-ndjson')
+    else:
+        resp = client.post('/api/measurements/bulk', json=items)
+
+    assert resp.status_code == 200
+    assert resp.json == {'errors': True, 'items': [
+        {'status': 201, 'measurement': {**BULK_MEASUREMENT, 'day': 'Sun, 01 Aug 2021 00:00:00 GMT'}},
+        {'status': 400, 'errors': ['Invalid date format for day']},
+        {'status': 400, 'errors': ['Invalid measurement, it must be a JSON object']},
+    ]}
+
+
+def test_measurements_bulk_invalid_body(client):
+    resp = client.post('/api/measurements/bulk', json={'average_temperature': 41})
+    assert resp.status_code == 400
+    assert resp.json == {'errors': ['Please, provide a JSON array or NDJSON with the measurements']}
+
+
+def test_measurements_bulk_update(client):
+    resp = client.patch('/api/measurements/bulk', json=[
+        {'city': 'Ahvaz', 'country': 'Iran', 'day': '2013-07-01', 'average_temperature': 10.0},
+        {'city': 'Ahvaz', 'country': 'Spain', 'day': '2013-07-01', 'average_temperature': 10.0},
+        {'city': 'Ahvaz', 'day': '2013-07-01'},
+    ])
+
+    assert resp.status_code == 200
+    assert resp.json == {'errors': True, 'items': [
+        {'status': 200, 'measurement': {**AHVAZ, 'average_temperature': 10.0}},
+        {'status': 404, 'errors': ['Could not find the document']},
+        {'status': 400, 'errors': [
+            'Missing field country',
+            'Please, provide either average_temperature or average_temperature_uncertainty'
+        ]},
+    ]}
+    assert client.get('/api/measurements?cities=1').json['cities'][0]['city'] == 'Abadan'
@@ -1,14 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from threading import Event
 from unittest.mock import patch, Mock
+import asyncio
+import base64
+import json
+import time
 import urllib
 
 import pytest
-from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import ConnectionError, NotFoundError
 
+from app import app
+from app_async import app as async_app
+from coruscant import api, rollups
+from coruscant.cache import measurements_flights
+from coruscant.documents import Measurement
+from coruscant.indexes import index_catalog
+from coruscant.writebehind import WriteBuffer
+
+MEASUREMENT_FIELDS = ['day', 'average_temperature', 'average_temperature_uncertainty', 'city', 'country', 'location']
 BASE_REQUEST_BODY = {
     'collapse': {'field': 'city'},
-    'sort': [{"average_temperature": "desc"}],
-    'size': 10
+    'sort': [{"average_temperature": "desc"}, {"city": "asc"}],
+    'size': 10,
+    '_source': MEASUREMENT_FIELDS
 }
+ROLLUP_INDEX = 'global_land_temperatures_by_city_rollup'
+
+
+def rollup_request_body(years, *partial_ranges, size=10):
+    """
+    Expected body for a query reading the full `years` from the rollups, and the partial years from the
+    yearly indexes.
+    """
+    year_rollups = [{'term': {'period': 'year'}}]
+    if years:
+        year_rollups.append({'range': {'year': years}})
+    clauses = [{'bool': {'filter': year_rollups}}]
+    for gte, lte in partial_ranges:
+        clauses.append({'bool': {
+            'filter': [{'range': {'day': {'gte': gte, 'lte': lte}}}],
+            'must_not': [{'exists': {'field': 'period'}}]
+        }})
+
+    return {
+        **BASE_REQUEST_BODY,
+        'size': size,
+        'query': {'bool': {'should': clauses, 'minimum_should_match': 1}}
+    }
 
 
 @pytest.mark.parametrize('obj, result, status_code', [
@@ -100,16 +140,56 @@ BASE_REQUEST_BODY = {
         400
     )
 ])
+@patch('coruscant.api.rollups.measurements_updated')
 @patch('coruscant.api.Measurement.save')
-def test_add_measurement(m_measurement_save, client, obj, result, status_code):
-    resp = client.post('/api/measurement/add', json=obj)
+def test_add_measurement(
+    m_measurement_save, m_measurements_updated, backend, backend_client, obj, result, status_code
+):
+    resp = backend_client.post('/api/measurement/add', json=obj)
 
-    if status_code == 201:
-        m_measurement_save.assert_called_once_with()
+    if backend == 'columnar':
+        m_measurement_save.assert_not_called()
+    elif status_code == 201:
+        m_measurement_save.assert_called_once_with(request_timeout=10)
+        assert m_measurements_updated.call_args.args[1][0]['average_temperature'] == obj['average_temperature']
+    else:
+        m_measurements_updated.assert_not_called()
     assert resp.status_code == status_code
     assert resp.json == result
 
 
+@patch('coruscant.rollups.bulk')
+@patch('coruscant.rollups.recompute')
+@patch('coruscant.api.Measurement.save')
+@patch('coruscant.api.get_es_client')
+def test_add_measurement_overwrites_hotter(m_es_client, m_measurement_save, m_recompute, m_bulk, client):
+    # The same city and day was stored hotter, and is the hottest of its year and month
+    hotter = rollups.rollup_documents({**BULK_MEASUREMENT, 'average_temperature': 45})
+    m_es_client.return_value.mget.return_value = {'docs': [
+        {'_id': rollups._rollup_id(doc), 'found': True, '_source': doc} for doc in hotter
+    ]}
+
+    resp = client.post('/api/measurement/add', json=BULK_MEASUREMENT)
+
+    assert resp.status_code == 201
+    m_recompute.assert_called_once_with(m_es_client.return_value, 'Jerez', date(2021, 8, 1))
+    m_bulk.assert_not_called()
+
+
+@patch('coruscant.api.measurements_cache')
+@patch('coruscant.api.Measurement.save')
+@patch('coruscant.api.get_es_client')
+def test_add_measurement_rollups_failing(m_es_client, m_measurement_save, m_cache, client):
+    # The measurement has been written, so the add succeeds and its year is invalidated anyway
+    m_es_client.return_value.mget.side_effect = ConnectionError
+
+    resp = client.post('/api/measurement/add', json=BULK_MEASUREMENT)
+
+    assert resp.status_code == 201
+    m_cache.invalidate_year.assert_called_once_with(2021)
+    assert 'global_land_temperatures_by_city-2021' in index_catalog.indexes()
+
+
 @patch('coruscant.api.Measurement.save')
 def test_add_measurement_es_not_responding(m_measurement_save, client):
     m_measurement_save.side_effect = ConnectionError
@@ -152,36 +232,6 @@ def test_add_measurement_es_not_responding(m_measurement_save, client):
         },
         200
     ),
-    (
-        None,
-        None,
-        {
-            'average_temperature': 40.2
-        },
-        [],
-        {'errors': ['city and day fields required as URL params']},
-        400
-    ),
-    (
-        "Jerez",
-        None,
-        {
-            'average_temperature': 40.2
-        },
-        [],
-        {'errors': ['city and day fields required as URL params']},
-        400
-    ),
-    (
-        'Ahvaz',
-        '2013-07-01',
-        {
-            'somethingelse': 40.2
-        },
-        [],
-        {'errors': ['Please, provide either average_temperature or average_temperature_uncertainty']},
-        400
-    ),
     (
         'Ahvaz',
         '2013-07-01',
@@ -193,8 +243,11 @@ def test_add_measurement_es_not_responding(m_measurement_save, client):
         404
     )
 ])
+@patch('coruscant.api.rollups.measurement_updated')
 @patch('coruscant.api.Measurement.search')
-def test_update_measurement(m_measurement_search, client, city, day, payload, objects, result, status_code):
+def test_update_measurement(
+    m_measurement_search, m_measurement_updated, client, city, day, payload, objects, result, status_code
+):
     hits = []
     for data in objects:
         obj = Mock()
@@ -227,6 +280,65 @@ def test_update_measurement(m_measurement_search, client, city, day, payload, ob
 
     assert resp.status_code == status_code
     assert resp.json == result
+    assert m_measurement_updated.called == (status_code == 200)
+
+
+@pytest.mark.parametrize('params, payload, error', [
+    ({}, {'average_temperature': 40.2}, 'city and day fields required as URL params'),
+    ({'city': 'Jerez'}, {'average_temperature': 40.2}, 'city and day fields required as URL params'),
+    (
+        {'city': 'Ahvaz', 'day': '2013-07-01'},
+        {'somethingelse': 40.2},
+        'Please, provide either average_temperature or average_temperature_uncertainty'
+    ),
+    ({'city': 'Ahvaz', 'day': '2013-07-1x'}, {'average_temperature': 40.2}, 'Invalid date format for day'),
+    ({'city': 'Ahvaz', 'day': '2013-07-01'}, {'average_temperature': 'hot'}, 'average_temperature must be a float'),
+])
+@patch('coruscant.api.Measurement.search')
+def test_invalid_update(m_measurement_search, backend_client, params, payload, error):
+    resp = backend_client.patch(f'/api/measurement/update?{urllib.parse.urlencode(params)}', json=payload)
+
+    assert resp.status_code == 400
+    assert resp.json == {'errors': [error]}
+    m_measurement_search.assert_not_called()
+
+
+@pytest.mark.parametrize('payload, fields, status_code', [
+    ({'average_temperature': '40'}, {'average_temperature': 40.0}, 200),
+    ({'average_temperature': 40, 'average_temperature_uncertainty': '0.5'},
+     {'average_temperature': 40.0, 'average_temperature_uncertainty': 0.5}, 200),
+    ({'average_temperature': 'hot'}, None, 400),
+    ({'average_temperature_uncertainty': None}, None, 400),
+])
+@patch('coruscant.api.rollups.measurement_updated')
+@patch('coruscant.api.Measurement.update', autospec=True)
+@patch('coruscant.api.Measurement.search')
+def test_update_measurement_temperatures(
+    m_measurement_search, m_measurement_update, m_measurement_updated, client, payload, fields, status_code
+):
+    def update(measurement, **fields):
+        for field, value in fields.items():
+            setattr(measurement, field, value)
+
+    m_measurement_update.side_effect = update
+    hit = Measurement(
+        meta={'id': 'x', 'index': 'global_land_temperatures_by_city-2013'},
+        city='Ahvaz', day='2013-07-01', average_temperature=39.1, average_temperature_uncertainty=0.37
+    )
+    m_measurement_search.return_value.params.return_value.filter.return_value.filter.return_value \
+        .execute.return_value.hits = [hit]
+
+    resp = client.patch('/api/measurement/update?city=Ahvaz&day=2013-07-01', json=payload)
+
+    assert resp.status_code == status_code
+    if fields:
+        # The rollups compare the temperatures, they would fail with strings
+        _, previous, current = m_measurement_updated.call_args.args
+        assert previous['average_temperature'] == 39.1
+        assert {field: current[field] for field in fields} == fields
+    else:
+        assert resp.json['errors'][0].endswith('must be a float')
+        m_measurement_search.assert_not_called()
 
 
 @patch('coruscant.api.Measurement.search')
@@ -253,7 +365,7 @@ def test_update_measurement_es_not_responding(m_measurement_search, client):
 @patch('coruscant.api.get_es_client')
 def test_get_measurements_size(m_es_client, client, cities):
     path = '/api/measurements'
-    body = BASE_REQUEST_BODY.copy()
+    body = rollup_request_body({})
     if cities:
         path = f'{path}?cities={cities}'
         body['size'] = cities
@@ -262,9 +374,10 @@ def test_get_measurements_size(m_es_client, client, cities):
     assert resp.status_code == 200
 
     m_es_client.return_value.search.assert_called_once_with(
-        index='global_land_temperatures_by_city-*',
+        index=ROLLUP_INDEX,
         body=body,
-        ignore_unavailable=True
+        ignore_unavailable=True,
+        request_timeout=10
     )
 
 
@@ -272,18 +385,15 @@ def test_get_measurements_size(m_es_client, client, cities):
     'a',
     '121a'
 ])
-def test_get_invalid_measurements_size(client, cities):
+def test_get_invalid_measurements_size(backend_client, cities):
     path = f'/api/measurements?cities={cities}'
-    resp = client.get(path)
+    resp = backend_client.get(path)
     assert resp.status_code == 400
 
 
 @pytest.mark.parametrize('from_d, to_d, indexes', [
     ('2019-01-01', '2019-05-01', ['2019']),
-    ('2018-01-01', '2020-04-07', ['2018', '2019', '2020']),
-    ('2018-01-01', None, ['2018', '2019', '2020', '2021', '2022']),
-    (None, '2018-01-01', [str(y) for y in range(1500, 2019)]),
-    (None, None, None),
+    ('2018-03-01', '2019-04-07', ['2018', '2019']),
 ])
 @patch('coruscant.api.get_es_client')
 def test_date_range_to_es_index(m_es_client, client, from_d, to_d, indexes):
@@ -298,7 +408,9 @@ def test_date_range_to_es_index(m_es_client, client, from_d, to_d, indexes):
         params['to'] = to_d
         date_range['lte'] = to_d
     if from_d or to_d:
-        body['query'] = {'range': {'day': date_range}}
+        body['query'] = {'bool': {'filter': [
+            {'range': {'day': date_range}}, {'exists': {'field': 'average_temperature'}}
+        ]}}
 
     path = '/api/measurements'
     if params:
@@ -315,19 +427,108 @@ def test_date_range_to_es_index(m_es_client, client, from_d, to_d, indexes):
     m_es_client.return_value.search.assert_called_once_with(
         index=final_indexes,
         body=body,
-        ignore_unavailable=True
+        ignore_unavailable=True,
+        request_timeout=10
     )
 
 
+@pytest.mark.parametrize('from_d, to_d, indexes, body', [
+    (
+        '2018-01-01', '2020-04-07',
+        [ROLLUP_INDEX, 'global_land_temperatures_by_city-2020'],
+        rollup_request_body({'gte': 2018, 'lte': 2019}, ('2020-01-01', '2020-04-07'))
+    ),
+    (
+        '2018-03-01', '2020-12-31',
+        [ROLLUP_INDEX, 'global_land_temperatures_by_city-2018'],
+        rollup_request_body({'gte': 2019, 'lte': 2020}, ('2018-03-01', '2018-12-31'))
+    ),
+    (
+        '2017-06-01', '2020-04-07',
+        [ROLLUP_INDEX, 'global_land_temperatures_by_city-2017', 'global_land_temperatures_by_city-2020'],
+        rollup_request_body(
+            {'gte': 2018, 'lte': 2019}, ('2017-06-01', '2017-12-31'), ('2020-01-01', '2020-04-07')
+        )
+    ),
+    (
+        '2018-01-01', None,
+        [ROLLUP_INDEX],
+        rollup_request_body({'gte': 2018})
+    ),
+    (
+        None, '2018-01-01',
+        [ROLLUP_INDEX, 'global_land_temperatures_by_city-2018'],
+        rollup_request_body({'lte': 2017}, ('2018-01-01', '2018-01-01'))
+    ),
+    (
+        None, None,
+        [ROLLUP_INDEX],
+        rollup_request_body({})
+    ),
+])
+@patch('coruscant.api.get_es_client')
+def test_full_years_from_rollups(m_es_client, client, from_d, to_d, indexes, body):
+    params = {}
+    if from_d:
+        params['from'] = from_d
+    if to_d:
+        params['to'] = to_d
+
+    resp = client.get(f'/api/measurements?{urllib.parse.urlencode(params)}')
+    assert resp.status_code == 200
+
+    m_es_client.return_value.search.assert_called_once_with(
+        index=','.join(indexes),
+        body=body,
+        ignore_unavailable=True,
+        request_timeout=10
+    )
+
+
+@patch('coruscant.api.get_es_client')
+def test_full_years_before_rollups_backfill(m_es_client, client):
+    index_catalog.update(['global_land_temperatures_by_city-2018', 'global_land_temperatures_by_city-2019'])
+    assert not index_catalog.rollups_ready()
+
+    resp = client.get('/api/measurements?from=2018-01-01&to=2019-12-31')
+    assert resp.status_code == 200
+    search = m_es_client.return_value.search.call_args.kwargs
+    assert ROLLUP_INDEX not in search['index']
+    assert search['body']['query'] == {'bool': {'filter': [
+        {'range': {'day': {'gte': '2018-01-01', 'lte': '2019-12-31'}}},
+        {'exists': {'field': 'average_temperature'}}
+    ]}}
+
+
+@patch('coruscant.api.get_es_client')
+def test_index_catalog_refresh(m_es_client, client):
+    index_catalog.clear()
+    m_es_client.return_value.indices.get_alias.return_value = {
+        'global_land_temperatures_by_city-2012': {},
+        'global_land_temperatures_by_city-2013': {},
+        'global_land_temperatures_by_city-2020': {},
+    }
+
+    for to_d in ('2013-04-07', '2013-05-07'):
+        resp = client.get(f'/api/measurements?from=2012-03-01&to={to_d}')
+        assert resp.status_code == 200
+    m_es_client.return_value.indices.get_alias.assert_called_once_with(
+        index='global_land_temperatures_by_city-*,global_land_temperatures_by_city_rollup*'
+    )
+
+    # Every existing index from 201x is in the range
+    assert m_es_client.return_value.search.call_args.kwargs['index'] == 'global_land_temperatures_by_city-201*'
+
+
 @pytest.mark.parametrize('from_d, to_d', [
     ('2019-02-30', '2019-05-01'),
     ('xxxxx', '2020-04-07'),
     ('2020-02-28', '2019-05-01')
 ])
-def test_invalid_date_range_to_es_index(client, from_d, to_d):
+def test_invalid_date_range_to_es_index(backend_client, from_d, to_d):
     params = {'from': from_d, 'to': to_d}
     path = f'/api/measurements?{urllib.parse.urlencode(params)}'
-    resp = client.get(path)
+    resp = backend_client.get(path)
     assert resp.status_code == 400
 
 
@@ -538,9 +739,196 @@ def test_convert_es_response(m_es_client, client):
                     "lon": 44.78
                 }
             },
-        ]
+        ],
+        "cursor": None
+    }
+
+
+RANKING = [
+    {'city': 'Ahvaz', 'average_temperature': 39.156},
+    {'city': 'Masjed E Soleyman', 'average_temperature': 39.156},
+    {'city': 'Abadan', 'average_temperature': 38.531},
+    {'city': 'Khorramshahr', 'average_temperature': 38.531},
+    {'city': 'Buraydah', 'average_temperature': 38.049},
+]
+
+
+@patch('coruscant.api.get_es_client')
+def test_measurements_pagination(m_es_client, client):
+    m_es_client.return_value.search.side_effect = [
+        {'hits': {'hits': [{'_source': city} for city in RANKING[:2]]}},
+        {'hits': {'hits': [{'_source': city} for city in RANKING]}},
+    ]
+
+    pages, cursors = [], [None]
+    while len(pages) < 5:
+        resp = client.get(f'/api/measurements?{urllib.parse.urlencode({"cities": 2, "cursor": cursors[-1] or ""})}')
+        assert resp.status_code == 200
+        pages.append([measurement['city'] for measurement in resp.json['cities']])
+        cursors.append(resp.json['cursor'])
+        if cursors[-1] is None:
+            break
+
+    assert pages == [['Ahvaz', 'Masjed E Soleyman'], ['Abadan', 'Khorramshahr'], ['Buraydah']]
+    assert decode_cursor(cursors[1]) == {'after': [39.156, 'Masjed E Soleyman']}
+    # The first page only needs 2 cities, the next ones are sliced from the cached ranking
+    assert [call.kwargs['body']['size'] for call in m_es_client.return_value.search.call_args_list] == [2, 10000]
+
+
+@pytest.mark.parametrize('params, indexes, body', [
+    (
+        {'order': 'asc'},
+        'global_land_temperatures_by_city-*',
+        {**BASE_REQUEST_BODY, 'sort': [{'average_temperature': 'asc'}, {'city': 'asc'}], 'query': {'bool': {
+            'filter': [{'exists': {'field': 'average_temperature'}}]
+        }}}
+    ),
+    (
+        {'country': 'Iran', 'from': '2018-01-01', 'to': '2018-12-31'},
+        'global_land_temperatures_by_city-2018',
+        {**BASE_REQUEST_BODY, 'query': {'bool': {'filter': [
+            {'match_phrase': {'country': 'Iran'}},
+            {'range': {'day': {'gte': '2018-01-01', 'lte': '2018-12-31'}}},
+            {'exists': {'field': 'average_temperature'}}
+        ]}}}
+    ),
+    (
+        {'min_uncertainty': '0.1', 'max_uncertainty': '0.5', 'cities': 3},
+        'global_land_temperatures_by_city-*',
+        {**BASE_REQUEST_BODY, 'size': 3, 'query': {'bool': {'filter': [
+            {'range': {'average_temperature_uncertainty': {'gte': 0.1, 'lte': 0.5}}},
+            {'exists': {'field': 'average_temperature'}}
+        ]}}}
+    ),
+])
+@patch('coruscant.api.get_es_client')
+def test_measurements_filters(m_es_client, client, params, indexes, body):
+    resp = client.get(f'/api/measurements?{urllib.parse.urlencode(params)}')
+    assert resp.status_code == 200
+
+    # The rollups only have the hottest measurements, these are always read from the yearly indexes
+    m_es_client.return_value.search.assert_called_once_with(
+        index=indexes,
+        body=body,
+        ignore_unavailable=True,
+        request_timeout=10
+    )
+
+
+@pytest.mark.parametrize('params, error', [
+    ({'order': 'hottest'}, 'Invalid order: hottest, it must be either desc (hottest first) or asc (coldest first)'),
+    ({'min_uncertainty': 'low'}, 'Invalid min_uncertainty: low'),
+    ({'cursor': 'nope'}, 'Invalid cursor'),
+    ({'cursor': base64.urlsafe_b64encode(b'{"after": [1.5]}').decode('ascii')}, 'Invalid cursor'),
+])
+def test_invalid_measurements_params(backend_client, params, error):
+    resp = backend_client.get(f'/api/measurements?{urllib.parse.urlencode(params)}')
+
+    assert resp.status_code == 400
+    assert resp.json == {'errors': [error]}
+
+
+GEO_BUCKET = {
+    'doc_count': 12,
+    'average_temperature': {'value': 26.4},
+    'max_temperature': {'value': 39.156},
+    'location': {'location': {'lat': 31.35, 'lon': 49.01}, 'count': 12}
+}
+GEO_RESULT = {
+    'average_temperature': 26.4,
+    'max_temperature': 39.156,
+    'measurements': 12,
+    'location': {'lat': 31.35, 'lon': 49.01}
+}
+
+
+@patch('coruscant.api.get_es_client')
+def test_measurements_geo_cities(m_es_client, client):
+    m_es_client.return_value.search.return_value = {
+        'hits': {'hits': []}, 'aggregations': {'cities': {'buckets': [{'key': 'Ahvaz', **GEO_BUCKET}]}}
+    }
+    path = '/api/measurements/geo/cities?lat=31.35&lon=49.01&distance=500&cities=5&from=2013-01-01&to=2013-12-31'
+
+    for _ in range(2):
+        resp = client.get(path)
+        assert resp.status_code == 200
+        assert resp.json == {'cities': [{'city': 'Ahvaz', **GEO_RESULT}]}
+
+    # Only the yearly indexes in the range are searched, once
+    m_es_client.return_value.search.assert_called_once()
+    call = m_es_client.return_value.search.call_args
+    assert call.kwargs['index'] == 'global_land_temperatures_by_city-2013'
+    assert call.kwargs['body']['size'] == 0
+    assert call.kwargs['body']['aggs']['cities']['terms']['size'] == 5
+
+
+@patch('coruscant.api.get_es_client')
+def test_measurements_geo_grid(m_es_client, client):
+    m_es_client.return_value.search.return_value = {
+        'hits': {'hits': []}, 'aggregations': {'grid': {'buckets': [{'key': 'tm5', **GEO_BUCKET}]}}
     }
 
+    resp = client.get('/api/measurements/geo/grid?precision=3')
+
+    assert resp.status_code == 200
+    assert resp.json == {'cells': [{'geohash': 'tm5', **GEO_RESULT}]}
+    body = m_es_client.return_value.search.call_args.kwargs['body']
+    assert body['aggs']['grid']['geohash_grid']['precision'] == 3
+
+
+@pytest.mark.parametrize('path, error', [
+    ('/api/measurements/geo/cities', 'Please, provide either lat, lon and distance, or top, left, bottom and right'),
+    ('/api/measurements/geo/cities?lat=31&lon=49&distance=5&cities=0', 'cities must be between 1 and 10000'),
+    ('/api/measurements/geo/grid?precision=13', 'precision must be between 1 and 12'),
+    ('/api/measurements/geo/grid?top=10&left=0&bottom=20&right=10', 'top has to be north of bottom'),
+    ('/api/measurements/geo/grid?from=2013-13-01', 'Invalid date format: 2013-13-01'),
+])
+def test_invalid_measurements_geo(client, path, error):
+    resp = client.get(path)
+
+    assert resp.status_code == 400
+    assert resp.json == {'errors': [error]}
+
+
+@patch('coruscant.api.get_es_client')
+def test_city_series(m_es_client, client):
+    m_es_client.return_value.search.return_value = {'hits': {'hits': []}, 'aggregations': {'series': {'buckets': [{
+        'key_as_string': '2013-07-01',
+        'doc_count': 1,
+        'temperature': {'count': 1, 'min': 39.156, 'max': 39.156, 'avg': 39.156, 'sum': 39.156},
+        'weight': {'value': 4.0},
+        'weighted_temperature': {'value': 156.624},
+    }]}}}
+
+    resp = client.get('/api/cities/Ahvaz/series?interval=month&from=2013-01-01&to=2013-12-31&points=100')
+
+    assert resp.status_code == 200
+    assert resp.json == {'city': 'Ahvaz', 'interval': 'month', 'series': [{
+        'day': '2013-07-01',
+        'average_temperature': 39.156,
+        'min_temperature': 39.156,
+        'max_temperature': 39.156,
+        'weighted_temperature': 39.156,
+        'measurements': 1
+    }]}
+    call = m_es_client.return_value.search.call_args
+    # Only the shard of the city, in the indexes of the range
+    assert call.kwargs['routing'] == 'Ahvaz'
+    assert call.kwargs['index'] == 'global_land_temperatures_by_city-2013'
+
+
+@pytest.mark.parametrize('params, error', [
+    ('interval=week', 'Invalid interval: week, it must be one of month, year, decade'),
+    ('points=0', 'points must be between 1 and 10000'),
+    ('points=many', 'Invalid points number: many'),
+    ('from=2013-02-30', 'Invalid date format: 2013-02-30'),
+])
+def test_invalid_city_series(client, params, error):
+    resp = client.get(f'/api/cities/Ahvaz/series?{params}')
+
+    assert resp.status_code == 400
+    assert resp.json == {'errors': [error]}
+
 
 @patch('coruscant.api.get_es_client')
 def test_es_not_responding(m_es_client, client):
@@ -548,3 +936,461 @@ def test_es_not_responding(m_es_client, client):
     path = '/api/measurements'
     resp = client.get(path)
     assert resp.status_code == 400
+
+
+@patch('coruscant.api.rollups.measurements_updated')
+@patch('coruscant.api.Measurement.save')
+@patch('coruscant.api.get_es_client')
+def test_measurements_cache(m_es_client, m_measurement_save, m_measurements_updated, client):
+    m_es_client.return_value.search.return_value = {'hits': {'hits': [{'_source': {'city': 'Ahvaz'}}]}}
+
+    for path in ('/api/measurements?from=2000-01-01', '/api/measurements?from=2000-01-01&cities=10'):
+        resp = client.get(path)
+        assert resp.status_code == 200
+        assert resp.json == {'cities': [{'city': 'Ahvaz'}], 'cursor': None}
+    assert m_es_client.return_value.search.call_count == 1
+
+    # Writes outside of the range don't invalidate it
+    measurement = {
+        'average_temperature': 41,
+        'average_temperature_uncertainty': 0.37,
+        'city': 'Jerez',
+        'country': 'Spain',
+        'day': '1999-08-01',
+        'location': {'lat': 31.35, 'lon': 49.01}
+    }
+    client.post('/api/measurement/add', json=measurement)
+    client.get('/api/measurements?from=2000-01-01')
+    assert m_es_client.return_value.search.call_count == 1
+
+    client.post('/api/measurement/add', json={**measurement, 'day': '2021-08-01'})
+    client.get('/api/measurements?from=2000-01-01')
+    assert m_es_client.return_value.search.call_count == 2
+
+
+@patch('coruscant.api.get_es_client')
+def test_measurements_coalescing(m_es_client):
+    release = Event()
+    m_es_client.return_value.search.side_effect = lambda **kwargs: release.wait() and {
+        'hits': {'hits': [{'_source': {'city': 'Ahvaz'}}]}
+    }
+
+    def get(path):
+        with app.test_client() as client:
+            return client.get(path).json
+
+    coalesced = measurements_flights.stats()['coalesced']
+    with ThreadPoolExecutor(8) as pool:
+        try:
+            responses = [pool.submit(get, '/api/measurements?from=2000-01-01') for _ in range(6)]
+            # Another query isn't coalesced with them
+            other = pool.submit(get, '/api/measurements?from=2001-01-01')
+            for _ in range(200):
+                if measurements_flights.stats()['coalesced'] == coalesced + 5 and (
+                    m_es_client.return_value.search.call_count == 2
+                ):
+                    break
+                time.sleep(0.005)
+        finally:
+            release.set()
+
+    assert [response.result()['cities'] for response in responses] == [[{'city': 'Ahvaz'}]] * 6
+    assert other.result()['cities'] == [{'city': 'Ahvaz'}]
+    assert m_es_client.return_value.search.call_count == 2
+    assert measurements_flights.stats() == {**measurements_flights.stats(), 'in_flight': 0, 'coalesced': coalesced + 5}
+
+
+@patch('coruscant.api_async.get_async_es_client')
+def test_measurements_coalescing_async(m_async_es_client):
+    searches = []
+
+    async def search(**kwargs):
+        searches.append(kwargs)
+        await asyncio.sleep(0.01)
+        return {'hits': {'hits': [{'_source': {'city': 'Ahvaz'}}]}}
+
+    m_async_es_client.return_value.search = search
+
+    async def requests():
+        client = async_app.test_client()
+        responses = await asyncio.gather(*(client.get('/api/measurements?from=2000-01-01') for _ in range(6)))
+        return [await response.get_json() for response in responses]
+
+    assert asyncio.run(requests()) == [{'cities': [{'city': 'Ahvaz'}], 'cursor': None}] * 6
+    assert len(searches) == 1
+
+
+BULK_MEASUREMENT = {
+    'average_temperature': 41,
+    'average_temperature_uncertainty': 0.37,
+    'city': 'Jerez',
+    'country': 'Spain',
+    'day': '2021-08-01',
+    'location': {
+        'lat': 31.35,
+        'lon': 49.01
+    }
+}
+
+
+@pytest.mark.parametrize('ndjson', [False, True])
+@patch('coruscant.api.rollups.measurements_updated')
+@patch('coruscant.api.get_es_client')
+def test_measurements_bulk(m_es_client, m_measurements_updated, client, ndjson):
+    items = [
+        {**BULK_MEASUREMENT, 'day': '2021-08-01'},
+        {**BULK_MEASUREMENT, 'day': '202108-01'},
+        {**BULK_MEASUREMENT, 'day': '1999-08-01'},
+        {**BULK_MEASUREMENT, 'day': '2021-09-01'},
+        'nope',
+    ]
+    m_es_client.return_value.bulk.return_value = {
+        'errors': True,
+        'items': [
+            {'index': {'_index': 'global_land_temperatures_by_city-1990s', 'status': 201}},
+            {'index': {'_index': 'global_land_temperatures_by_city-2021', 'status': 201}},
+            {'index': {
+                '_index': 'global_land_temperatures_by_city-2021',
+                'status': 429,
+                'error': {'type': 'es_rejected_execution_exception', 'reason': 'rejected execution'}
+            }},
+        ]
+    }
+
+    if ndjson:
+        data = '\n'.join(json.dumps(item) for item in items) + '\n{not json\n'
+        resp = client.post('/api/measurements/bulk', data=data, content_type='application/x-ndjson')
+    else:
+        resp = client.post('/api/measurements/bulk', json=items)
+
+    assert resp.status_code == 200
+    expected = [
+        {'status': 201, 'measurement': {**BULK_MEASUREMENT, 'day': 'Sun, 01 Aug 2021 00:00:00 GMT'}},
+        {'status': 400, 'errors': ['Invalid date format for day']},
+        {'status': 201, 'measurement': {**BULK_MEASUREMENT, 'day': 'Sun, 01 Aug 1999 00:00:00 GMT'}},
+        {'status': 429, 'errors': ['rejected execution']},
+        {'status': 400, 'errors': ['Invalid measurement, it must be a JSON object']},
+    ]
+    if ndjson:
+        expected.append({'status': 400, 'errors': ['Invalid measurement, it must be a JSON object']})
+    assert resp.json == {'errors': True, 'items': expected}
+
+    # A single bulk request, grouped by index
+    body = m_es_client.return_value.bulk.call_args.kwargs['body']
+    assert [line['index']['_index'] for line in body[::2]] == [
+        'global_land_temperatures_by_city-1990s',
+        'global_land_temperatures_by_city-2021',
+        'global_land_temperatures_by_city-2021',
+    ]
+    assert body[1]['day'] == date(1999, 8, 1)
+    assert body[0]['index']['_id'] == Measurement.generate_id('Jerez', 'Spain', '1999-08-01')
+
+    assert [measurement['day'] for measurement in m_measurements_updated.call_args.args[1]] == [
+        date(1999, 8, 1), date(2021, 8, 1)
+    ]
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'json': {'average_temperature': 41}},
+    {'data': 'not json', 'content_type': 'application/json'},
+])
+def test_measurements_bulk_invalid_body(backend_client, kwargs):
+    resp = backend_client.post('/api/measurements/bulk', **kwargs)
+    assert resp.status_code == 400
+    assert resp.json == {'errors': ['Please, provide a JSON array or NDJSON with the measurements']}
+
+
+@patch('coruscant.api.get_es_client')
+def test_measurements_bulk_es_not_responding(m_es_client, client):
+    m_es_client.return_value.bulk.side_effect = ConnectionError
+    resp = client.post('/api/measurements/bulk', json=[BULK_MEASUREMENT])
+    assert resp.status_code == 400
+
+
+@patch('coruscant.api.get_es_client')
+def test_measurements_bulk_only_invalid_items(m_es_client, backend_client):
+    resp = backend_client.post('/api/measurements/bulk', json=[{}])
+    assert resp.status_code == 200
+    assert resp.json['errors'] is True
+    m_es_client.return_value.bulk.assert_not_called()
+
+
+@patch('coruscant.api.rollups.measurements_updated')
+@patch('coruscant.api.get_es_client')
+def test_measurements_bulk_update(m_es_client, m_measurements_updated, client):
+    source = {
+        'average_temperature': 39.1,
+        'average_temperature_uncertainty': 0.37,
+        'city': 'Ahvaz',
+        'country': 'Iran',
+        'day': '2013-07-01',
+        'location': {'lat': 31.35, 'lon': 49.01}
+    }
+    m_es_client.return_value.bulk.return_value = {
+        'errors': True,
+        'items': [
+            {'update': {
+                '_index': 'global_land_temperatures_by_city-2013', '_id': '1', 'status': 200, 'result': 'updated',
+                'get': {'_source': source}
+            }},
+            {'update': {
+                '_index': 'global_land_temperatures_by_city-2013', '_id': '2', 'status': 404,
+                'error': {'type': 'document_missing_exception', 'reason': '[2]: document missing'}
+            }},
+            {'update': {
+                '_index': 'global_land_temperatures_by_city-2012', '_id': '3', 'status': 409,
+                'error': {'type': 'version_conflict_engine_exception', 'reason': 'version conflict'}
+            }},
+        ]
+    }
+
+    resp = client.patch('/api/measurements/bulk', json=[
+        {'city': 'Ahvaz', 'country': 'Iran', 'day': '2013-07-01', 'average_temperature': 39.1},
+        {'city': 'Ahvaz', 'day': '2013-07-01', 'average_temperature': 39.1},
+        {'city': 'Jerez', 'country': 'Spain', 'day': '2013-07-01', 'average_temperature_uncertainty': '0.2'},
+        {'city': 'Ahvaz', 'country': 'Iran', 'day': '2012-07-01', 'average_temperature': 'aa'},
+        {'city': 'Ahvaz', 'country': 'Iran', 'day': '2012-07-01', 'average_temperature': 10},
+        {'city': 'Ahvaz', 'country': 'Iran', 'day': '2012-07-01'},
+    ])
+
+    assert resp.status_code == 200
+    assert resp.json == {'errors': True, 'items': [
+        {'status': 200, 'measurement': {**source, 'day': 'Mon, 01 Jul 2013 00:00:00 GMT'}},
+        {'status': 400, 'errors': ['Missing field country']},
+        {'status': 404, 'errors': ['Could not find the document']},
+        {'status': 400, 'errors': ['average_temperature must be a float']},
+        {'status': 409, 'errors': ['Conflict with a concurrent update, please retry']},
+        {'status': 400, 'errors': ['Please, provide either average_temperature or average_temperature_uncertainty']},
+    ]}
+
+    body = m_es_client.return_value.bulk.call_args.kwargs['body']
+    assert body == [
+        {'update': {
+            '_index': 'global_land_temperatures_by_city-2013',
+            '_id': Measurement.generate_id('Ahvaz', 'Iran', '2013-07-01'),
+            'routing': 'Ahvaz',
+            '_source': True
+        }},
+        {'doc': {'average_temperature': 39.1}},
+        {'update': {
+            '_index': 'global_land_temperatures_by_city-2013',
+            '_id': Measurement.generate_id('Jerez', 'Spain', '2013-07-01'),
+            'routing': 'Jerez',
+            '_source': True
+        }},
+        {'doc': {'average_temperature_uncertainty': 0.2}},
+        {'update': {
+            '_index': 'global_land_temperatures_by_city-2012',
+            '_id': Measurement.generate_id('Ahvaz', 'Iran', '2012-07-01'),
+            'routing': 'Ahvaz',
+            '_source': True
+        }},
+        {'doc': {'average_temperature': 10.0}},
+    ]
+    assert [measurement['city'] for measurement in m_measurements_updated.call_args.args[1]] == ['Ahvaz']
+
+
+def test_measurements_bulk_update_invalid_body(backend_client):
+    resp = backend_client.patch('/api/measurements/bulk', json={'city': 'Ahvaz'})
+    assert resp.status_code == 400
+
+
+EXPORTED = [
+    {'day': '2013-07-01T00:00:00', 'average_temperature': 39.156, 'city': 'Ahvaz', 'country': 'Iran',
+     'location': {'lat': 31.35, 'lon': 49.01}},
+    {'day': '2013-07-01T00:00:00', 'average_temperature': 20.1, 'city': 'London', 'country': 'Canada',
+     'location': {'lat': 42.59, 'lon': -80.73}},
+    {'day': '2013-07-01T00:00:00', 'city': 'London', 'country': 'United Kingdom',
+     'location': {'lat': 52.24, 'lon': -0.0}},
+]
+
+
+def export_pages(*pages):
+    """
+    Search responses of an export, with pages of the given EXPORTED measurements.
+    """
+    responses, position = [], 0
+    for page in pages:
+        hits = [
+            {'_source': EXPORTED[i], 'sort': [1372636800000, EXPORTED[i]['city'], position + n]}
+            for n, i in enumerate(page)
+        ]
+        position += len(page)
+        responses.append({'pit_id': f'pit-{len(responses) + 2}', 'hits': {'hits': hits}})
+    return responses
+
+
+def ndjson_lines(data):
+    return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor))
+
+
+@patch('coruscant.api.EXPORT_PAGE_SIZE', 2)
+@patch('coruscant.api.get_es_client')
+def test_measurements_export(m_es_client, client):
+    m_es_client.return_value.open_point_in_time.return_value = {'id': 'pit-1'}
+    m_es_client.return_value.search.side_effect = export_pages([0, 1], [2])
+
+    resp = client.get('/api/measurements/export?from=2013-07-01&to=2013-07-31')
+
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/x-ndjson'
+    lines = ndjson_lines(resp.data)
+    assert lines[:2] == EXPORTED[:2]
+    assert decode_cursor(lines[2]['cursor']) == {'pit': 'pit-2', 'after': [1372636800000, 'London', 1]}
+    assert lines[3:] == [EXPORTED[2], {'cursor': None}]
+
+    m_es_client.return_value.open_point_in_time.assert_called_once_with(
+        index='global_land_temperatures_by_city-2013', keep_alive='5m', ignore_unavailable=True
+    )
+    first, second = [call.kwargs['body'] for call in m_es_client.return_value.search.call_args_list]
+    assert first == {
+        'pit': {'id': 'pit-1', 'keep_alive': '5m'},
+        'size': 2,
+        'query': {'bool': {'filter': [{'range': {'day': {'gte': '2013-07-01', 'lte': '2013-07-31'}}}]}},
+        'sort': [{'day': 'asc'}, {'city': 'asc'}, {'_shard_doc': 'asc'}],
+        'track_total_hits': False
+    }
+    assert second == {
+        **first, 'pit': {'id': 'pit-2', 'keep_alive': '5m'}, 'search_after': [1372636800000, 'London', 1]
+    }
+    m_es_client.return_value.close_point_in_time.assert_called_once_with(body={'id': 'pit-3'}, ignore=404)
+
+
+@patch('coruscant.api.get_es_client')
+def test_measurements_export_csv(m_es_client, client):
+    m_es_client.return_value.open_point_in_time.return_value = {'id': 'pit-1'}
+    m_es_client.return_value.search.side_effect = export_pages([1, 2])
+
+    resp = client.get('/api/measurements/export?format=csv&city=London&country=Canada')
+
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/csv'
+    # Only the exact matches of the country
+    assert resp.data.decode('utf-8').splitlines() == [
+        'day,average_temperature,average_temperature_uncertainty,city,country,lat,lon',
+        '2013-07-01,20.1,,London,Canada,42.59,-80.73',
+        '# cursor=null',
+    ]
+    assert m_es_client.return_value.search.call_args.kwargs['body']['query'] == {'bool': {'filter': [
+        {'term': {'city': 'London'}},
+        {'match_phrase': {'country': 'Canada'}},
+    ]}}
+    assert m_es_client.return_value.open_point_in_time.call_args.kwargs['index'] == (
+        'global_land_temperatures_by_city-*'
+    )
+
+
+@patch('coruscant.api.get_es_client')
+def test_measurements_export_resume(m_es_client, client):
+    m_es_client.return_value.search.side_effect = export_pages([2])
+    cursor = base64.urlsafe_b64encode(
+        json.dumps({'pit': 'pit-1', 'after': [1372636800000, 'London', 1]}).encode('utf-8')
+    ).decode('ascii')
+
+    resp = client.get(f'/api/measurements/export?{urllib.parse.urlencode({"cursor": cursor})}')
+
+    assert resp.status_code == 200
+    assert ndjson_lines(resp.data) == [EXPORTED[2], {'cursor': None}]
+    m_es_client.return_value.open_point_in_time.assert_not_called()
+    body = m_es_client.return_value.search.call_args.kwargs['body']
+    assert body['pit'] == {'id': 'pit-1', 'keep_alive': '5m'}
+    assert body['search_after'] == [1372636800000, 'London', 1]
+
+
+@patch('coruscant.api.EXPORT_PAGE_SIZE', 2)
+@patch('coruscant.api.get_es_client')
+def test_measurements_export_csv_resume(m_es_client, client):
+    m_es_client.return_value.open_point_in_time.return_value = {'id': 'pit-1'}
+    m_es_client.return_value.search.side_effect = export_pages([0, 1], [2])
+
+    lines = client.get('/api/measurements/export?format=csv').data.decode('utf-8').splitlines()
+
+    assert len(lines) == 6
+    assert lines[3].startswith('# cursor=')
+    assert decode_cursor(lines[3][len('# cursor='):]) == {'pit': 'pit-2', 'after': [1372636800000, 'London', 1]}
+    assert lines[5] == '# cursor=null'
+
+    m_es_client.return_value.search.side_effect = export_pages([2])
+    params = urllib.parse.urlencode({'format': 'csv', 'cursor': lines[3][len('# cursor='):]})
+    resumed = client.get(f'/api/measurements/export?{params}').data.decode('utf-8').splitlines()
+
+    # Without the header
+    assert resumed == lines[4:]
+
+
+@pytest.mark.parametrize('params, error', [
+    ({'format': 'xml'}, 'Invalid format: xml, it must be one of ndjson, csv'),
+    ({'cursor': 'nope'}, 'Invalid cursor'),
+    ({'cursor': 'e30='}, 'Invalid cursor'),
+    ({'from': '2019-02-30'}, 'Invalid date format: 2019-02-30'),
+])
+def test_measurements_export_invalid_params(client, params, error):
+    resp = client.get(f'/api/measurements/export?{urllib.parse.urlencode(params)}')
+    assert resp.status_code == 400
+    assert resp.json == {'errors': [error]}
+
+
+@pytest.mark.parametrize('side_effect, status_code', [
+    (ConnectionError, 400),
+    (NotFoundError(404, 'search_context_missing_exception', {}), 410),
+])
+@patch('coruscant.api.get_es_client')
+def test_measurements_export_errors(m_es_client, client, side_effect, status_code):
+    m_es_client.return_value.open_point_in_time.return_value = {'id': 'pit-1'}
+    m_es_client.return_value.search.side_effect = side_effect
+
+    resp = client.get('/api/measurements/export')
+    assert resp.status_code == status_code
+
+
+@pytest.fixture
+def write_buffer(tmp_path):
+    buffer = WriteBuffer(str(tmp_path), api.index_buffered)
+    with patch('coruscant.api.WRITE_BEHIND', True), patch('coruscant.api.write_buffer', buffer), \
+            patch('coruscant.api_async.WRITE_BEHIND', True), patch('coruscant.api_async.write_buffer', buffer):
+        yield buffer
+    buffer.stop()
+
+
+@patch('coruscant.api.rollups.measurements_updated')
+@patch('coruscant.api.get_es_client')
+def test_add_measurement_write_behind(m_es_client, m_measurements_updated, client, write_buffer):
+    m_es_client.return_value.bulk.return_value = {'items': [{'index': {'status': 201}}]}
+
+    resp = client.post('/api/measurement/add', json=BULK_MEASUREMENT)
+
+    assert resp.status_code == 202
+    assert resp.json['status'] == 'pending'
+    assert resp.json['measurement']['city'] == 'Jerez'
+    m_es_client.return_value.bulk.assert_not_called()
+    assert client.get(f'/api/measurement/add/{resp.json["id"]}').json == {'id': resp.json['id'], 'status': 'pending'}
+
+    assert write_buffer.flush()
+    assert m_es_client.return_value.bulk.call_args.kwargs['body'] == [
+        {'index': {
+            '_index': 'global_land_temperatures_by_city-2021',
+            '_id': Measurement.generate_id('Jerez', 'Spain', '2021-08-01'),
+            'routing': 'Jerez'
+        }},
+        {**BULK_MEASUREMENT, 'day': date(2021, 8, 1)},
+    ]
+    assert m_measurements_updated.call_args.args[1][0]['city'] == 'Jerez'
+    assert client.get(f'/api/measurement/add/{resp.json["id"]}').json == {'id': resp.json['id'], 'status': 'indexed'}
+
+
+def test_add_measurement_write_behind_invalid(client, write_buffer):
+    resp = client.post('/api/measurement/add', json={**BULK_MEASUREMENT, 'day': '202108-01'})
+
+    assert resp.status_code == 400
+    assert write_buffer.pending() == 0
+
+
+def test_add_measurement_status_unknown(client):
+    resp = client.get('/api/measurement/add/nope')
+
+    assert resp.status_code == 404
+    assert resp.json == {'errors': ['Unknown write, or sent too long ago']}
@@ -0,0 +1,39 @@
+from statistics import median
+
+import pytest
+from elasticsearch_dsl import connections
+
+from app import app
+from benchmarks.suite import FIRST_YEAR, FakeES, SyntheticData, profiles, run_profile
+from coruscant.es import CLIENT_SETTINGS
+
+
+def test_synthetic_first_years():
+    first_years = [city['first_year'] for city in SyntheticData().cities]
+
+    # Like the real dataset: half of the cities start before ~1900, few of them before 1800
+    assert min(first_years) >= FIRST_YEAR
+    assert max(first_years) <= 1953
+    assert 1875 <= median(first_years) <= 1925
+    assert sum(year < 1800 for year in first_years) / len(first_years) < 0.2
+
+
+@pytest.fixture
+def fake_es():
+    data = SyntheticData(cities=50)
+    fake_es = FakeES(data).start()
+    connections.remove_connection('default')
+    connections.configure(default={**CLIENT_SETTINGS, 'hosts': [fake_es.host], 'sniff_on_start': False})
+    yield data
+    fake_es.stop()
+    connections.remove_connection('default')
+    connections.configure(default=CLIENT_SETTINGS)
+
+
+@pytest.mark.parametrize('name', ['top_narrow', 'add', 'bulk_add', 'update'])
+def test_profiles_without_errors(fake_es, name):
+    request, clear_cache = profiles(fake_es)[name]
+
+    result = run_profile(app, request, clear_cache, requests=2, concurrency=1, seed=0)
+
+    assert result['errors'] == 0
@@ -0,0 +1,208 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from unittest.mock import Mock, patch
+
+import pytest
+
+from coruscant.cache import QueryCache, SharedWrites, SingleFlight
+
+
+def test_get_and_put():
+    cache = QueryCache()
+    value, generation = cache.get('key')
+    assert value is None
+
+    cache.put('key', (2000, 2010), ['Ahvaz'], generation)
+    assert cache.get('key')[0] == ['Ahvaz']
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0, 'invalidations': 0}
+
+
+def test_lru_eviction():
+    cache = QueryCache(maxsize=2)
+    cache.put('a', (2000, 2000), 1, 0)
+    cache.put('b', (2000, 2000), 2, 0)
+    cache.get('a')
+    cache.put('c', (2000, 2000), 3, 0)
+
+    assert cache.get('a')[0] == 1
+    assert cache.get('b')[0] is None
+    assert cache.get('c')[0] == 3
+    assert cache.evictions == 1
+
+
+@patch('coruscant.cache.time.monotonic')
+def test_ttl(m_monotonic):
+    m_monotonic.return_value = 100
+    cache = QueryCache(ttl=10)
+    cache.put('a', (2000, 2000), 1, 0)
+
+    m_monotonic.return_value = 109
+    assert cache.get('a')[0] == 1
+    m_monotonic.return_value = 110
+    assert cache.get('a')[0] is None
+    assert cache.stats()['size'] == 0
+
+
+@pytest.mark.parametrize('years, invalidated', [
+    ((2000, 2010), True),
+    ((2005, 2005), True),
+    ((None, 2005), True),
+    ((2005, None), True),
+    ((None, None), True),
+    ((2006, 2010), False),
+    ((None, 2004), False),
+])
+@patch('coruscant.cache.time.monotonic')
+def test_invalidate_year(m_monotonic, years, invalidated):
+    m_monotonic.return_value = 100
+    cache = QueryCache(settle_time=2)
+    cache.put('key', years, 'value', 0)
+
+    cache.invalidate_year(2005)
+
+    assert (cache.get('key')[0] is None) == invalidated
+    assert cache.invalidations == int(invalidated)
+
+    # Writes in 2005 might not be visible yet, so overlapping results are not cached
+    _, generation = cache.get('other')
+    cache.put('other', years, 'value', generation)
+    assert (cache.get('other')[0] is None) == invalidated
+
+    m_monotonic.return_value = 102
+    cache.put('other', years, 'value', generation)
+    assert cache.get('other')[0] == 'value'
+
+
+def test_concurrent_write_prevents_put():
+    cache = QueryCache()
+    _, generation = cache.get('key')
+    cache.invalidate_year(1800)
+    cache.put('key', (2000, 2010), 'value', generation)
+
+    assert cache.get('key')[0] is None
+
+
+def test_shared_writes(tmp_path):
+    path = str(tmp_path / 'cache-writes')
+    cache = QueryCache(shared=SharedWrites(path))
+    for key, years in (('key', (2000, 2010)), ('other', (1800, 1810))):
+        _, generation = cache.get(key)
+        cache.put(key, years, 'value', generation)
+
+    # A write handled by another worker
+    worker = multiprocessing.get_context('fork').Process(
+        target=lambda: QueryCache(shared=SharedWrites(path)).invalidate_year(2005)
+    )
+    worker.start()
+    worker.join()
+
+    assert cache.get('key')[0] is None
+    assert cache.get('other')[0] == 'value'
+    assert cache.invalidations == 1
+    # The write might not be visible yet
+    _, generation = cache.get('key')
+    cache.put('key', (2000, 2010), 'value', generation)
+    assert cache.get('key')[0] is None
+
+
+def test_shared_writes_of_the_same_process(tmp_path):
+    cache = QueryCache(shared=SharedWrites(str(tmp_path / 'cache-writes')))
+    _, generation = cache.get('key')
+    cache.put('key', (2000, 2010), 'value', generation)
+
+    cache.invalidate_year(2005)
+    cache.get('key')
+
+    assert cache.invalidations == 1
+    assert cache.shared.count() == 1
+
+
+def test_shared_writes_missed(tmp_path):
+    path = str(tmp_path / 'cache-writes')
+    cache = QueryCache(shared=SharedWrites(path, size=2))
+    _, generation = cache.get('key')
+    cache.put('key', (2000, 2010), 'value', generation)
+
+    other = SharedWrites(path, size=2)
+    for year in (1800, 1801, 1802):
+        other.record(year)
+
+    # Older writes have been overwritten, so their years are unknown
+    assert cache.get('key')[0] is None
+    _, generation = cache.get('key')
+    cache.put('key', (2000, 2010), 'value', generation)
+    assert cache.get('key')[0] is None
+
+
+def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        time.sleep(0.005)
+    raise AssertionError('timed out')
+
+
+def test_single_flight():
+    flights, release = SingleFlight(), Event()
+    call = Mock(side_effect=lambda: release.wait() and ['Ahvaz'])
+
+    with ThreadPoolExecutor(9) as pool:
+        try:
+            results = [pool.submit(flights.do, 'key', call) for _ in range(8)]
+            wait_for(lambda: flights.stats()['coalesced'] == 7)
+            assert pool.submit(flights.do, 'other', lambda: 'other').result() == 'other'
+        finally:
+            release.set()
+
+    assert [result.result() for result in results] == [['Ahvaz']] * 8
+    assert call.call_count == 1
+    assert flights.stats() == {'in_flight': 0, 'calls': 2, 'coalesced': 7}
+
+    # Once done, the next call is made again
+    flights.do('key', call)
+    assert call.call_count == 2
+
+
+def test_single_flight_error():
+    flights, release = SingleFlight(), Event()
+
+    def call():
+        release.wait()
+        raise ConnectionError
+
+    with ThreadPoolExecutor(4) as pool:
+        try:
+            results = [pool.submit(flights.do, 'key', call) for _ in range(4)]
+            wait_for(lambda: flights.stats()['coalesced'] == 3)
+        finally:
+            release.set()
+
+    for result in results:
+        with pytest.raises(ConnectionError):
+            result.result()
+    assert flights.stats()['in_flight'] == 0
+
+
+def test_single_flight_async():
+    flights = SingleFlight()
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return ['Ahvaz']
+
+    async def requests():
+        leader = asyncio.ensure_future(flights.do_async('key', call))
+        followers = [asyncio.ensure_future(flights.do_async('key', call)) for _ in range(7)]
+        await asyncio.sleep(0)
+        # The caller making the call going away doesn't cancel it
+        leader.cancel()
+        return await asyncio.gather(*followers)
+
+    assert asyncio.run(requests()) == [['Ahvaz']] * 7
+    assert len(calls) == 1
+    assert flights.stats() == {'in_flight': 0, 'calls': 1, 'coalesced': 7}
@@ -0,0 +1,133 @@
+from datetime import date
+from unittest.mock import patch
+
+import pytest
+
+from coruscant.columnar import ColumnarStore, from_month, to_month
+
+ROWS = [
+    ['2013-07-01', '39.156', '0.37', 'Ahvaz', 'Iran', '31.35N', '49.01E'],
+    ['2012-07-01', '38.531', '0.431', 'Abadan', 'Iran', '29.74N', '48.00E'],
+    ['2013-08-01', '38.2', '0.3', 'Ahvaz', 'Iran', '31.35N', '49.01E'],
+    ['1850-01-01', '', '', 'Ahvaz', 'Iran', '31.35N', '49.01E'],
+    ['1850-01-01', '5.0', '', 'London', 'United Kingdom', '52.24N', '0.00W'],
+    ['1850-01-01', '6.0', '', 'London', 'Canada', '42.59N', '80.73W'],
+]
+JEREZ = {
+    'day': date(2021, 8, 1),
+    'average_temperature': 41.0,
+    'average_temperature_uncertainty': 0.37,
+    'city': 'Jerez',
+    'country': 'Spain',
+    'location': {'lat': 36.17, 'lon': -6.0}
+}
+
+
+def cities(measurements):
+    return [(measurement['city'], measurement['day']) for measurement in measurements]
+
+
+@pytest.mark.parametrize('day', [date(1743, 11, 1), date(1969, 12, 31), date(1970, 1, 1), date(2013, 9, 15)])
+def test_months(day):
+    assert from_month(to_month(day), day.day) == day
+
+
+def test_from_rows():
+    store = ColumnarStore.from_rows(ROWS)
+
+    assert len(store) == 6
+    assert store.top_cities(1) == [{
+        'day': '2013-07-01',
+        'average_temperature': 39.156,
+        'average_temperature_uncertainty': 0.37,
+        'city': 'Ahvaz',
+        'country': 'Iran',
+        'location': {'lat': 31.35, 'lon': 49.01}
+    }]
+
+
+def test_last_write_wins():
+    store = ColumnarStore.from_rows(ROWS + [['2013-07-01', '10.0', '0.37', 'Ahvaz', 'Iran', '31.35N', '49.01E']])
+
+    assert len(store) == 6
+    assert store.top_cities(1, date(2013, 1, 1))[0]['day'] == '2013-08-01'
+
+
+@pytest.mark.parametrize('_from, _to, expected', [
+    (None, None, [('Ahvaz', '2013-07-01'), ('Abadan', '2012-07-01'), ('London', '1850-01-01')]),
+    (date(2013, 7, 2), None, [('Ahvaz', '2013-08-01')]),
+    (None, date(2013, 7, 1), [('Ahvaz', '2013-07-01'), ('Abadan', '2012-07-01'), ('London', '1850-01-01')]),
+    (date(1800, 1, 1), date(1900, 1, 1), [('London', '1850-01-01')]),
+    (date(2014, 1, 1), None, []),
+])
+def test_top_cities(_from, _to, expected):
+    store = ColumnarStore.from_rows(ROWS)
+
+    assert cities(store.top_cities(10, _from, _to)) == expected
+
+
+def test_top_cities_groups_by_name():
+    # Like the collapse on city of the ES query, the two Londons are a single city
+    store = ColumnarStore.from_rows(ROWS)
+
+    assert store.top_cities(10, date(1850, 1, 1), date(1850, 1, 1)) == [{
+        'day': '1850-01-01',
+        'average_temperature': 6.0,
+        'city': 'London',
+        'country': 'Canada',
+        'location': {'lat': 42.59, 'lon': -80.73}
+    }]
+
+
+@pytest.mark.parametrize('buffer_size', [1, 100])
+def test_add(buffer_size):
+    with patch('coruscant.columnar.BUFFER_SIZE', buffer_size):
+        store = ColumnarStore.from_rows(ROWS)
+        store.add(JEREZ)
+        store.add({**JEREZ, 'day': date(2021, 9, 1), 'average_temperature': 30.0})
+        store.add({**JEREZ, 'day': date(2013, 7, 1), 'city': 'Ahvaz', 'country': 'Iran', 'average_temperature': 1.0})
+
+        assert len(store) == 8
+        assert cities(store.top_cities(3)) == [
+            ('Jerez', '2021-08-01'), ('Abadan', '2012-07-01'), ('Ahvaz', '2013-08-01')
+        ]
+        assert cities(store.top_cities(10, date(2021, 8, 2))) == [('Jerez', '2021-09-01')]
+
+        # Adding it again overwrites it
+        store.add({**JEREZ, 'average_temperature': 10.0})
+        assert len(store) == 8
+        assert store.top_cities(1)[0]['city'] == 'Abadan'
+
+
+@pytest.mark.parametrize('buffered', [False, True])
+def test_update(buffered):
+    store = ColumnarStore.from_rows([] if buffered else ROWS[:1])
+    if buffered:
+        store.add({**JEREZ, 'day': date(2013, 7, 1), 'city': 'Ahvaz', 'country': 'Iran'})
+
+    measurement = store.update('Ahvaz', date(2013, 7, 1), {'average_temperature': 50.5})
+
+    assert measurement['day'] == date(2013, 7, 1)
+    assert measurement['average_temperature'] == 50.5
+    assert store.top_cities(1)[0]['average_temperature'] == 50.5
+    assert store.update('Ahvaz', date(2013, 6, 1), {'average_temperature': 50.5}) is None
+    assert store.update('Jerez', date(2013, 7, 1), {'average_temperature': 50.5}) is None
+
+
+def test_update_exact():
+    store = ColumnarStore.from_rows(ROWS)
+
+    measurement = store.update_exact('London', 'United Kingdom', date(1850, 1, 1), {'average_temperature': 7.0})
+
+    assert measurement['country'] == 'United Kingdom'
+    assert store.top_cities(1, _to=date(1900, 1, 1))[0]['country'] == 'United Kingdom'
+    assert store.update_exact('London', 'Spain', date(1850, 1, 1), {'average_temperature': 7.0}) is None
+
+
+def test_top_cities_coldest():
+    store = ColumnarStore.from_rows(ROWS)
+    store.add({**JEREZ, 'average_temperature': 5.0, 'city': 'Cadiz'})
+
+    # Ties are ranked by city name
+    assert [measurement['city'] for measurement in store.top_cities(2, order='asc')] == ['Cadiz', 'London']
+    assert store.top_cities(1, order='asc', country='Canada')[0]['average_temperature'] == 6.0
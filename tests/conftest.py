@@ -1,10 +1,132 @@
+import asyncio
+from datetime import date
+from types import SimpleNamespace
+from unittest.mock import patch
+
 import pytest
 
 from app import app
+from app_async import app as async_app
+from app_local import app as local_app
+from coruscant import api
+from coruscant.cache import SharedWrites, measurements_cache
+from coruscant.columnar import ColumnarStore
+from coruscant.documents import Measurement
+from coruscant.indexes import index_catalog
+from tests.columnar_test import ROWS
+
+
+class AwaitableMock:
+    """
+    Async facade over a mock: calling it (or any of its attributes) returns an awaitable with
+    the result of calling the mock.
+    """
+
+    def __init__(self, mock):
+        self._mock = mock
+
+    def __getattr__(self, name):
+        return AwaitableMock(getattr(self._mock, name))
+
+    async def __call__(self, *args, **kwargs):
+        return self._mock(*args, **kwargs)
+
+
+class AsyncAppClient:
+    """
+    Sync facade over the test client of the async app, with the interface of Flask's one.
+    """
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def open(self, path, method='GET', content_type=None, **kwargs):
+        if content_type:
+            kwargs['headers'] = {'Content-Type': content_type}
+
+        async def request():
+            response = await self._client.open(path, method=method, **kwargs)
+            return SimpleNamespace(
+                status_code=response.status_code,
+                json=await response.get_json(silent=True),
+                data=await response.get_data(),
+                mimetype=response.mimetype
+            )
+
+        return asyncio.run(request())
+
+    def get(self, path, **kwargs):
+        return self.open(path, method='GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, method='POST', **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.open(path, method='PATCH', **kwargs)
+
+
+def _client(kind):
+    if kind == 'sync':
+        with app.test_client() as client:
+            yield client
+        return
+
+    if kind == 'columnar':
+        with patch('coruscant.api_local._store', ColumnarStore.from_rows(ROWS)), local_app.test_client() as client:
+            yield client
+        return
+
+    # The tests mock the sync ES client and elasticsearch-dsl calls of coruscant.api, so the async
+    # ones are bridged to them at call time, after the patches of every test have been applied
+    async def execute(search):
+        return search.execute()
+
+    async def save(measurement, **kwargs):
+        return measurement.save(**kwargs)
+
+    with patch('coruscant.api.get_es_client'), \
+            patch('coruscant.api_async.get_es_client', lambda: api.get_es_client()), \
+            patch('coruscant.api_async.get_async_es_client', lambda: AwaitableMock(api.get_es_client())), \
+            patch('coruscant.api_async.execute_async', execute), \
+            patch.object(Measurement, 'save_async', save):
+        yield AsyncAppClient(async_app)
+
+
+@pytest.fixture(params=['sync', 'async'])
+def client(request):
+    yield from _client(request.param)
+
+
+@pytest.fixture(params=['sync', 'async', 'columnar'])
+def backend(request):
+    return request.param
 
 
 @pytest.fixture
-def client():
+def backend_client(backend):
+    """
+    Same as `client`, plus the app with the columnar backend (see app_local.py), holding the measurements in
+    tests.columnar_test.ROWS. For the tests of the responses that don't depend on the ES mocks.
+    """
+    yield from _client(backend)
+
+
+@pytest.fixture(autouse=True)
+def clear_measurements_cache(tmp_path):
+    measurements_cache.clear()
+    with patch.object(measurements_cache, 'shared', SharedWrites(str(tmp_path / 'cache-writes'))), \
+            patch.object(measurements_cache, '_seen', None):
+        yield
+    measurements_cache.clear()
+
 
-    with app.test_client() as client:
-        yield client
+@pytest.fixture(autouse=True)
+def index_catalog_indexes():
+    """
+    Indexes from the first year in the dataset to 2021, and backfilled rollups, so the API doesn't read them from ES.
+    """
+    index_catalog.update(
+        (Measurement.index_for_day(date(year, 1, 1)) for year in range(1743, 2022)), rollups_ready=True
+    )
+    yield
+    index_catalog.clear()
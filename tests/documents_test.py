@@ -1,7 +1,10 @@
-from datetime import date
-from unittest.mock import patch
+import asyncio
+from datetime import date, datetime
+from unittest.mock import AsyncMock, patch
 
-from coruscant.documents import Measurement
+import pytest
+
+from coruscant.documents import IndexLayout, Measurement
 
 
 @patch('coruscant.documents.Document.save')
@@ -17,3 +20,174 @@ def test_save_index_name(m_save):
 
     measurement.save()
     m_save.assert_called_once_with(index='global_land_temperatures_by_city-2019')
+
+
+@patch('coruscant.documents.Document.save')
+def test_save_generates_deterministic_id(m_save):
+    measurement = Measurement(
+        day=date(2019, 11, 29),
+        city='Bristol',
+        country='United Kingdom',
+    )
+
+    measurement.save()
+    assert measurement.meta.id == Measurement.generate_id('Bristol', 'United Kingdom', '2019-11-29')
+    assert measurement.meta.routing == 'Bristol'
+
+
+@patch('coruscant.documents.get_async_es_client')
+def test_save_async(m_get_async_es_client):
+    m_get_async_es_client.return_value.index = AsyncMock(return_value={'_id': 'x', '_version': 1, 'result': 'created'})
+    measurement = Measurement(
+        day=date(2019, 11, 29),
+        average_temperature=32.2,
+        city='Bristol',
+        country='United Kingdom',
+    )
+
+    assert asyncio.run(measurement.save_async(request_timeout=10)) == 'created'
+    m_get_async_es_client.return_value.index.assert_awaited_once_with(
+        index='global_land_temperatures_by_city-2019',
+        id=Measurement.generate_id('Bristol', 'United Kingdom', '2019-11-29'),
+        body=measurement.to_dict(),
+        routing='Bristol',
+        request_timeout=10
+    )
+    assert measurement.meta.version == 1
+
+
+@pytest.mark.parametrize('day', [date(2019, 11, 1), datetime(2019, 11, 1), '2019-11-01'])
+def test_generate_id(day):
+    assert Measurement.generate_id('London', 'United Kingdom', day) == Measurement.generate_id(
+        'London', 'United Kingdom', '2019-11-01'
+    )
+    assert Measurement.generate_id('London', 'United Kingdom', day) != Measurement.generate_id(
+        'London', 'Canada', day
+    )
+
+
+@pytest.mark.parametrize('bulk_load, settings', [
+    (False, {
+        'number_of_shards': 1,
+        'number_of_replicas': 1,
+        'refresh_interval': '1s',
+        'translog.flush_threshold_size': '512mb'
+    }),
+    (True, {
+        'number_of_shards': 1,
+        'number_of_replicas': 0,
+        'refresh_interval': '-1',
+        'translog.flush_threshold_size': '2gb'
+    }),
+])
+def test_as_template(bulk_load, settings):
+    template = Measurement.as_template(bulk_load).to_dict()
+
+    assert template['index_patterns'] == ['global_land_temperatures_by_city-*']
+    assert template['settings'] == settings
+    assert template['mappings'] == Measurement._index.to_dict()['mappings']
+    # The production settings are left untouched
+    assert Measurement._index.to_dict()['settings']['refresh_interval'] == '1s'
+
+
+def test_routing_required():
+    assert Measurement._index.to_dict()['mappings']['_routing'] == {'required': True}
+
+
+@patch('coruscant.documents.INDEX_DECADE_SHARDS', 3)
+def test_decade_template():
+    assert Measurement.decade_template().to_dict() == {
+        'index_patterns': ['global_land_temperatures_by_city-*s'],
+        'order': 1,
+        'settings': {'number_of_shards': 3}
+    }
+
+
+def test_optimized_template():
+    template = Measurement.as_template(profile='optimized').to_dict()
+
+    assert template['mappings']['_routing'] == {'required': True}
+    assert template['mappings']['properties']['country'] == {'type': 'keyword'}
+    assert template['mappings']['properties']['average_temperature'] == {'type': 'float', 'index': False}
+    assert template['settings']['sort.field'] == ['average_temperature', 'city']
+    assert template['settings']['sort.order'] == ['desc', 'asc']
+    # The standard profile is left untouched
+    assert Measurement.as_template().to_dict()['mappings']['properties']['country'] == {'type': 'text'}
+    assert 'sort.field' not in Measurement.as_template().to_dict()['settings']
+
+
+def test_optimized_decade_template():
+    assert Measurement.decade_template('optimized').to_dict()['settings'] == {
+        'number_of_shards': 1, 'codec': 'best_compression'
+    }
+
+
+def test_dynamic_settings():
+    assert Measurement.dynamic_settings() == {
+        'number_of_replicas': 1,
+        'refresh_interval': '1s',
+        'translog.flush_threshold_size': '512mb'
+    }
+    assert Measurement.dynamic_settings(bulk_load=True) == Measurement.BULK_LOAD_SETTINGS
+
+
+DATASET_INDEXES = {Measurement.index_for_year(year) for year in range(1743, 2014)}
+
+
+@pytest.mark.parametrize('_from, _to, indexes, expected', [
+    (None, None, None, ['*']),
+    (date(2019, 1, 1), date(2019, 5, 1), None, ['2019']),
+    (date(2018, 3, 1), date(2019, 4, 7), None, ['2018', '2019']),
+    (date(1990, 1, 1), date(2012, 4, 7), None, ['1990s', '200*', '2010', '2011', '2012']),
+    (None, date(1999, 1, 1), None, ['1*']),
+    (None, date(2013, 1, 1), DATASET_INDEXES, ['*']),
+    (date(1800, 1, 1), None, DATASET_INDEXES, ['18*', '19*', '2*']),
+    (date(1745, 6, 1), date(1911, 1, 1), DATASET_INDEXES, ['17*', '18*', '1900s', '1910s']),
+    (date(1852, 6, 1), date(1911, 1, 1), DATASET_INDEXES, [
+        '1850s', '1860s', '1870s', '1880s', '1890s', '1900s', '1910s'
+    ]),
+    # Indexes from a previous layout are targeted too
+    (date(2000, 1, 1), date(2020, 1, 1), [
+        'global_land_temperatures_by_city-1999',
+        'global_land_temperatures_by_city-2001',
+        'global_land_temperatures_by_city-2021'
+    ], ['2001']),
+    (date(1850, 1, 1), date(1859, 1, 1), [
+        'global_land_temperatures_by_city-1850s',
+        'global_land_temperatures_by_city-1851',
+        'global_land_temperatures_by_city-1860s'
+    ], ['185*']),
+    (date(1500, 1, 1), date(1600, 1, 1), DATASET_INDEXES, ['none']),
+    (None, date(1600, 1, 1), DATASET_INDEXES, ['none']),
+])
+def test_get_indexes_for_range(_from, _to, indexes, expected):
+    assert Measurement.get_indexes_for_range(_from, _to, indexes) == ','.join(
+        f'global_land_temperatures_by_city-{index}' for index in expected
+    )
+
+
+@pytest.mark.parametrize('year, index', [
+    (1743, 'global_land_temperatures_by_city-1740s'),
+    (1899, 'global_land_temperatures_by_city-1890s'),
+    (1900, 'global_land_temperatures_by_city-1900'),
+    (2013, 'global_land_temperatures_by_city-2013'),
+])
+def test_index_for_year(year, index):
+    with patch.object(Measurement, 'layout', IndexLayout(hot_since=1900)):
+        assert Measurement.index_for_year(year) == index
+        assert Measurement.index_for_day(date(year, 7, 1)) == index
+
+
+@pytest.mark.parametrize('suffix, span', [
+    ('2013', (2013, 2013)),
+    ('1850s', (1850, 1859)),
+    ('1851s', None),
+    ('old', None),
+])
+def test_index_layout_span(suffix, span):
+    assert IndexLayout.span(suffix) == span
+
+
+def test_index_layout_hot_since_decade():
+    with pytest.raises(ValueError):
+        IndexLayout(hot_since=1995)
@@ -0,0 +1,89 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import AsyncMock, patch
+
+from elasticsearch import Transport
+from elasticsearch_dsl import connections
+
+from coruscant import es
+from coruscant.documents import Measurement
+
+
+def test_get_es_client_is_shared():
+    client = es.get_es_client()
+
+    assert es.get_es_client() is client
+    # elasticsearch-dsl uses the same client
+    assert connections.get_connection() is client
+    assert Measurement._get_connection() is client
+
+    with ThreadPoolExecutor(8) as pool:
+        assert set(pool.map(lambda _: es.get_es_client(), range(32))) == {client}
+
+
+def test_get_es_client_settings():
+    client = es.get_es_client()
+    connection = client.transport.get_connection()
+
+    assert connection.host == f'http://{es.ES_HOST}'
+    assert connection.pool.pool.maxsize == es.CLIENT_SETTINGS['maxsize']
+    assert connection.timeout == es.CLIENT_SETTINGS['timeout']
+
+
+def test_client_is_recreated_after_fork():
+    client = es.get_es_client()
+
+    es._reset_after_fork()
+
+    assert es.get_es_client() is not client
+    assert es.get_es_client() is connections.get_connection()
+
+
+def test_get_async_es_client_is_shared_per_loop():
+    async def get_clients():
+        return es.get_async_es_client(), es.get_async_es_client()
+
+    first, second = asyncio.run(get_clients())
+    assert first is second
+    assert asyncio.run(get_clients())[0] is not first
+
+    # The connections are only created on the first request
+    assert first.transport.hosts == [{'host': es.ES_HOST.split(':')[0], 'port': int(es.ES_HOST.split(':')[1])}]
+    assert first.transport.kwargs['maxsize'] == es.ASYNC_CLIENT_SETTINGS['maxsize']
+
+
+@patch('coruscant.es.get_async_es_client')
+def test_execute_async(m_get_async_es_client):
+    m_get_async_es_client.return_value.search = AsyncMock(return_value={'hits': {'hits': [
+        {'_index': 'global_land_temperatures_by_city-2013', '_id': '1', '_source': {'city': 'Ahvaz'}}
+    ]}})
+    search = Measurement.search().params(request_timeout=10).filter('term', city='Ahvaz')
+
+    response = asyncio.run(es.execute_async(search))
+
+    m_get_async_es_client.return_value.search.assert_awaited_once_with(
+        index=['global_land_temperatures_by_city-*'], body=search.to_dict(), request_timeout=10
+    )
+    assert isinstance(response.hits[0], Measurement)
+    assert response.hits[0].city == 'Ahvaz'
+
+
+@patch.object(Transport, 'perform_request', return_value={})
+def test_bounded_requests(m_perform_request):
+    transport = es.InstrumentedTransport([{'host': 'localhost'}], max_retries=3, retry_on_timeout=True)
+    client = type('Client', (), {'transport': transport})
+
+    with es.bounded_requests(client, time.monotonic() + 60, 5):
+        assert (transport.max_retries, transport.retry_on_timeout) == (0, False)
+        transport.perform_request('GET', '/')
+        transport.perform_request('POST', '/_search', params={'request_timeout': 2})
+    with es.bounded_requests(client, time.monotonic() + 1, 5):
+        transport.perform_request('POST', '/_search', params={'request_timeout': 10})
+    transport.perform_request('POST', '/_search', params={'request_timeout': 10})
+
+    timeouts = [c.kwargs['params']['request_timeout'] for c in m_perform_request.call_args_list]
+    assert timeouts[:2] == [5, 2]
+    assert 0 < timeouts[2] <= 1
+    assert timeouts[3] == 10
+    assert (transport.max_retries, transport.retry_on_timeout) == (3, True)
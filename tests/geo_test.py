@@ -0,0 +1,80 @@
+from datetime import date
+
+import pytest
+
+from coruscant.geo import cities_buckets, cities_query, grid_query, parse_area
+
+CIRCLE = {'lat': 31.35, 'lon': 49.01, 'distance': 500.0}
+BOX = {'top': 40.0, 'left': 40.0, 'bottom': 20.0, 'right': 60.0}
+
+
+@pytest.mark.parametrize('args, errors, area', [
+    ({}, [], None),
+    ({'lat': '31.35', 'lon': '49.01', 'distance': '500'}, [], CIRCLE),
+    ({'top': '40', 'left': '40', 'bottom': '20', 'right': '60'}, [], BOX),
+    # Crossing the antimeridian
+    ({'top': '40', 'left': '170', 'bottom': '20', 'right': '-170'}, [], {**BOX, 'left': 170.0, 'right': -170.0}),
+    (
+        {'lat': '31.35', 'top': '40'},
+        ['Please, provide either lat, lon and distance, or top, left, bottom and right'],
+        None
+    ),
+    ({'lat': '31.35', 'lon': 'east'}, ['Invalid lon: east', 'Missing param distance'], None),
+    (
+        {'lat': '91', 'lon': '49.01', 'distance': '0'},
+        ['lat must be between -90 and 90', 'distance must be positive'],
+        None
+    ),
+    ({'top': '20', 'left': '40', 'bottom': '40', 'right': '60'}, ['top has to be north of bottom'], None),
+])
+def test_parse_area(args, errors, area):
+    assert parse_area(args) == (errors, area)
+
+
+def test_cities_query():
+    indexes, body = cities_query(CIRCLE, 5, date(2012, 3, 1), date(2013, 12, 31))
+
+    assert indexes == 'global_land_temperatures_by_city-2012,global_land_temperatures_by_city-2013'
+    assert body['size'] == 0
+    assert body['query'] == {'bool': {'filter': [
+        {'exists': {'field': 'average_temperature'}},
+        {'geo_distance': {'distance': '500.0km', 'location': {'lat': 31.35, 'lon': 49.01}}},
+        {'range': {'day': {'gte': '2012-03-01', 'lte': '2013-12-31'}}},
+    ]}}
+    assert body['aggs']['cities']['terms'] == {
+        'field': 'city', 'size': 5, 'order': [{'max_temperature': 'desc'}, {'_key': 'asc'}]
+    }
+
+
+def test_grid_query():
+    indexes, body = grid_query(BOX, 4)
+
+    assert indexes == 'global_land_temperatures_by_city-*'
+    assert body['query'] == {'bool': {'filter': [
+        {'exists': {'field': 'average_temperature'}},
+        {'geo_bounding_box': {'location': {
+            'top_left': {'lat': 40.0, 'lon': 40.0}, 'bottom_right': {'lat': 20.0, 'lon': 60.0}
+        }}},
+    ]}}
+    assert body['aggs']['grid']['geohash_grid'] == {'field': 'location', 'precision': 4, 'size': 10000}
+
+    # The whole world
+    assert grid_query(None, 4)[1]['query'] == {'bool': {'filter': [{'exists': {'field': 'average_temperature'}}]}}
+
+
+def test_cities_buckets():
+    response = {'aggregations': {'cities': {'buckets': [{
+        'key': 'Ahvaz',
+        'doc_count': 12,
+        'average_temperature': {'value': 26.4},
+        'max_temperature': {'value': 39.156},
+        'location': {'location': {'lat': 31.35, 'lon': 49.01}, 'count': 12}
+    }]}}}
+
+    assert cities_buckets(response) == [{
+        'city': 'Ahvaz',
+        'average_temperature': 26.4,
+        'max_temperature': 39.156,
+        'measurements': 12,
+        'location': {'lat': 31.35, 'lon': 49.01}
+    }]
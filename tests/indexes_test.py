@@ -0,0 +1,64 @@
+from unittest.mock import Mock
+
+from coruscant.indexes import IndexCatalog
+
+
+def test_refresh():
+    client = Mock()
+    client.indices.get_alias.return_value = {
+        'global_land_temperatures_by_city-2013': {},
+        'global_land_temperatures_by_city-1740s': {},
+        'global_land_temperatures_by_city-old': {},
+    }
+    catalog = IndexCatalog()
+    assert catalog.indexes() is None
+
+    assert catalog.refresh(client) == {
+        'global_land_temperatures_by_city-1740s', 'global_land_temperatures_by_city-2013'
+    }
+    assert catalog.indexes() == {'global_land_temperatures_by_city-1740s', 'global_land_temperatures_by_city-2013'}
+    assert catalog.rollups_ready() is False
+    client.indices.get_alias.assert_called_once_with(
+        index='global_land_temperatures_by_city-*,global_land_temperatures_by_city_rollup*'
+    )
+
+
+def test_rollups_ready():
+    catalog = IndexCatalog()
+    assert catalog.rollups_ready() is None
+
+    catalog.load({'global_land_temperatures_by_city_rollup': {'aliases': {}}})
+    assert catalog.rollups_ready() is False
+
+    catalog.load({
+        'global_land_temperatures_by_city-2013': {'aliases': {}},
+        'global_land_temperatures_by_city_rollup': {
+            'aliases': {'global_land_temperatures_by_city_rollup_ready': {}}
+        },
+    })
+    assert catalog.rollups_ready() is True
+    assert catalog.indexes() == {'global_land_temperatures_by_city-2013'}
+
+
+def test_expires():
+    catalog = IndexCatalog(ttl=0)
+    catalog.update(['global_land_temperatures_by_city-2013'])
+    assert catalog.indexes() is None
+
+
+def test_add_year():
+    catalog = IndexCatalog()
+    catalog.add_year(2021)
+    assert catalog.indexes() is None
+
+    catalog.update(['global_land_temperatures_by_city-2013'])
+    catalog.add_year(2021)
+    catalog.add_year(1851)
+    assert catalog.indexes() == {
+        'global_land_temperatures_by_city-1850s',
+        'global_land_temperatures_by_city-2013',
+        'global_land_temperatures_by_city-2021'
+    }
+
+    catalog.clear()
+    assert catalog.indexes() is None
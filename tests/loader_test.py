@@ -0,0 +1,268 @@
+import json
+from datetime import date
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import Mock, patch
+
+import pytest
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+from elasticsearch.helpers import BulkIndexError
+from elasticsearch.serializer import JSONSerializer
+
+from coruscant.documents import Measurement
+from coruscant.loader import (
+    Checkpoint,
+    Progress,
+    actions_from_csv,
+    bulk_load_mode,
+    convert_byte_range,
+    csv_byte_ranges,
+    docs_from_csv,
+    fast_action,
+    generate_es_document,
+    header_size,
+    parallel_load,
+    send_with_retries,
+    serial_load
+)
+
+CSV_HEADER = 'dt,AverageTemperature,AverageTemperatureUncertainty,City,Country,Latitude,Longitude\n'
+CSV_ROWS = [
+    '1743-11-01,6.068,1.7369999999999999,Århus,Denmark,57.05N,10.33E\n',
+    '1743-12-01,,,Århus,Denmark,57.05N,10.33E\n',
+    '2013-07-01,39.156,0.37,Ahvaz,Iran,31.35N,49.01E\n',
+    '2012-07-01,38.531,0.431,Abadan,Iran,29.74N,48.00E\n',
+    '2013-08-01,10.5,0.2,Punta Arenas,Chile,53.84S,70.55W\n',
+]
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / 'temperatures.csv'
+    path.write_text(CSV_HEADER + ''.join(CSV_ROWS * 20), encoding='utf-8')
+    return str(path)
+
+
+def serialize(actions):
+    # elasticsearch_dsl orders the meta fields (_id, _routing) of a document as a frozenset does
+    serializer = JSONSerializer()
+    return [json.dumps(action, sort_keys=True, default=serializer.default) for action in actions]
+
+
+@pytest.mark.parametrize('shard_size', [1, 64, 1000, 10 ** 6])
+def test_csv_byte_ranges_cover_every_row_once(csv_file, shard_size):
+    ranges = list(csv_byte_ranges(csv_file, shard_size))
+
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+
+    actions = [action for start, end in ranges for action in convert_byte_range(csv_file, start, end)]
+    assert actions == [action for chunk in actions_from_csv(csv_file) for action in chunk]
+
+
+@pytest.mark.parametrize('row', [row.strip().split(',') for row in CSV_ROWS])
+def test_fast_action_matches_measurement(row):
+    header = CSV_HEADER.strip().split(',')
+
+    assert serialize([fast_action(row)]) == serialize([generate_es_document(dict(zip(header, row))).to_dict(True)])
+
+
+def test_actions_from_csv_matches_docs_from_csv(csv_file):
+    assert [serialize(chunk) for chunk in actions_from_csv(csv_file, 7)] == [
+        serialize(chunk) for chunk in docs_from_csv(csv_file, 7)
+    ]
+
+
+def test_docs_from_csv(csv_file):
+    assert next(docs_from_csv(csv_file))[:2] == [
+        {
+            '_index': 'global_land_temperatures_by_city-1740s',
+            '_routing': 'Århus',
+            '_id': Measurement.generate_id('Århus', 'Denmark', '1743-11-01'),
+            '_source': {
+                'day': date(1743, 11, 1),
+                'average_temperature': Decimal('6.068'),
+                'average_temperature_uncertainty': Decimal('1.7369999999999999'),
+                'city': 'Århus',
+                'country': 'Denmark',
+                'location': {'lat': Decimal('57.05'), 'lon': Decimal('10.33')}
+            }
+        },
+        {
+            '_index': 'global_land_temperatures_by_city-1740s',
+            '_routing': 'Århus',
+            '_id': Measurement.generate_id('Århus', 'Denmark', '1743-12-01'),
+            '_source': {
+                'day': date(1743, 12, 1),
+                'city': 'Århus',
+                'country': 'Denmark',
+                'location': {'lat': Decimal('57.05'), 'lon': Decimal('10.33')}
+            }
+        },
+    ]
+
+
+@patch('coruscant.loader.bulk')
+def test_parallel_load(m_bulk, csv_file):
+    m_bulk.return_value = (7, [])
+    progress = parallel_load(
+        None, csv_file, workers=2, senders=2, chunk_size=7, max_in_flight=2, shard_size=200,
+        progress=Progress(out=StringIO())
+    )
+
+    sent = [action for call in m_bulk.call_args_list for action in call.args[1]]
+    assert progress.rows == len(sent) == len(CSV_ROWS) * 20
+    assert sorted(serialize(sent)) == sorted(serialize(action for chunk in docs_from_csv(csv_file) for action in chunk))
+    assert all(call.kwargs == {'chunk_size': 7, 'raise_on_error': False} for call in m_bulk.call_args_list)
+
+
+@patch('coruscant.loader.bulk')
+def test_parallel_load_propagates_bulk_errors(m_bulk, csv_file):
+    m_bulk.side_effect = ConnectionError('ES is down')
+
+    with pytest.raises(ConnectionError):
+        parallel_load(None, csv_file, workers=2, senders=2, max_in_flight=2, shard_size=200)
+
+
+@pytest.mark.parametrize('load', [serial_load, parallel_load])
+@patch('coruscant.loader.bulk')
+def test_load_resumes_from_checkpoint(m_bulk, load, csv_file, tmp_path):
+    m_bulk.return_value = (7, [])
+    checkpoint_path = str(tmp_path / 'load.checkpoint')
+    # First range fails, so the checkpoint can't move past the header
+    m_bulk.side_effect = [ValueError('Unexpected error')] + [(7, [])] * 100
+
+    with pytest.raises(ValueError):
+        load(None, csv_file, shard_size=200, checkpoint=Checkpoint(checkpoint_path, csv_file))
+    assert Checkpoint(checkpoint_path, csv_file).begin(resume=True) == header_size(csv_file)
+
+    m_bulk.reset_mock()
+    m_bulk.side_effect = None
+    progress = load(
+        None, csv_file, shard_size=200, checkpoint=Checkpoint(checkpoint_path, csv_file),
+        progress=Progress(out=StringIO())
+    )
+    assert progress.rows == len(CSV_ROWS) * 20
+
+    file_size = len((CSV_HEADER + ''.join(CSV_ROWS * 20)).encode('utf-8'))
+    checkpoint = Checkpoint(checkpoint_path, csv_file)
+    assert checkpoint.begin(resume=True) == file_size
+    assert checkpoint.begin(resume=False) == header_size(csv_file)
+
+    # Nothing left to load
+    m_bulk.reset_mock()
+    load(None, csv_file, checkpoint=Checkpoint(checkpoint_path, csv_file), resume=True)
+    m_bulk.assert_not_called()
+
+
+def test_checkpoint_acknowledged_out_of_order(csv_file, tmp_path):
+    checkpoint_path = str(tmp_path / 'load.checkpoint')
+    checkpoint = Checkpoint(checkpoint_path, csv_file)
+    start = checkpoint.begin()
+    ranges = list(zip(range(start, start + 40, 10), range(start + 10, start + 50, 10)))
+
+    checkpoint.acknowledge(*ranges[1])
+    checkpoint.acknowledge(*ranges[3])
+    assert checkpoint.offset == start
+    checkpoint.acknowledge(*ranges[0])
+    assert checkpoint.offset == ranges[1][1]
+    assert Checkpoint(checkpoint_path, csv_file).begin(resume=True) == ranges[1][1]
+    checkpoint.acknowledge(*ranges[2])
+    assert checkpoint.offset == ranges[3][1]
+
+
+def test_checkpoint_from_another_file(csv_file, tmp_path):
+    checkpoint_path = str(tmp_path / 'load.checkpoint')
+    checkpoint = Checkpoint(checkpoint_path, csv_file)
+    checkpoint.acknowledge(checkpoint.begin(), 100)
+
+    other_file = tmp_path / 'other.csv'
+    other_file.write_text(CSV_HEADER)
+    with pytest.raises(ValueError):
+        Checkpoint(checkpoint_path, str(other_file)).begin(resume=True)
+
+
+@patch('coruscant.loader.time.sleep')
+@patch('coruscant.loader.bulk')
+def test_send_with_retries(m_bulk, m_sleep):
+    actions = [{'_index': 'i', '_id': str(i), '_source': {}} for i in range(4)]
+    m_bulk.side_effect = [
+        ESConnectionError('N/A', 'ES is down', None),
+        (2, [
+            {'index': {'_id': '1', 'status': 429, 'error': 'rejected'}},
+            {'index': {'_id': '2', 'status': 400, 'error': 'mapper_parsing_exception'}},
+        ]),
+        (1, []),
+    ]
+    progress = Progress(out=StringIO())
+
+    send_with_retries(None, actions, max_retries=3, initial_backoff=1, progress=progress)
+
+    assert [call.args[1] for call in m_bulk.call_args_list] == [actions, actions, [actions[1]]]
+    assert [call.args[0] for call in m_sleep.call_args_list] == [1, 2]
+    assert progress.rejected == 1
+
+
+@patch('coruscant.loader.time.sleep')
+@patch('coruscant.loader.bulk')
+def test_send_with_retries_gives_up(m_bulk, m_sleep):
+    m_bulk.return_value = (0, [{'index': {'_id': '0', 'status': 503, 'error': 'unavailable'}}])
+
+    with pytest.raises(BulkIndexError):
+        send_with_retries(None, [{'_id': '0', '_source': {}}], max_retries=2)
+    assert m_bulk.call_count == 3
+
+
+def test_bulk_load_mode():
+    client = Mock()
+
+    with bulk_load_mode(client):
+        client.indices.put_settings.assert_called_once_with(
+            index='global_land_temperatures_by_city-*',
+            body={'index': Measurement.BULK_LOAD_SETTINGS},
+            allow_no_indices=True
+        )
+        templates = [call.kwargs for call in client.indices.put_template.call_args_list]
+        assert [template['name'] for template in templates] == [
+            'global_land_temperatures_by_city',
+            'global_land_temperatures_by_city_decades',
+            'global_land_temperatures_by_city_rollup'
+        ]
+        assert templates[0]['body']['settings']['refresh_interval'] == '-1'
+        assert templates[1]['body'] == {
+            'index_patterns': ['global_land_temperatures_by_city-*s'], 'order': 1, 'settings': {'number_of_shards': 1}
+        }
+        client.reset_mock()
+
+    assert [call[0] for call in client.mock_calls] == [
+        'indices.forcemerge',
+        'indices.put_template',
+        'indices.put_template',
+        'indices.put_template',
+        'indices.put_settings'
+    ]
+    assert client.indices.forcemerge.call_args.kwargs['index'] == (
+        f'global_land_temperatures_by_city-*,-global_land_temperatures_by_city-{date.today().year}'
+    )
+    client.indices.put_settings.assert_called_once_with(
+        index='global_land_temperatures_by_city-*',
+        body={'index': Measurement.dynamic_settings()},
+        allow_no_indices=True
+    )
+    assert client.indices.put_template.call_args_list[0].kwargs['body']['settings']['refresh_interval'] == '1s'
+
+
+def test_bulk_load_mode_restores_settings_on_errors():
+    client = Mock()
+
+    with pytest.raises(ValueError):
+        with bulk_load_mode(client):
+            client.reset_mock()
+            raise ValueError('Unexpected error')
+
+    client.indices.forcemerge.assert_not_called()
+    client.indices.put_settings.assert_called_once_with(
+        index='global_land_temperatures_by_city-*',
+        body={'index': Measurement.dynamic_settings()},
+        allow_no_indices=True
+    )
@@ -0,0 +1,85 @@
+import logging
+from unittest.mock import patch
+
+from elasticsearch import Transport
+
+from coruscant import metrics
+from coruscant.es import InstrumentedTransport
+
+
+def value(line_prefix):
+    lines = [line for line in metrics.render().splitlines() if line.startswith(line_prefix)]
+    return float(lines[0].rsplit(' ', 1)[1]) if lines else 0
+
+
+def test_histogram():
+    histogram = metrics.Histogram('test_seconds', 'Test.', ('endpoint',), buckets=(0.1, 1))
+    for seconds in (0.05, 0.1, 0.5, 3):
+        histogram.observe(seconds, endpoint='/a"b')
+
+    assert histogram.render() == [
+        '# HELP test_seconds Test.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{endpoint="/a\\"b",le="0.1"} 2',
+        'test_seconds_bucket{endpoint="/a\\"b",le="1"} 3',
+        'test_seconds_bucket{endpoint="/a\\"b",le="+Inf"} 4',
+        'test_seconds_sum{endpoint="/a\\"b"} 3.65',
+        'test_seconds_count{endpoint="/a\\"b"} 4',
+    ]
+
+
+@patch('coruscant.api.get_es_client')
+def test_metrics_endpoint(m_es_client, client):
+    m_es_client.return_value.search.return_value = {'hits': {'hits': []}}
+    requests = 'coruscant_request_duration_seconds_count{method="GET",endpoint="/api/measurements",status="200"}'
+    before = value(requests), value('coruscant_cache_misses_total')
+    coalescing_searches = value('coruscant_coalescing_searches_total')
+
+    client.get('/api/measurements?from=2010-01-01&to=2012-05-01')
+    client.get('/api/measurements?from=2010-01-01&to=2012-05-01')
+    resp = client.get('/metrics')
+
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/plain'
+    assert (value(requests), value('coruscant_cache_misses_total')) == (before[0] + 2, before[1] + 1)
+    assert value('coruscant_coalescing_searches_total') == coalescing_searches + 1
+    assert 'coruscant_response_size_bytes_bucket{method="GET",endpoint="/api/measurements",le="100"}' in (
+        resp.data.decode('utf-8')
+    )
+
+
+@patch.object(Transport, 'perform_request', return_value={'took': 250, 'hits': {'hits': []}})
+def test_instrumented_transport(m_perform_request):
+    took = 'coruscant_es_took_seconds_count{api="_search"}'
+    before = (
+        value(took), value('coruscant_es_took_seconds_sum{api="_search"}'),
+        value('coruscant_indexes_per_search_count'), value('coruscant_indexes_per_search_sum')
+    )
+    transport = InstrumentedTransport([{'host': 'localhost'}])
+
+    # A top cities search: the rollups, and the yearly indexes of the partial years
+    response = transport.perform_request(
+        'POST', '/global_land_temperatures_by_city_rollup,global_land_temperatures_by_city-2013/_search',
+        body={'size': 0}
+    )
+    # Neither searches of a point in time nor other requests target indexes
+    transport.perform_request('POST', '/_search', body={'pit': {'id': 'pit'}})
+    transport.perform_request('GET', '/global_land_temperatures_by_city-2013/_count')
+
+    assert response['took'] == 250
+    assert value(took) == before[0] + 2
+    assert value('coruscant_es_took_seconds_sum{api="_search"}') == before[1] + 0.5
+    assert value('coruscant_indexes_per_search_count') == before[2] + 1
+    assert value('coruscant_indexes_per_search_sum') == before[3] + 2
+
+
+@patch('coruscant.metrics.SLOW_REQUEST_SECONDS', 1e-9)
+def test_slow_request_log(caplog):
+    with caplog.at_level(logging.WARNING, logger='coruscant.metrics'):
+        metrics.start_request()
+        metrics.observe_es_request('POST', '/_search', {'query': {'match_all': {}}}, 0.5, {'took': 400})
+        metrics.finish_request('GET', '/api/measurements', '/api/measurements', 200, 10)
+
+    assert 'Slow request GET /api/measurements (200)' in caplog.text
+    assert '"body": {"query": {"match_all": {}}}' in caplog.text
+    assert '"took": 400' in caplog.text
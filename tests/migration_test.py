@@ -0,0 +1,132 @@
+from unittest.mock import Mock
+
+import pytest
+
+from coruscant import migration
+
+PREFIX = 'global_land_temperatures_by_city-'
+
+
+def test_migration_plan():
+    assert migration.migration_plan([
+        f'{PREFIX}1850', f'{PREFIX}1851', f'{PREFIX}1860s', f'{PREFIX}1999', f'{PREFIX}2013', 'other'
+    ]) == {
+        f'{PREFIX}1850s': [f'{PREFIX}1850', f'{PREFIX}1851'],
+        f'{PREFIX}1990s': [f'{PREFIX}1999'],
+    }
+
+
+def test_migration_plan_splits_decades():
+    assert migration.migration_plan([f'{PREFIX}2000s', f'{PREFIX}2010s'])[f'{PREFIX}2003'] == [f'{PREFIX}2000s']
+
+
+def test_migrate():
+    client = Mock()
+    client.indices.get_alias.return_value = {f'{PREFIX}1850': {}, f'{PREFIX}1851': {}, f'{PREFIX}2013': {}}
+    client.reindex.return_value = {'failures': []}
+
+    migration.migrate(client)
+
+    client.reindex.assert_called_once_with(body={
+        'source': {
+            'index': f'{PREFIX}1850,{PREFIX}1851',
+            'query': {'range': {'day': {'gte': '1850-01-01', 'lte': '1859-12-31'}}}
+        },
+        'dest': {'index': f'{PREFIX}1850s'},
+        'script': migration.ROUTING_SCRIPT
+    }, refresh=True, wait_for_completion=True, request_timeout=migration.REINDEX_TIMEOUT)
+    client.indices.delete.assert_called_once_with(index=f'{PREFIX}1850,{PREFIX}1851')
+
+
+def test_reindex_routes_by_city():
+    # Documents indexed before the writes were routed by city have no routing, and the templates require it
+    client = Mock()
+    client.indices.get_alias.return_value = {f'{PREFIX}1850': {}}
+    client.indices.get.return_value = {f'{PREFIX}1850s': index()}
+    client.reindex.return_value = {'failures': []}
+    client.count.return_value = {'count': 120}
+
+    migration.migrate(client)
+    client.indices.get_alias.return_value = {}
+    migration.reindex_profile(client, 'optimized')
+
+    assert [call.kwargs['body']['script'] for call in client.reindex.call_args_list] == [
+        {'source': 'ctx._routing = ctx._source.city', 'lang': 'painless'}
+    ] * 3
+
+
+def test_migrate_keeps_sources_on_failure():
+    client = Mock()
+    client.indices.get_alias.return_value = {f'{PREFIX}1850': {}}
+    client.reindex.return_value = {'failures': [{'cause': 'mapper_parsing_exception'}]}
+
+    with pytest.raises(RuntimeError):
+        migration.migrate(client)
+    client.indices.delete.assert_not_called()
+
+
+def index(sorted_segments=False):
+    settings = {'number_of_shards': '1'}
+    if sorted_segments:
+        settings['sort'] = {'field': ['average_temperature', 'city']}
+    return {'settings': {'index': settings}, 'mappings': {'properties': {'country': {'type': 'text'}}}}
+
+
+def test_profile_plan():
+    indexes = {f'{PREFIX}1850s': index(), f'{PREFIX}2013': index(sorted_segments=True), 'other': index()}
+
+    assert migration.profile_plan(indexes, 'optimized') == [f'{PREFIX}1850s']
+    assert migration.profile_plan(indexes, 'standard') == [f'{PREFIX}2013']
+
+
+def test_reindex_profile():
+    client = Mock()
+    client.indices.get.return_value = {f'{PREFIX}1850s': index(), f'{PREFIX}2013': index(sorted_segments=True)}
+    client.indices.get_alias.return_value = {}
+    client.reindex.return_value = {'failures': []}
+    client.count.return_value = {'count': 120}
+
+    assert migration.reindex_profile(client, 'optimized') == [f'{PREFIX}1850s']
+
+    assert [call.kwargs['name'] for call in client.indices.put_template.call_args_list] == [
+        'global_land_temperatures_by_city', 'global_land_temperatures_by_city_decades'
+    ]
+    client.indices.add_block.assert_called_once_with(index=f'{PREFIX}1850s', block='write')
+    assert client.indices.create.call_args.kwargs['index'] == f'{migration.STAGING_PREFIX}1850s'
+    assert [call.kwargs['body']['dest']['index'] for call in client.reindex.call_args_list] == [
+        f'{migration.STAGING_PREFIX}1850s', f'{PREFIX}1850s'
+    ]
+    assert [call.kwargs['index'] for call in client.indices.delete.call_args_list] == [
+        f'{migration.STAGING_PREFIX}1850s', f'{PREFIX}1850s', f'{migration.STAGING_PREFIX}1850s'
+    ]
+
+
+def test_reindex_profile_resumes_from_staging():
+    client = Mock()
+    client.indices.get.return_value = {f'{PREFIX}2013': index(sorted_segments=True)}
+    client.indices.get_alias.return_value = {
+        f'{migration.STAGING_PREFIX}1850s': {}, f'{migration.STAGING_PREFIX}2013': {}
+    }
+    client.reindex.return_value = {'failures': []}
+    client.count.return_value = {'count': 120}
+
+    assert migration.reindex_profile(client, 'optimized') == [f'{PREFIX}1850s', f'{PREFIX}2013']
+
+    client.indices.add_block.assert_not_called()
+    assert [call.kwargs['body']['source']['index'] for call in client.reindex.call_args_list] == [
+        f'{migration.STAGING_PREFIX}1850s', f'{migration.STAGING_PREFIX}2013'
+    ]
+
+
+def test_reindex_profile_keeps_sources_on_lost_documents():
+    client = Mock()
+    client.indices.get.return_value = {f'{PREFIX}1850s': index()}
+    client.indices.get_alias.return_value = {}
+    client.reindex.return_value = {'failures': []}
+    client.count.side_effect = [{'count': 120}, {'count': 119}]
+
+    with pytest.raises(RuntimeError):
+        migration.reindex_profile(client, 'optimized')
+    assert [call.kwargs['index'] for call in client.indices.delete.call_args_list] == [
+        f'{migration.STAGING_PREFIX}1850s'
+    ]
@@ -0,0 +1,241 @@
+from bisect import bisect_right
+from datetime import date, datetime
+from unittest.mock import Mock, patch
+
+import pytest
+
+from coruscant import rollups
+from coruscant.documents import MeasurementRollup
+
+MEASUREMENT = {
+    'day': datetime(2013, 7, 1),
+    'average_temperature': 39.156,
+    'average_temperature_uncertainty': 0.37,
+    'city': 'Ahvaz',
+    'country': 'Iran',
+    'location': {'lat': 31.35, 'lon': 49.01}
+}
+
+
+def measurement(day, temperature, city='Ahvaz'):
+    return {**MEASUREMENT, 'day': day, 'average_temperature': temperature, 'city': city}
+
+
+@pytest.mark.parametrize('day', [date(2013, 7, 1), datetime(2013, 7, 1), '2013-07-01', '2013-07-01T00:00:00'])
+def test_rollup_documents(day):
+    source = {**MEASUREMENT, 'day': '2013-07-01'}
+    assert rollups.rollup_documents({**MEASUREMENT, 'day': day}) == [
+        {**source, 'period': 'year', 'year': 2013},
+        {**source, 'period': 'month', 'month': 7},
+    ]
+
+
+@patch('coruscant.rollups.bulk')
+def test_record(m_bulk):
+    client = Mock()
+    rollups.record(client, MEASUREMENT)
+
+    year_doc, month_doc = rollups.rollup_documents(MEASUREMENT)
+    actions = m_bulk.call_args.args[1]
+    assert [action['_id'] for action in actions] == [
+        MeasurementRollup.generate_id('Ahvaz', 'year', 2013),
+        MeasurementRollup.generate_id('Ahvaz', 'month', 7),
+    ]
+    assert [action['upsert'] for action in actions] == [year_doc, month_doc]
+    assert all(action['_op_type'] == 'update' for action in actions)
+    assert all(action['script']['params']['doc'] == action['upsert'] for action in actions)
+
+
+@patch('coruscant.rollups.bulk')
+def test_record_without_temperature(m_bulk):
+    rollups.record(Mock(), {**MEASUREMENT, 'average_temperature': None})
+    m_bulk.assert_not_called()
+
+
+@pytest.mark.parametrize('before, after, recomputed', [
+    (39.1, 40.2, False),
+    (39.1, 39.1, False),
+    (None, 20.1, False),
+    (39.1, 20.1, True),
+    (39.1, None, True),
+])
+@patch('coruscant.rollups.recompute')
+@patch('coruscant.rollups.record')
+def test_measurement_updated(m_record, m_recompute, before, after, recomputed):
+    client = Mock()
+    rollups.measurement_updated(
+        client, {**MEASUREMENT, 'average_temperature': before}, {**MEASUREMENT, 'average_temperature': after}
+    )
+
+    if recomputed:
+        m_recompute.assert_called_once_with(client, 'Ahvaz', MEASUREMENT['day'])
+        m_record.assert_not_called()
+    else:
+        m_record.assert_called_once_with(client, {**MEASUREMENT, 'average_temperature': after})
+        m_recompute.assert_not_called()
+
+
+@patch('coruscant.rollups.bulk')
+def test_recompute(m_bulk):
+    client = Mock()
+    client.search.side_effect = [
+        {'hits': {'hits': [{'_source': measurement('2013-08-01', 38.2)}]}},
+        {'hits': {'hits': []}},
+    ]
+
+    rollups.recompute(client, 'Ahvaz', '2013-07-01')
+
+    client.indices.refresh.assert_called_once_with(
+        index='global_land_temperatures_by_city-2013', ignore_unavailable=True
+    )
+    assert [call.kwargs['routing'] for call in client.search.call_args_list] == ['Ahvaz', 'Ahvaz']
+    assert m_bulk.call_args.args[1] == [
+        {
+            '_index': rollups.ROLLUP_INDEX,
+            '_id': MeasurementRollup.generate_id('Ahvaz', 'year', 2013),
+            '_source': {**measurement('2013-08-01', 38.2), 'period': 'year', 'year': 2013}
+        },
+        {
+            '_op_type': 'delete',
+            '_index': rollups.ROLLUP_INDEX,
+            '_id': MeasurementRollup.generate_id('Ahvaz', 'month', 7),
+        },
+    ]
+
+
+class CompositeClient:
+    """
+    Fake client answering the composite aggregation of the backfill with the hottest measurements given
+    per index, in pages, like ES.
+    """
+
+    def __init__(self, hottest_per_index):
+        self.buckets = {
+            index: sorted(((doc['city'], doc['day'][:7]), doc) for doc in docs)
+            for index, docs in hottest_per_index.items()
+        }
+        self.keys = {index: [key for key, _ in buckets] for index, buckets in self.buckets.items()}
+        self.indices = Mock()
+        self.indices.get_alias.return_value = {index: {} for index in hottest_per_index}
+        self.searches = []
+
+    def search(self, index, body, **kwargs):
+        composite = body['aggs']['months']['composite']
+        self.searches.append((index, composite))
+        start = 0
+        if 'after' in composite:
+            start = bisect_right(self.keys[index], (composite['after']['city'], composite['after']['month']))
+        page = self.buckets[index][start:start + composite['size']]
+        months = {'buckets': [
+            {'key': {'city': city, 'month': month}, 'hottest': {'hits': {'hits': [{'_source': doc}]}}}
+            for (city, month), doc in page
+        ]}
+        if page:
+            months['after_key'] = months['buckets'][-1]['key']
+        return {'aggregations': {'months': months}}
+
+
+def test_backfill_actions():
+    client = CompositeClient({
+        'global_land_temperatures_by_city-2013': [measurement('2013-07-01', 39.1), measurement('2013-08-01', 37.2)],
+        'global_land_temperatures_by_city-2012': [
+            measurement('2012-07-01', 38.5), measurement('2012-08-01', 38.9), measurement('2012-07-01', 30.1, 'Abadan')
+        ],
+    })
+
+    actions = list(rollups._backfill_actions(client))
+
+    assert [index for index, _ in client.searches] == [
+        'global_land_temperatures_by_city-2012', 'global_land_temperatures_by_city-2013'
+    ]
+    assert {(a['_source']['city'], a['_source']['period'], a['_source']['day']) for a in actions} == {
+        ('Ahvaz', 'year', '2012-08-01'),
+        ('Abadan', 'year', '2012-07-01'),
+        ('Ahvaz', 'year', '2013-07-01'),
+        ('Ahvaz', 'month', '2013-07-01'),
+        ('Ahvaz', 'month', '2012-08-01'),
+        ('Abadan', 'month', '2012-07-01'),
+    }
+    assert len(actions) == 6
+
+
+def test_backfill_decade_index():
+    # A decade index, with more (city, month) buckets than search.max_buckets (65535 by default). The
+    # dataset has ~3.4k cities, i.e. ~400k buckets per decade.
+    cities = [f'City {i:04d}' for i in range(600)]
+    months = [f'{year}-{month:02d}-01' for year in range(1850, 1860) for month in range(1, 13)]
+    client = CompositeClient({'global_land_temperatures_by_city-1850s': [
+        {'city': city, 'day': day, 'average_temperature': float(i)} for city in cities for i, day in enumerate(months)
+    ]})
+
+    actions = list(rollups._backfill_actions(client))
+
+    # Every search stays within search.max_buckets, and the pages cover every (city, month)
+    assert all(composite['size'] <= 65535 for _, composite in client.searches)
+    assert len(client.searches) == len(cities) * len(months) // rollups.BACKFILL_PAGE_SIZE + 1
+    assert len(actions) == len(cities) * 10 + len(cities) * 12
+    assert {a['_source']['day'] for a in actions if a['_source']['period'] == 'year'} == {
+        f'{year}-12-01' for year in range(1850, 1860)
+    }
+
+
+@patch('coruscant.rollups.bulk')
+def test_record_many(m_bulk):
+    rollups.record_many(Mock(), [
+        MEASUREMENT,
+        {**MEASUREMENT, 'average_temperature': None},
+        measurement('2012-01-01', 12.1, 'Abadan'),
+    ])
+
+    assert [action['upsert']['city'] for action in m_bulk.call_args.args[1]] == ['Ahvaz', 'Ahvaz', 'Abadan', 'Abadan']
+    assert m_bulk.call_args.kwargs['chunk_size'] == 4
+
+
+@patch('coruscant.rollups.record_many')
+@patch('coruscant.rollups.recompute')
+def test_measurements_updated(m_recompute, m_record_many):
+    client = Mock()
+    hottest_2013 = rollups.rollup_documents(measurement('2013-07-01', 39.1))
+    client.mget.return_value = {'docs': [
+        {'_id': rollups._rollup_id(hottest_2013[0]), 'found': True, '_source': hottest_2013[0]},
+        {'_id': rollups._rollup_id(hottest_2013[1]), 'found': True, '_source': hottest_2013[1]},
+        {'_id': 'other', 'found': False},
+    ]}
+    colder = measurement('2013-07-01', 30.2)
+    not_the_hottest = measurement('2013-08-01', 20.2)
+    new_city = measurement('2013-08-01', 20.2, 'Abadan')
+
+    rollups.measurements_updated(client, [colder, not_the_hottest, new_city])
+
+    m_recompute.assert_called_once_with(client, 'Ahvaz', '2013-07-01')
+    m_record_many.assert_called_once_with(client, [not_the_hottest, new_city])
+    assert len(client.mget.call_args.kwargs['body']['ids']) == 6
+
+
+def test_measurements_updated_nothing_updated():
+    client = Mock()
+    rollups.measurements_updated(client, [])
+    client.mget.assert_not_called()
+
+
+@patch('coruscant.rollups._backfill_actions')
+@patch('coruscant.rollups.MeasurementRollup.init')
+@patch('coruscant.rollups.bulk')
+def test_backfill_dynamic_mapping(m_bulk, m_init, m_actions):
+    # An add created the index before its template was saved, mapping the city as text
+    client = Mock()
+    client.indices.get_mapping.return_value = {rollups.ROLLUP_INDEX: {'mappings': {'properties': {
+        'city': {'type': 'text', 'fields': {'keyword': {'type': 'keyword'}}}
+    }}}}
+
+    rollups.backfill(client)
+
+    assert client.indices.put_template.call_args.kwargs['name'] == rollups.ROLLUP_INDEX
+    client.indices.delete.assert_called_once_with(index=rollups.ROLLUP_INDEX)
+    m_init.assert_called_once_with(using=client)
+    m_bulk.assert_called_once_with(client, m_actions.return_value, chunk_size=10000)
+    # Only searched once every rollup is there
+    assert [call[0] for call in client.mock_calls][-2:] == ['indices.refresh', 'indices.put_alias']
+    client.indices.put_alias.assert_called_once_with(
+        index=rollups.ROLLUP_INDEX, name='global_land_temperatures_by_city_rollup_ready'
+    )
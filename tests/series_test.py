@@ -0,0 +1,85 @@
+from datetime import date
+
+import pytest
+
+from coruscant.series import series_points, series_query
+
+
+def bucket(day, temperatures, uncertainties):
+    weights = [1 / uncertainty ** 2 for uncertainty in uncertainties]
+    return {
+        'key_as_string': day,
+        'doc_count': len(temperatures),
+        'temperature': {
+            'count': len(temperatures),
+            'min': min(temperatures),
+            'max': max(temperatures),
+            'avg': sum(temperatures) / len(temperatures),
+            'sum': sum(temperatures)
+        },
+        'weight': {'value': sum(weights)},
+        'weighted_temperature': {'value': sum(t * w for t, w in zip(temperatures, weights))},
+    }
+
+
+def response(*buckets):
+    return {'aggregations': {'series': {'buckets': list(buckets)}}}
+
+
+YEARS = [
+    bucket('1998-01-01', [10.0, 20.0], [1.0, 1.0]),
+    bucket('1999-01-01', [12.0], [0.5]),
+    bucket('2000-01-01', [30.0, 14.0], [2.0, 0.5]),
+]
+
+
+def test_series_query():
+    indexes, body = series_query('Ahvaz', 'month', 'Iran', date(2013, 1, 1), date(2013, 12, 31))
+
+    assert indexes == 'global_land_temperatures_by_city-2013'
+    assert body['size'] == 0
+    assert body['query'] == {'bool': {'filter': [
+        {'term': {'city': 'Ahvaz'}},
+        {'exists': {'field': 'average_temperature'}},
+        {'match_phrase': {'country': 'Iran'}},
+        {'range': {'day': {'gte': '2013-01-01', 'lte': '2013-12-31'}}},
+    ]}}
+    assert body['aggs']['series']['date_histogram']['calendar_interval'] == '1M'
+
+
+def test_series_points():
+    points = series_points(response(*YEARS), 'year')
+
+    assert [point['day'] for point in points] == ['1998-01-01', '1999-01-01', '2000-01-01']
+    assert points[0] == {
+        'day': '1998-01-01',
+        'average_temperature': 15.0,
+        'min_temperature': 10.0,
+        'max_temperature': 20.0,
+        'weighted_temperature': 15.0,
+        'measurements': 2,
+    }
+    # The precise measurement weighs 16 times more
+    assert points[2]['weighted_temperature'] == pytest.approx((30 * 0.25 + 14 * 4) / 4.25)
+
+
+def test_series_decades():
+    points = series_points(response(*YEARS), 'decade')
+
+    assert [(point['day'], point['measurements']) for point in points] == [('1990-01-01', 3), ('2000-01-01', 2)]
+    assert points[0]['average_temperature'] == 14.0
+    assert points[0]['min_temperature'] == 10.0
+    assert points[0]['weighted_temperature'] == pytest.approx((10 + 20 + 12 * 4) / 6)
+
+
+@pytest.mark.parametrize('points, days', [
+    (None, ['1998-01-01', '1999-01-01', '2000-01-01']),
+    (3, ['1998-01-01', '1999-01-01', '2000-01-01']),
+    (2, ['1998-01-01', '2000-01-01']),
+    (1, ['1998-01-01']),
+])
+def test_series_downsampling(points, days):
+    series = series_points(response(*YEARS), 'year', points)
+
+    assert [point['day'] for point in series] == days
+    assert sum(point['measurements'] for point in series) == 5
@@ -0,0 +1,110 @@
+import struct
+from io import StringIO
+from unittest.mock import patch
+
+import pytest
+
+from coruscant.columnar import ColumnarStore
+from coruscant.loader import Checkpoint, Progress, actions_from_csv, data_ranges, parallel_load, serial_load
+from coruscant.snapshot import PRELUDE, Snapshot, convert_csv, is_snapshot, row_ranges
+from tests.loader_test import CSV_HEADER, CSV_ROWS, serialize
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / 'temperatures.csv'
+    path.write_text(CSV_HEADER + ''.join(CSV_ROWS * 20), encoding='utf-8')
+    return str(path)
+
+
+@pytest.fixture
+def snapshot_file(csv_file, tmp_path):
+    path = str(tmp_path / 'temperatures.snapshot')
+    convert_csv(csv_file, path)
+    return path
+
+
+def test_convert_csv(csv_file, snapshot_file):
+    assert is_snapshot(snapshot_file)
+    assert not is_snapshot(csv_file)
+
+    with Snapshot(snapshot_file) as snapshot:
+        assert len(snapshot) == len(CSV_ROWS) * 20
+        assert snapshot.cities == ['Århus', 'Ahvaz', 'Abadan', 'Punta Arenas']
+        assert snapshot.countries == ['Denmark', 'Iran', 'Chile']
+        assert snapshot.columns['month'].dtype == 'int32'
+        # Backed by the file
+        assert not snapshot.columns['average_temperature'].flags.writeable
+
+
+def test_actions_match_csv(csv_file, snapshot_file):
+    with Snapshot(snapshot_file) as snapshot:
+        actions = snapshot.actions(0, len(snapshot))
+
+    assert serialize(actions) == serialize(action for chunk in actions_from_csv(csv_file) for action in chunk)
+
+
+@pytest.mark.parametrize('shard_rows, start', [(1, None), (7, None), (7, 30), (1000, None)])
+def test_row_ranges(snapshot_file, shard_rows, start):
+    ranges = list(row_ranges(snapshot_file, shard_rows, start))
+
+    assert ranges[0][0] == (start or 0)
+    assert ranges[-1][1] == len(CSV_ROWS) * 20
+    for (_, end), (next_start, _) in zip(ranges, ranges[1:]):
+        assert end == next_start
+    assert all(end - range_start <= shard_rows for range_start, end in ranges)
+
+
+def test_wrong_version(snapshot_file):
+    with open(snapshot_file, 'r+b') as snapshot:
+        magic, _, header_length = PRELUDE.unpack(snapshot.read(PRELUDE.size))
+        snapshot.seek(0)
+        snapshot.write(PRELUDE.pack(magic, 2, header_length))
+
+    with pytest.raises(ValueError, match='Unsupported snapshot version 2'):
+        Snapshot(snapshot_file)
+
+
+def test_corrupted(snapshot_file):
+    with open(snapshot_file, 'r+b') as snapshot:
+        snapshot.seek(-8, 2)
+        snapshot.write(struct.pack('<d', 1.5))
+
+    with pytest.raises(ValueError, match='checksum'):
+        Snapshot(snapshot_file)
+    # Not verified when converting the ranges, as the load already did it
+    Snapshot(snapshot_file, verify=False).close()
+
+
+def test_not_a_snapshot(csv_file):
+    with pytest.raises(ValueError, match='not a snapshot'):
+        Snapshot(csv_file)
+
+
+@pytest.mark.parametrize('load', [serial_load, parallel_load])
+@patch('coruscant.loader.bulk')
+def test_load_snapshot(m_bulk, load, csv_file, snapshot_file, tmp_path):
+    m_bulk.return_value = (7, [])
+    checkpoint_path = str(tmp_path / 'load.checkpoint')
+
+    progress = load(
+        None, snapshot_file, checkpoint=Checkpoint(checkpoint_path, snapshot_file), progress=Progress(out=StringIO())
+    )
+
+    sent = [action for call in m_bulk.call_args_list for action in call.args[1]]
+    assert progress.rows == len(CSV_ROWS) * 20
+    assert sorted(serialize(sent)) == sorted(
+        serialize(action for chunk in actions_from_csv(csv_file) for action in chunk)
+    )
+    # Snapshots are checkpointed by row
+    assert Checkpoint(checkpoint_path, snapshot_file).begin(resume=True) == len(CSV_ROWS) * 20
+    assert Checkpoint(checkpoint_path, snapshot_file).begin(resume=False) == 0
+    assert list(data_ranges(snapshot_file, start=len(CSV_ROWS) * 20)) == []
+
+
+def test_columnar_store_from_snapshot(csv_file, snapshot_file):
+    from_snapshot = ColumnarStore.from_snapshot(snapshot_file)
+    from_csv = ColumnarStore.from_csv(csv_file)
+
+    assert len(from_snapshot) == len(from_csv) == len(CSV_ROWS)
+    assert from_snapshot.top_cities(10) == from_csv.top_cities(10)
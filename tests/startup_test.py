@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds. Importing app takes ~0.5s, mostly the elasticsearch client and Flask, and ~0.03s of our modules
+IMPORT_BUDGET = 2
+OWN_IMPORT_BUDGET = 0.25
+
+
+def run(code: str, *args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True,
+        env={**os.environ, 'ES_HOST': '127.0.0.1:1'}  # nothing listens there
+    )
+
+
+def test_import_has_no_side_effects():
+    result = run(
+        'import json, sys\n'
+        'import app\n'
+        'from elasticsearch_dsl import connections\n'
+        'print(json.dumps({"connections": list(connections.connections._conns), '
+        '"modules": [name for name in ("numpy", "quart") if name in sys.modules]}))'
+    )
+
+    assert json.loads(result.stdout) == {'connections': [], 'modules': []}
+
+
+def test_import_time():
+    result = run('import app', '-X', 'importtime')
+
+    # Lines of "import time: <self us> | <cumulative us> | <module>", the last one being app
+    times = [line.split('|') for line in result.stderr.splitlines() if line.startswith('import time:')][1:]
+    total = int(times[-1][1]) / 1e6
+    own = sum(int(self_us.split(':')[1]) for self_us, _, module in times
+              if module.strip() == 'app' or module.strip().startswith('coruscant')) / 1e6
+    assert total < IMPORT_BUDGET
+    assert own < OWN_IMPORT_BUDGET
@@ -0,0 +1,80 @@
+import logging
+import time
+from unittest.mock import ANY, Mock, patch
+
+from flask import Flask
+
+from coruscant import warmup
+
+
+@patch('coruscant.warmup.run_queries')
+@patch('coruscant.warmup.index_catalog')
+@patch('coruscant.warmup.get_es_client')
+def test_warmup(get_es_client, index_catalog, run_queries):
+    app = Mock()
+
+    warmup.warmup(app)
+
+    assert get_es_client.return_value.info.call_count == warmup.WARMUP_CONNECTIONS
+    index_catalog.refresh.assert_called_once_with(get_es_client.return_value)
+    run_queries.assert_called_once_with(app, deadline=ANY)
+    # The requests of the warmup are back to the settings of the client
+    assert get_es_client.return_value.transport.bounds is None
+
+
+@patch('coruscant.warmup.run_queries')
+@patch('coruscant.warmup.index_catalog')
+@patch('coruscant.warmup.get_es_client')
+def test_warmup_deadline(get_es_client, index_catalog, run_queries, caplog):
+    get_es_client.return_value.info.side_effect = lambda **_: time.sleep(0.1)
+
+    with caplog.at_level(logging.WARNING):
+        warmup.warmup(Mock(), seconds=0.05)
+
+    assert 'Warmup step rollups template skipped, past the deadline' in caplog.text
+    index_catalog.refresh.assert_not_called()
+    run_queries.assert_not_called()
+
+
+@patch('coruscant.warmup.run_queries')
+@patch('coruscant.warmup.index_catalog')
+@patch('coruscant.warmup.get_es_client')
+def test_warmup_es_unreachable(get_es_client, index_catalog, run_queries, caplog):
+    get_es_client.return_value.info.side_effect = ConnectionError
+
+    with caplog.at_level(logging.WARNING):
+        warmup.warmup(Mock())
+
+    assert 'Warmup step connections failed' in caplog.text
+    index_catalog.refresh.assert_not_called()
+    run_queries.assert_not_called()
+
+
+def test_run_queries(caplog):
+    app = Flask(__name__)
+    served = []
+
+    @app.route('/api/measurements')
+    def measurements():
+        served.append('measurements')
+        return {}
+
+    with caplog.at_level(logging.WARNING):
+        warmup.run_queries(app, ['/api/measurements', '/api/missing'])
+
+    assert served == ['measurements']
+    assert 'Warmup query /api/missing failed with 404' in caplog.text
+
+
+def test_run_queries_deadline(caplog):
+    app = Flask(__name__)
+
+    @app.route('/api/measurements')
+    def measurements():
+        time.sleep(0.1)
+        return {}
+
+    with caplog.at_level(logging.WARNING):
+        warmup.run_queries(app, ['/api/measurements', '/api/measurements?cities=100'], time.monotonic() + 0.05)
+
+    assert 'Warmup queries /api/measurements?cities=100 skipped, past the deadline' in caplog.text
@@ -0,0 +1,154 @@
+import json
+import os
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from coruscant.writebehind import SharedStatuses, WriteBuffer
+
+MEASUREMENT = {
+    'average_temperature': 39.156,
+    'average_temperature_uncertainty': 0.37,
+    'city': 'Ahvaz',
+    'country': 'Iran',
+    'day': '2013-07-01',
+    'location': {'lat': 31.35, 'lon': 49.01}
+}
+
+
+def indexed(measurements):
+    return [{'status': 201} for _ in measurements]
+
+
+def journal_lines(buffer):
+    with open(buffer._path) as journal:
+        return [json.loads(line) for line in journal]
+
+
+@pytest.fixture
+def buffers(tmp_path):
+    started = []
+
+    def buffer(send=indexed, **kwargs):
+        started.append(WriteBuffer(str(tmp_path), Mock(side_effect=send), fsync=False, **kwargs))
+        return started[-1]
+
+    yield buffer
+    for buffer in started:
+        buffer.stop()
+
+
+def test_add_and_flush(buffers):
+    buffer = buffers(max_age=60)
+    first = buffer.add(MEASUREMENT)
+    second = buffer.add({**MEASUREMENT, 'day': '2013-08-01'})
+
+    assert buffer.status(first) == {'status': 'pending'}
+    assert [line['add'] for line in journal_lines(buffer)] == [first, second]
+
+    assert buffer.flush()
+    buffer.send.assert_called_once_with([MEASUREMENT, {**MEASUREMENT, 'day': '2013-08-01'}])
+    assert buffer.status(first) == buffer.status(second) == {'status': 'indexed'}
+    assert journal_lines(buffer) == []
+
+
+def test_failed_measurements(buffers):
+    buffer = buffers(send=lambda measurements: [
+        {'status': 400, 'errors': ['failed to parse field [average_temperature]']},
+        {'status': 429, 'errors': ['rejected execution']},
+    ], max_age=60)
+    failed, rejected = buffer.add(MEASUREMENT), buffer.add(MEASUREMENT)
+
+    assert not buffer.flush()
+    assert buffer.status(failed) == {'status': 'failed', 'errors': ['failed to parse field [average_temperature]']}
+    assert buffer.status(rejected) == {'status': 'pending'}
+    assert journal_lines(buffer)[-1] == {'done': [failed]}
+
+
+def test_es_unreachable(buffers):
+    buffer = buffers(send=ConnectionError, max_age=60)
+    _id = buffer.add(MEASUREMENT)
+
+    assert not buffer.flush()
+    assert buffer.status(_id) == {'status': 'pending'}
+
+
+def test_sends_by_size_and_age(buffers):
+    buffer = buffers(max_items=2, max_age=0.05)
+    buffer.add(MEASUREMENT)
+    buffer.add(MEASUREMENT)
+    buffer.add(MEASUREMENT)
+
+    for _ in range(100):
+        if not buffer.pending():
+            break
+        time.sleep(0.01)
+    assert [len(call.args[0]) for call in buffer.send.call_args_list] == [2, 1]
+
+
+def test_compaction(buffers):
+    buffer = buffers(send=lambda measurements: [{'status': 429}] + indexed(measurements[1:]), max_items=2, max_age=60)
+    stuck = buffer.add(MEASUREMENT)
+    for _ in range(12):
+        buffer.add(MEASUREMENT)
+        buffer.flush()
+
+    assert buffer.pending() == 1
+    # 25 lines without the compaction after the 20th
+    assert len(journal_lines(buffer)) < 10
+    with open(buffer._path) as journal:
+        assert WriteBuffer._replay(journal) == {stuck: MEASUREMENT}
+
+
+def test_takes_over_journals_of_stopped_processes(buffers, tmp_path):
+    crashed = buffers(send=ConnectionError, max_age=60)
+    _id = crashed.add(MEASUREMENT)
+    crashed.stop(timeout=0)
+    crashed._journal.close()  # releases the lock, like the process exiting
+
+    buffer = buffers(max_age=60)
+    buffer.start()
+
+    assert buffer.status(_id) == {'status': 'pending'}
+    assert os.listdir(tmp_path) == [os.path.basename(buffer._path)]
+    assert buffer.flush()
+    buffer.send.assert_called_once_with([MEASUREMENT])
+
+
+def test_keeps_journals_of_live_processes(buffers):
+    live = buffers(max_age=60)
+    _id = live.add(MEASUREMENT)
+
+    buffer = buffers(max_age=60)
+    buffer.start()
+
+    assert buffer.pending() == 0
+    assert live.status(_id) == {'status': 'pending'}
+
+
+def test_statuses_shared_by_processes(buffers):
+    accepting = buffers(send=lambda measurements: [
+        {'status': 201}, {'status': 400, 'errors': ['failed to parse field [average_temperature]']}
+    ], max_age=60)
+    indexed_id, failed_id = accepting.add(MEASUREMENT), accepting.add(MEASUREMENT)
+    other = buffers(max_age=60)
+    other.start()
+
+    assert other.status(indexed_id) == {'status': 'pending'}
+    assert accepting.flush()
+    assert other.status(indexed_id) == {'status': 'indexed'}
+    assert other.status(failed_id) == {'status': 'failed', 'errors': ['failed to parse field [average_temperature]']}
+    assert other.status('nope') is None
+
+
+def test_statuses_forgotten(tmp_path):
+    statuses = SharedStatuses(str(tmp_path / 'statuses.db'), size=2)
+    assert statuses.get('a') is None
+
+    statuses.record({'a': {'status': 'indexed'}, 'b': {'status': 'indexed'}})
+    statuses.record({'c': {'status': 'failed', 'errors': []}})
+
+    assert statuses.get('a') is None
+    assert statuses.get('b') == {'status': 'indexed'}
+    assert statuses.get('c') == {'status': 'failed', 'errors': []}